@@ -0,0 +1,126 @@
+"""
+Benchmark chat history pagination on a synthetic chat_msg table in SQLite.
+
+Compares the old offset query (ORDER BY created_at DESC LIMIT n OFFSET k on idx_chat / idx_create)
+with the keyset query of ChatHistoryService.get_chat_history_page on idx_chat_deleted_id.
+The SQL is the same the ORM sends to MySQL, the table follows home/db/20240610-chat_history.sql.
+
+    python -m bench.chat_history_bench --rows 2000000 --chats 2000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DDL = """
+CREATE TABLE chat_msg (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    msg_id VARCHAR(64) NOT NULL DEFAULT '',
+    direction VARCHAR(16) NOT NULL DEFAULT '',
+    msg_type VARCHAR(16) NOT NULL DEFAULT '',
+    chat_type VARCHAR(16) NOT NULL DEFAULT '',
+    chat_id VARCHAR(64) NOT NULL DEFAULT '',
+    at_bot TINYINT NOT NULL DEFAULT 0,
+    user_id VARCHAR(64) NOT NULL DEFAULT '',
+    open_id VARCHAR(64) NOT NULL DEFAULT '',
+    union_id VARCHAR(64) NOT NULL DEFAULT '',
+    msg_parent_id VARCHAR(64) NOT NULL DEFAULT '',
+    msg_root_id VARCHAR(64) NOT NULL DEFAULT '',
+    msg TEXT DEFAULT NULL,
+    deleted TINYINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE UNIQUE INDEX uniq_msg ON chat_msg (msg_id);
+CREATE INDEX idx_user ON chat_msg (user_id);
+CREATE INDEX idx_create ON chat_msg (created_at);
+"""
+OLD_INDEX = "CREATE INDEX idx_chat ON chat_msg (chat_id)"
+NEW_INDEX = "CREATE INDEX idx_chat_deleted_id ON chat_msg (chat_id, deleted, id)"
+
+OFFSET_SQL = ("SELECT * FROM chat_msg WHERE chat_id = ? AND deleted = 0 "
+              "ORDER BY created_at DESC LIMIT ? OFFSET ?")
+KEYSET_SQL = ("SELECT id, msg_id, direction, msg_type, user_id, msg, created_at FROM chat_msg "
+              "WHERE chat_id = ? AND deleted = 0 AND id < ? ORDER BY id DESC LIMIT ?")
+
+
+def build(conn, rows, chats, batch=50000):
+    conn.executescript(DDL)
+    # a few chats are much busier than the rest, like the real table
+    weights = [1.0 / (i + 1) for i in range(chats)]
+    chat_ids = ['oc_{:06d}'.format(i) for i in range(chats)]
+    start = datetime(2024, 6, 10)
+    text = json.dumps({'text': 'x' * 200, 'user_agent': 'Mozilla/5.0'})
+    n = 0
+    while n < rows:
+        size = min(batch, rows - n)
+        picks = random.choices(chat_ids, weights, k=size)
+        conn.executemany(
+            "INSERT INTO chat_msg (msg_id, direction, msg_type, chat_type, chat_id, user_id, msg, deleted, created_at) "
+            "VALUES (?, ?, 'text', 'p2p', ?, ?, ?, ?, ?)",
+            [('om_{}'.format(n + i), 'receive' if i % 2 else 'send', chat, 'u_' + chat[3:], text,
+              1 if i % 50 == 0 else 0, (start + timedelta(seconds=(n + i) * 10)).isoformat(' '))
+             for i, chat in enumerate(picks)])
+        n += size
+    conn.commit()
+    return chat_ids[0]
+
+
+def timed(conn, sql, params, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000, rows
+
+
+def run(rows, chats, page_size, pages, repeat):
+    path = os.path.join(tempfile.mkdtemp(), 'chat_msg_bench.db')
+    conn = sqlite3.connect(path)
+    t = time.perf_counter()
+    chat_id = build(conn, rows, chats)
+    total = conn.execute("SELECT COUNT(*) FROM chat_msg WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    print('[bench] {} rows, busiest chat {} has {} rows, built in {:.1f}s'.format(rows, chat_id, total, time.perf_counter() - t))
+
+    conn.execute(OLD_INDEX)
+    print('[bench] offset pagination, idx_chat / idx_create')
+    print('       plan: {}'.format(conn.execute('EXPLAIN QUERY PLAN ' + OFFSET_SQL, (chat_id, page_size, 0)).fetchall()))
+    for page in pages:
+        ms, _ = timed(conn, OFFSET_SQL, (chat_id, page_size, page * page_size), repeat)
+        print('       page {:>6}: {:8.2f} ms'.format(page, ms))
+
+    conn.execute(NEW_INDEX)
+    conn.execute("ANALYZE")
+    print('[bench] keyset pagination, idx_chat_deleted_id')
+    print('       plan: {}'.format(conn.execute('EXPLAIN QUERY PLAN ' + KEYSET_SQL, (chat_id, 1 << 62, page_size)).fetchall()))
+    # walk the cursor to each page once, then time the page query itself
+    cursors, cursor, page = {}, 1 << 62, 0
+    wanted = set(pages)
+    while page <= max(pages):
+        if page in wanted:
+            cursors[page] = cursor
+        rows_ = conn.execute(KEYSET_SQL, (chat_id, cursor, page_size)).fetchall()
+        if not rows_:
+            break
+        cursor, page = rows_[-1][0], page + 1
+    for page in pages:
+        if page not in cursors:
+            continue
+        ms, _ = timed(conn, KEYSET_SQL, (chat_id, cursors[page], page_size), repeat)
+        print('       page {:>6}: {:8.2f} ms'.format(page, ms))
+    conn.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.rows, args.chats, args.page_size, [0, 10, 100, 1000, 10000], args.repeat)
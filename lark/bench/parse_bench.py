@@ -0,0 +1,126 @@
+"""
+Benchmark gpt.script.parse_analyze against the previous line-by-line regex parser.
+
+Replies are taken from home/gpt/review_reader/warehouse.py (replies, merged, analyze); when the warehouse
+is empty, synthetic replies in the same format are generated. Both parsers must give the same points.
+
+    python -m bench.parse_bench --replies 200 --points 40 --repeat 5
+"""
+import argparse
+import random
+import re
+import time
+
+from home.gpt import script
+from home.gpt.review_reader import warehouse
+
+pt = re.compile(r'^(.*)\(([^()]*)\).*$')
+pt_colon = re.compile(r'^(.*): *([\d, ]+).*$')
+pt_num_range = re.compile(r'^(\d+) *- *(\d+)$')
+pt_filter_quote = re.compile(r'^.*filter_quote: (\d+)\D*$')
+pt_num_has = re.compile(r'^.*\d+.*$')
+pt_num_trim = re.compile(r'^\D*([\d\- ]+)\D*$')
+
+
+def legacy_parse_num(raw):
+    nums = []
+    if mt := pt_num_range.match(raw):
+        for i in range(int(mt.group(1)), int(mt.group(2))+1):
+            nums.append(str(i))
+    else:
+        nums.append(str(raw))
+    return nums
+
+
+def legacy_parse_analyze(raw):
+    # previous parser, without the per-line alert
+    points, filter_quote = [], 0
+    for line in raw.strip().split('\n'):
+        line = line.strip()
+        if 'Reviews Report' in line:
+            if mt := pt_filter_quote.match(line):
+                filter_quote = int(mt.group(1))
+        if not line.startswith('-') or ('(' not in line and ':' not in line):
+            continue
+        line = line.strip(',.- ')
+        if '(' in line and not line.endswith(')'):
+            line += ')'
+        if mt := pt.match(line):
+            point = str(mt.group(1)).strip('. ')
+            ids_str = mt.group(2).strip().strip('[]').split(',')
+        elif mt := pt_colon.match(line):
+            point = str(mt.group(1)).strip('. ')
+            ids_str = mt.group(2).strip().strip('[]').split(',')
+        else:
+            point, ids_str = None, None
+        if point and ids_str:
+            ids, ids_raw = [], []
+            for each in ids_str:
+                each = each.strip().strip("'")
+                if pt_num_has.match(each):
+                    if mt_num_trim := pt_num_trim.match(each):
+                        ids_raw.append(mt_num_trim.group(1))
+            for each in ids_raw:
+                ids += legacy_parse_num(each)
+            ids = list(set(ids))
+            if len(ids) <= filter_quote:
+                continue
+            ids.sort(key=lambda x: int(x))
+            points.append({'point': point, 'ids': ids})
+    points.sort(key=lambda x: len(x['ids']), reverse=True)
+    return points
+
+
+def stored_replies():
+    replies = [str(each) for each in warehouse.replies if str(each).strip()]
+    replies += [each for each in [warehouse.merged] + list(warehouse.analyze.values()) if each.strip()]
+    return replies
+
+
+def synthetic_replies(count, points, reviews=3000):
+    replies = []
+    for _ in range(count):
+        lines = []
+        for i in range(points):
+            ids = random.sample(range(1, reviews), random.randint(1, 30))
+            text = ', '.join(map(str, ids))
+            if random.random() < 0.1:
+                start = random.randint(1, reviews - 50)
+                text += ', {}-{}'.format(start, start + random.randint(1, 50))
+            lines.append('- Point number {} about fabric and sizing ({})'.format(i, text))
+        replies.append('\n'.join(lines))
+    return replies
+
+
+def timed(parse, replies, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for reply in replies:
+            parse(reply)
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+def run(count, points, repeat):
+    replies = stored_replies()
+    source = 'warehouse'
+    if not replies:
+        replies, source = synthetic_replies(count, points), 'synthetic'
+    lines = sum(reply.count('\n') + 1 for reply in replies)
+    print('[bench] {} {} replies, {} lines'.format(len(replies), source, lines))
+    mismatched = sum(1 for reply in replies if legacy_parse_analyze(reply) != script.parse_analyze(reply))
+    print('[bench] replies parsed differently: {}'.format(mismatched))
+    legacy_ms = timed(legacy_parse_analyze, replies, repeat)
+    new_ms = timed(script.parse_analyze, replies, repeat)
+    print('[bench] legacy: {:8.2f} ms'.format(legacy_ms))
+    print('[bench] single pass: {:8.2f} ms ({:.1f}x)'.format(new_ms, legacy_ms / new_ms if new_ms else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replies', type=int, default=200)
+    parser.add_argument('--points', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.replies, args.points, args.repeat)
@@ -2,8 +2,11 @@ from apscheduler.schedulers.background import BackgroundScheduler
 
 from . import bu_cs
 from .crawler import halara_crawler_job
+from .gpt import response_cache
+from .services import context_reaper
 from lark.settings import IS_PROD, TIME_ZONE
 from util.log_util import logger
+from util import redis_util
 
 
 def init():
@@ -13,6 +16,12 @@ def init():
         scheduler.add_job(func=bu_cs.cron_check_approval, trigger='cron', second='18', minute='3', hour='*')
         # Add Halara crawler job - runs daily at 2 AM
         scheduler.add_job(func=halara_crawler_job.run_crawler, trigger='cron', hour='2', minute='0')
+        # Redis command latency percentiles, every 10 minutes
+        scheduler.add_job(func=redis_util.log_latency_stats, trigger='interval', minutes=10)
+        # delete expired chat contexts in batches
+        scheduler.add_job(func=context_reaper.run, trigger='interval', minutes=10)
+        # hit rate of the gpt response cache
+        scheduler.add_job(func=response_cache.log_stats, trigger='interval', minutes=10)
 
     try:
         scheduler.start()
@@ -0,0 +1,39 @@
+
+-- optional: daily-partitioned chat_context, enabled with CHAT_CONTEXT_PARTITIONED=true
+-- p{yyyymmdd} holds the contexts expiring during that utc day, context_reaper.rotate_partitions() adds the
+-- next days and drops expired days wholesale instead of deleting their rows.
+-- partition columns must be part of every unique key, so expires_at joins the primary key and is NOT NULL;
+-- contexts without ttl are stored with the far-future expiry (context_reaper.NO_EXPIRY) and land in pmax,
+-- the catch-all partition rotate_partitions() splits new days from; it must not be dropped or renamed.
+
+-- the first partition ends at the next utc midnight after the deploy, computed here so the script can run
+-- on any day; the bound is an epoch literal, so it is built into the statement and run as a prepared statement.
+SET @p0_upper = UNIX_TIMESTAMP() - MOD(UNIX_TIMESTAMP(), 86400) + 86400;
+SET @create_partitioned = CONCAT("
+CREATE TABLE IF NOT EXISTS chat_context_partitioned (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    user_id VARCHAR(64) NOT NULL,
+    context_key VARCHAR(64) NOT NULL,
+    context_value TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL DEFAULT '2038-01-19 03:14:07',
+    PRIMARY KEY (id, expires_at),
+    INDEX idx_user_context (user_id, context_key),
+    INDEX idx_expires_at (expires_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+PARTITION BY RANGE (UNIX_TIMESTAMP(expires_at)) (
+    PARTITION p0 VALUES LESS THAN (", @p0_upper, "),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+)");
+PREPARE create_partitioned FROM @create_partitioned;
+EXECUTE create_partitioned;
+DEALLOCATE PREPARE create_partitioned;
+
+-- copy live contexts, then swap the tables atomically
+INSERT INTO chat_context_partitioned (id, user_id, context_key, context_value, created_at, updated_at, expires_at)
+SELECT id, user_id, context_key, context_value, created_at, updated_at, IFNULL(expires_at, '2038-01-19 03:14:07')
+FROM chat_context WHERE expires_at IS NULL OR expires_at > NOW();
+
+RENAME TABLE chat_context TO chat_context_unpartitioned, chat_context_partitioned TO chat_context;
+-- DROP TABLE chat_context_unpartitioned;  -- after checking the new table
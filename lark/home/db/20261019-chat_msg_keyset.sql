@@ -0,0 +1,7 @@
+
+-- keyset pagination of chat history: WHERE chat_id = ? AND deleted = 0 AND id < ? ORDER BY id DESC LIMIT ?
+-- is a single range scan on this index, no filesort and no offset rows to skip
+ALTER TABLE `chat_msg` ADD KEY `idx_chat_deleted_id` (`chat_id`, `deleted`, `id`);
+
+-- idx_chat is a prefix of the new index
+ALTER TABLE `chat_msg` DROP KEY `idx_chat`;
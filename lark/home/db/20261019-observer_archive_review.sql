@@ -0,0 +1,11 @@
+-- uploaded reviews, one compact row per review, stored once per content (sha256 of the selected columns of all rows)
+-- rows are never rewritten; observer_archive.origin_info and the workbench detail only keep the digest
+CREATE TABLE IF NOT EXISTS `observer_archive_review` (
+    `id` bigint(20) NOT NULL AUTO_INCREMENT COMMENT 'key',
+    `digest` char(64) NOT NULL DEFAULT '' COMMENT 'sha256 of the uploaded rows',
+    `seq` int NOT NULL DEFAULT '0' COMMENT 'row order in the uploaded sheet, from 0',
+    `data` json DEFAULT NULL COMMENT 'selected columns of the row, e.g. {"#1": "id", "#2": "content"}',
+
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `uniq_digest_seq` (`digest`, `seq`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='评论分析项目的评论数据';
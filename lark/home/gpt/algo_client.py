@@ -1,53 +1,142 @@
-import json
+import hashlib
+import threading
+import time
+import traceback
 
-import requests
+import numpy as np
 
+from home import redis_key
 from home.config import constant
-from home.gpt import script
+from home.gpt import meta, script
 from home.gpt.review_reader import warehouse
-from util import http_util
+from util import openai_util, redis_util
 from util.lark_util import Lark
 from util.log_util import logger
 
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # sentence-transformers is optional, points are then embedded by the api
+    SentenceTransformer = None
+
+# 相似度阈值, 与簇中心的余弦相似度不低于该值即归为同一观点
+SIMILARITY_THRESHOLD = 0.82
+LOCAL_EMBEDDING_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+EMBEDDING_BATCH = 512
+EMBEDDING_CACHE_TTL = 30 * 86400
+
+_local_model = None
+_local_model_lock = threading.Lock()
+
+
+def _get_local_model():
+    global _local_model
+    if SentenceTransformer is None:
+        return None
+    with _local_model_lock:
+        if _local_model is None:
+            try:
+                _local_model = SentenceTransformer(LOCAL_EMBEDDING_MODEL)
+            except Exception:
+                logger.error('[algo merge] load local embedding model failed: {}'.format(traceback.format_exc()))
+                return None
+        return _local_model
+
+
+def _embed_by_api(texts, retry_max=3):
+    # 按文本缓存向量, 同一观点只请求一次
+    keys = [redis_key.gpt_embedding(meta.MODEL_EMBEDDING, hashlib.md5(text.encode('utf-8')).hexdigest()) for text in texts]
+    cached = redis_util.mget(keys)
+    vectors = dict((i, v) for i, v in enumerate(cached) if v)
+    missing = [i for i in range(len(texts)) if i not in vectors]
+    client = openai_util.get_client(meta.OPEN_AI_KEY_AIGC)
+    for start in range(0, len(missing), EMBEDDING_BATCH):
+        batch = missing[start:start + EMBEDDING_BATCH]
+        retry, resp = 0, None
+        while retry < retry_max and resp is None:
+            retry += 1
+            try:
+                resp = client.embeddings.create(model=meta.MODEL_EMBEDDING, input=[texts[i] for i in batch])
+            except Exception as e:
+                logger.error('[algo merge] embedding api failed, retry: {}, {}'.format(retry, traceback.format_exc()))
+                if not openai_util.is_retryable(e) or retry >= retry_max:
+                    break
+                time.sleep(openai_util.retry_delay(retry, e))
+        if resp is None:
+            return None
+        fresh = {}
+        for i, item in zip(batch, resp.data):
+            vectors[i] = item.embedding
+            fresh[keys[i]] = [round(x, 6) for x in item.embedding]
+        redis_util.set_many(fresh, ex=EMBEDDING_CACHE_TTL)
+    logger.info('[algo merge] embedding {} points, cached: {}'.format(len(texts), len(texts) - len(missing)))
+    return np.asarray([vectors[i] for i in range(len(texts))], dtype=np.float32)
+
+
+def embed(texts, retry_max=3):
+    """返回归一化后的向量矩阵 (len(texts), dim), 失败返回None"""
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    model = _get_local_model()
+    if model is not None:
+        vectors = np.asarray(model.encode(texts, batch_size=64), dtype=np.float32)
+    else:
+        vectors = _embed_by_api(texts, retry_max=retry_max)
+        if vectors is None:
+            return None
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def cluster(vectors, weights, threshold=SIMILARITY_THRESHOLD):
+    """
+    阈值聚类: 按权重从高到低, 未归类中权重最高的观点作为簇中心, 相似度达到阈值的未归类观点并入该簇
+    returns: [[center index, member index...], ...]
+    """
+    order = np.argsort(-np.asarray(weights), kind='stable')
+    unassigned = np.ones(len(order), dtype=bool)
+    clusters = []
+    for center in order:
+        if not unassigned[center]:
+            continue
+        candidates = np.flatnonzero(unassigned)
+        sims = vectors[candidates] @ vectors[center]
+        members = candidates[sims >= threshold]
+        unassigned[members] = False
+        unassigned[center] = False
+        clusters.append([int(center)] + [int(m) for m in members if m != center])
+    return clusters
+
 
 def merge_points(replies, retry_max=3):
     if not replies:
         return None
-    map_point_weight, map_point_ids, result_points = {}, {}, []
+    map_point_ids, result_points = {}, []
     # 1. trim points
     for reply in replies:
         reply = str(reply).strip()
         points = script.parse_analyze(reply)
         for each in points:
-            point = each['point']
-            ids = each['ids']
-            if point not in map_point_ids:
-                map_point_ids[point] = ids
-            else:
-                map_point_ids[point] = list(set(map_point_ids[point] + ids))
-    map_point_weight = {k: len(v) for (k, v) in map_point_ids.items()}
-    # 2. request algo api
-    url = 'http://192.168.1.1:8090/voc/merge'
-    retry, map_summary_points = 0, {}
-    while retry < retry_max:
-        retry += 1
-        resp = requests.post(url, headers=http_util.get_json_headers(), data=json.dumps(map_point_weight))
-        logger.info('[chatgpt reviews algo merge] request: {}, response: {}'.format(json.dumps(map_point_weight), resp.text))
-        if resp and resp.ok:
-            resp = resp.json()
-            if 'result' in resp:
-                map_summary_points = resp['result']
-                break
-        if resp and not map_summary_points:
-            logger.error('[chatgpt reviews request failed] call algo api failed, raw: {}, resp: {}'.format(map_point_weight, resp.text))
-            Lark(constant.LARK_CHAT_ID_P0).send_rich_text('chatgpt reviews request failed', 'call algo api failed, raw: {}, resp: {}'.format(map_point_weight, resp.text))
-    # 3. wrap result
-    for new_point, old_points in map_summary_points.items():
-        ids = []
-        for old_point in old_points:
-            ids = list(set(ids + map_point_ids.get(old_point, [])))
-        ids.sort(key=lambda x: int(x))
-        result_points.append({'point': new_point, 'ids': ids})
+            map_point_ids.setdefault(each['point'], set()).update(each['ids'])
+    points = list(map_point_ids.keys())
+    weights = [len(map_point_ids[p]) for p in points]
+    # 2. embedding & cluster
+    start = time.monotonic()
+    vectors = embed(points, retry_max=retry_max)
+    if vectors is None:
+        logger.error('[chatgpt reviews algo merge] embedding failed, points: {}'.format(len(points)))
+        Lark(constant.LARK_CHAT_ID_P0).send_rich_text('chatgpt reviews request failed', 'embedding failed, points: {}'.format(len(points)))
+        clusters = [[i] for i in range(len(points))]
+    else:
+        clusters = cluster(vectors, weights)
+    logger.info('[chatgpt reviews algo merge] {} points -> {} clusters in {:.3f}s'.format(
+        len(points), len(clusters), time.monotonic() - start))
+    # 3. wrap result, 簇中心作为合并后的观点
+    for members in clusters:
+        ids = set()
+        for i in members:
+            ids |= map_point_ids[points[i]]
+        result_points.append({'point': points[members[0]], 'ids': sorted(ids, key=lambda x: int(x))})
 
     result_points.sort(key=lambda x: len(x['ids']), reverse=True)
     return result_points
@@ -55,4 +144,3 @@ def merge_points(replies, retry_max=3):
 
 if __name__ == '__main__':
     merge_points(warehouse.replies)
-
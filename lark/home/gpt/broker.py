@@ -1,90 +1,102 @@
 import traceback
 
 from home.config import constant
-from home.gpt import chat_client, meta, dev_mode, cache, cache_key
+from home.gpt import chat_client, meta, dev_mode, cache, context_store
 from home.lark_client import sender
 from home.models import ChatMsg
-from util import redis_util, sys_util
+from home.services import chat_persister
+from util import sys_util
 from util.lark_util import Lark
 from util.log_util import logger
 
 
-def ask(body):
+def parse_event(body):
+    """消息事件的字段, 不需要回复时返回None"""
     if not body or 'event' not in body:
         return None
     event = body['event']
-    msg_id = event.get('open_message_id', '')
-    chat_type = event.get('chat_type', '')
-    user_id = event.get('employee_id', '')
     is_mention = event.get('is_mention', False)
-    if is_mention:
-        at_bot = constant.YES_IN_DB
-    else:
-        at_bot = constant.NO_IN_DB
+    chat_type = event.get('chat_type', '')
     if chat_type == 'group' and not is_mention:
         # 群聊只关注直接at机器人消息
         return None
-    msg_type = event.get('msg_type', '')
-    chat_id = event.get('open_chat_id', '')
-    open_id = event.get('open_id', '')
-    union_id = event.get('union_id', '')
-    msg_parent_id = event.get('parent_id', '')
-    msg_root_id = event.get('root_id', '')
     text_without_at_bot = event.get('text_without_at_bot', '')
     if text_without_at_bot is None:
         return None
     text_without_at_bot = str(text_without_at_bot)
-    user_agent = event.get('user_agent', '')
-    msg_receive = {'text': text_without_at_bot, 'user_agent': user_agent}
-
+    ev = {
+        'msg_id': event.get('open_message_id', ''),
+        'chat_type': chat_type,
+        'user_id': event.get('employee_id', ''),
+        'at_bot': constant.YES_IN_DB if is_mention else constant.NO_IN_DB,
+        'msg_type': event.get('msg_type', ''),
+        'chat_id': event.get('open_chat_id', ''),
+        'open_id': event.get('open_id', ''),
+        'union_id': event.get('union_id', ''),
+        'msg_parent_id': event.get('parent_id', ''),
+        'msg_root_id': event.get('root_id', ''),
+        'text': text_without_at_bot,
+        'user_agent': event.get('user_agent', ''),
+    }
     # 判断是否进入dev_mode
-    is_dev_mode, direction_ask, direction_reply = constant.NO_IN_DB, 'receive', 'chat_gpt'
+    ev['is_dev_mode'], ev['direction_ask'], ev['direction_reply'] = constant.NO_IN_DB, 'receive', 'chat_gpt'
     if text_without_at_bot.strip().lower().startswith(dev_mode.CHAT_PREFIX):
-        is_dev_mode = constant.YES_IN_DB
-        direction_reply = 'send'
+        ev['is_dev_mode'] = constant.YES_IN_DB
+        ev['direction_reply'] = 'send'
+    return ev
+
+
+def receive_msg(ev):
+    return ChatMsg(msg_id=ev['msg_id'], direction=ev['direction_ask'], msg_type=ev['msg_type'], chat_type=ev['chat_type'],
+                   chat_id=ev['chat_id'], at_bot=ev['at_bot'], user_id=ev['user_id'], open_id=ev['open_id'],
+                   union_id=ev['union_id'], msg_parent_id=ev['msg_parent_id'], msg_root_id=ev['msg_root_id'],
+                   msg={'text': ev['text'], 'user_agent': ev['user_agent']}, deleted=constant.NO_IN_DB,
+                   dev_mode=ev['is_dev_mode'], chat_bot=meta.CHAT_BOT_NAME)
+
+
+def reply_msg(ev, reply_resp, reply, model):
+    reply_msg_id, reply_msg_type = '', ''
+    if reply_resp and 'data' in reply_resp and 'message_id' in reply_resp['data'] and 'msg_type' in reply_resp['data']:
+        reply_msg_id = reply_resp['data']['message_id']
+        reply_msg_type = reply_resp['data']['msg_type']
+    msg_reply = {'text': reply, 'replier': model}
+    return ChatMsg(msg_id=reply_msg_id, direction=ev['direction_reply'], msg_type=reply_msg_type, chat_type=ev['chat_type'],
+                   chat_id=ev['chat_id'], at_bot=constant.NO_IN_DB, user_id=ev['user_id'], open_id='', union_id='',
+                   msg_parent_id=ev['msg_id'], msg_root_id='', msg=msg_reply, deleted=constant.NO_IN_DB,
+                   dev_mode=ev['is_dev_mode'], chat_bot=meta.CHAT_BOT_NAME)
+
+
+def ask(body):
+    ev = parse_event(body)
+    if not ev:
+        return None
+    user_id, chat_id, text_without_at_bot = ev['user_id'], ev['chat_id'], ev['text']
 
     # 判断用来执行的模型
     model = dev_mode.get_model(user_id, chat_id)
 
     # 记录消息
     try:
-        ChatMsg(msg_id=msg_id, direction=direction_ask, msg_type=msg_type, chat_type=chat_type, chat_id=chat_id,
-                at_bot=at_bot, user_id=user_id, open_id=open_id, union_id=union_id, msg_parent_id=msg_parent_id,
-                msg_root_id=msg_root_id, msg=msg_receive, deleted=constant.NO_IN_DB, dev_mode=is_dev_mode,
-                chat_bot=meta.CHAT_BOT_NAME).save()
+        # 异步批量写入, 进程被强杀时会丢失未刷出的消息 (见 chat_persister)
+        chat_persister.save(receive_msg(ev))
     except:
         logger.error('[chat write msg exception]: {}'.format(traceback.format_exc()))
         Lark(constant.LARK_CHAT_ID_P0).send_rich_text('chat write exception', traceback.format_exc())
 
-    if is_dev_mode:
+    if ev['is_dev_mode']:
         model = 'sys'
         reply = dev_mode.reply_in_dev(user_id, chat_id, text_without_at_bot)
     else:
         # 进入chatGPT
         hit, reply = do_ask_with_context(chat_id, text_without_at_bot, model=model)
-        if hit is None:
-            # 上下文过载，先自动清空
-            hit, reply = do_ask_with_context(chat_id, text_without_at_bot, reset=True, model=model)
-            if hit is None:
-                # 仍过载就是本身问题太长，无法处理
-                reply = '上下文过载，无法处理(reach maximum context length, cannot handle it)'
-            elif hit:
-                reply = '[上下文过载，已重置(reach maximum context length, have reset)]\n{}'.format(reply)
 
     # 发送回答
     try:
-        reply_msg_id, reply_msg_type = '', ''
         if not reply:
             reply = "That's empty in my mind."
         reply_resp = sender.reply_text(chat_id, user_id, reply)
-        if reply_resp and 'data' in reply_resp and 'message_id' in reply_resp['data'] and 'msg_type' in reply_resp['data']:
-            reply_msg_id = reply_resp['data']['message_id']
-            reply_msg_type = reply_resp['data']['msg_type']
-        msg_reply = {'text': reply, 'replier': model}
         # 记录回答
-        ChatMsg(msg_id=reply_msg_id, direction=direction_reply, msg_type=reply_msg_type, chat_type=chat_type, chat_id=chat_id,
-                at_bot=constant.NO_IN_DB, user_id=user_id, open_id='', union_id='', msg_parent_id=msg_id,
-                msg_root_id='', msg=msg_reply, deleted=constant.NO_IN_DB, dev_mode=is_dev_mode, chat_bot=meta.CHAT_BOT_NAME).save()
+        chat_persister.save(reply_msg(ev, reply_resp, reply, model))
     except:
         logger.error('[chat reply exception]: {}'.format(traceback.format_exc()))
         Lark(constant.LARK_CHAT_ID_P0).send_rich_text('chat reply exception', traceback.format_exc())
@@ -92,21 +104,14 @@ def ask(body):
 
 
 def do_ask_with_context(chat_id, content, reset=False, model=meta.MODEL_CHAT):
-    redis_key = cache_key.get_context_key(chat_id)
-    each_chat_user = 'user::{}'.format(content)
-    if reset:
-        redis_util.del_(redis_key)
-    redis_util.rpush(redis_key, each_chat_user)
-    redis_util.expire(redis_key, meta.TIMEOUT_CHAT_CONTEXT)
-    prompt_list = redis_util.lrange(redis_key, 0, -1)
-    # reply
+    total, prompt_list = context_store.push_user(chat_id, content, model=model, reset=reset)
     system_prompt = cache.get_tone(chat_id)
     temperature = cache.get_temp(chat_id)
+    # 上下文超出预算前先压缩, 不会因过长被拒
+    prompt_list = context_store.fit(chat_id, total, prompt_list, model=model, system_prompt=system_prompt)
+    # reply
     hit, reply = chat_client.ask(prompt_list, system_prompt=system_prompt, model=model, temperature=temperature)
     # 写入回复上下文
     if hit:
-        each_chat_bot = 'assistant::{}'.format(reply)
-        redis_util.rpush(redis_key, each_chat_bot)
-        redis_util.expire(redis_key, meta.TIMEOUT_CHAT_CONTEXT)
+        context_store.push_reply(chat_id, reply, model=model)
     return hit, reply
-
@@ -0,0 +1,68 @@
+import asyncio
+import traceback
+
+from asgiref.sync import sync_to_async
+
+from home.config import constant
+from home.gpt import chat_client, meta, dev_mode, cache, context_store
+from home.gpt.broker import parse_event, receive_msg, reply_msg
+from home.lark_client import sender
+from home.services import chat_persister
+from util.lark_util import Lark
+from util.log_util import logger
+
+
+async def _alert(title):
+    await asyncio.to_thread(Lark(constant.LARK_CHAT_ID_P0).send_rich_text, title, traceback.format_exc())
+
+
+async def do_ask_with_context(chat_id, content, reset=False, model=meta.MODEL_CHAT):
+    # 上下文与会话设置并发读取
+    (total, prompt_list), system_prompt, temperature = await asyncio.gather(
+        context_store.push_user_async(chat_id, content, model=model, reset=reset),
+        # 语气回源mysql时在线程池中执行, 不占用共享的同步线程
+        sync_to_async(cache.get_tone, thread_sensitive=False)(chat_id),
+        sync_to_async(cache.get_temp, thread_sensitive=False)(chat_id),
+    )
+    prompt_list = await context_store.fit_async(chat_id, total, prompt_list, model=model, system_prompt=system_prompt)
+    hit, reply = await chat_client.ask_async(prompt_list, system_prompt=system_prompt, model=model, temperature=temperature)
+    return hit, reply
+
+
+async def ask(body):
+    """broker.ask() on the event loop: redis, openai and lark calls are awaited instead of holding a thread each"""
+    ev = parse_event(body)
+    if not ev:
+        return None
+    user_id, chat_id, text_without_at_bot = ev['user_id'], ev['chat_id'], ev['text']
+
+    # 记录消息, 异步批量写入不会阻塞, 进程被强杀时会丢失未刷出的消息 (见 chat_persister)
+    try:
+        chat_persister.save(receive_msg(ev))
+    except:
+        logger.error('[chat write msg exception]: {}'.format(traceback.format_exc()))
+        await _alert('chat write exception')
+
+    model = await sync_to_async(dev_mode.get_model, thread_sensitive=False)(user_id, chat_id)
+    hit = False
+    if ev['is_dev_mode']:
+        model = 'sys'
+        reply = await sync_to_async(dev_mode.reply_in_dev)(user_id, chat_id, text_without_at_bot)
+    else:
+        # 进入chatGPT
+        hit, reply = await do_ask_with_context(chat_id, text_without_at_bot, model=model)
+
+    # 发送回答, 同时写入回复上下文
+    try:
+        if not reply:
+            reply = "That's empty in my mind."
+        jobs = [sender.reply_text_async(chat_id, user_id, reply)]
+        if hit:
+            jobs.append(context_store.push_reply_async(chat_id, reply, model=model))
+        reply_resp = (await asyncio.gather(*jobs))[0]
+        # 记录回答
+        chat_persister.save(reply_msg(ev, reply_resp, reply, model))
+    except:
+        logger.error('[chat reply exception]: {}'.format(traceback.format_exc()))
+        await _alert('chat reply exception')
+    return True
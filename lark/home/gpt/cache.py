@@ -1,7 +1,7 @@
 from home.config import constant
 from home.gpt import dev_mode, meta
 from home.lark_client import bot
-from util import redis_util
+from util import redis_util, local_cache
 from home.gpt import cache_key as key
 
 
@@ -9,14 +9,20 @@ def set_tone(chat_id, tone_text):
     if tone_text is None:
         return
     redis_util.set_(key.get_tone_key(chat_id), tone_text, 24 * 3600)
+    local_cache.invalidate(key.get_tone_key(chat_id))
 
 
 def get_tone(chat_id):
+    # 进程内缓存 -> redis -> mysql
+    return local_cache.get_or_load(key.get_tone_key(chat_id), lambda: _load_tone(chat_id))
+
+
+def _load_tone(chat_id):
     tone_text = redis_util.get(key.get_tone_key(chat_id))
     if tone_text is None:
         _, tone_text = dev_mode.get_tone(chat_id)
         if tone_text is not None:
-            set_tone(chat_id, tone_text)
+            redis_util.set_(key.get_tone_key(chat_id), tone_text, 24 * 3600)
     return tone_text
 
 
@@ -25,6 +31,7 @@ def del_tone(user_id, prompt_id):
     if ok:
         for chat in chats:
             redis_util.del_(key.get_tone_key(chat))
+            local_cache.invalidate(key.get_tone_key(chat))
     return ok, msg
 
 
@@ -43,6 +50,10 @@ def get_chatgpt4_users(force_update=False):
 
 
 def get_temp(chat_id):
+    return local_cache.get_or_load(key.get_temperature_key(chat_id), lambda: _load_temp(chat_id))
+
+
+def _load_temp(chat_id):
     # try to get from cache
     temp = redis_util.get(key.get_temperature_key(chat_id))
     if temp is not None:
@@ -67,6 +78,7 @@ def set_temp(temp, chat_id):
     except:
         return False, 'error format of temperature, pls input a float'
     redis_util.set_(key.get_temperature_key(chat_id), temp, duration)
+    local_cache.invalidate(key.get_temperature_key(chat_id))
     return True, 'success, temperature {} will effect in {} hours'.format(temp, duration_hour)
 
 
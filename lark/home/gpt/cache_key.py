@@ -4,6 +4,10 @@ def get_context_key(chat_id):
     return 'chat_gpt:context:{}'.format(chat_id)
 
 
+def get_context_tokens_key(chat_id):
+    return 'chat_gpt:context:tokens:{}'.format(chat_id)
+
+
 def get_tone_key(chat_id):
     return 'chat_gpt:tone:{}'.format(chat_id)
 
@@ -1,10 +1,9 @@
+import asyncio
 import time
 import traceback
-from openai import OpenAI
 
-from home.config import constant
-from home.gpt import meta
-from util.lark_util import Lark
+from home.gpt import meta, response_cache
+from util import openai_util
 from util.log_util import logger
 
 
@@ -17,38 +16,98 @@ def get_default_sys_prompt(model):
     return DEFAULT_SYS_PROMPT.format(str(model).upper()).strip()
 
 
-def ask(prompt_list, system_prompt='', model=meta.MODEL_CHAT_3_5, temperature=0.7, auto_retry=False):
+ERROR_REPLY = 'error in parsing, please retry later or contact Luke.'
+
+
+def build_messages(prompt_list, system_prompt=''):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    for prompt in prompt_list:
+        role, content = 'user', prompt
+        if '::' in prompt:
+            role, content = prompt.split('::', 1)
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def _cache_key(model, system_prompt, messages, temperature, use_cache):
+    # temperature为0的结果可复用, 其它情况需显式开启缓存
+    if use_cache is None:
+        use_cache = temperature == 0
+    if use_cache and response_cache.cache.enabled:
+        return response_cache.cache.make_key(model, system_prompt, messages, temperature)
+    return None
+
+
+def ask(prompt_list, system_prompt='', model=meta.MODEL_CHAT_3_5, temperature=0.7, auto_retry=False, retry_max=3,
+        use_cache=None, refresh_cache=False):
     if not prompt_list:
         return False, ''
-    retry_max = 3 if auto_retry else 1
+    retry_max = retry_max if auto_retry else 1
+    messages = build_messages(prompt_list, system_prompt)
+    # refresh_cache跳过读取, 用新结果覆盖(如结果格式校验失败后重试)
+    cache_key = _cache_key(model, system_prompt, messages, temperature, use_cache)
+    if cache_key and not refresh_cache and (reply := response_cache.cache.get(cache_key)) is not None:
+        return True, reply
+    client = openai_util.get_client(meta.OPEN_AI_KEY_AIGC)
     retry = 0
     while retry < retry_max:
         retry += 1
         try:
-            client = OpenAI(api_key=meta.OPEN_AI_KEY_AIGC)
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            for prompt in prompt_list:
-                role, content = 'user', prompt
-                if '::' in prompt:
-                    role, content = prompt.split('::', 1)
-                messages.append({"role": role, "content": content})
             response = client.chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature
             )
             if response and response.choices and response.choices[0].message:
-                return True, response.choices[0].message.content
+                reply = response.choices[0].message.content
+                if cache_key and reply:
+                    response_cache.cache.put(cache_key, model, reply)
+                return True, reply
+        except Exception as e:
+            logger.error('[openai chat exception] retry: {}/{}, {}'.format(retry, retry_max, traceback.format_exc()))
+            if not openai_util.is_retryable(e) or retry >= retry_max:
+                openai_util.alert('openai chat exception', e, traceback.format_exc())
+                break
+            time.sleep(openai_util.retry_delay(retry, e))
+
+    return False, ERROR_REPLY
+
+
+async def ask_async(prompt_list, system_prompt='', model=meta.MODEL_CHAT_3_5, temperature=0.7, auto_retry=False, retry_max=3,
+                    use_cache=None, refresh_cache=False):
+    """ask() for the asyncio path (gpt.broker_async), the event loop is not blocked while waiting for OpenAI"""
+    if not prompt_list:
+        return False, ''
+    retry_max = retry_max if auto_retry else 1
+    messages = build_messages(prompt_list, system_prompt)
+    cache_key = _cache_key(model, system_prompt, messages, temperature, use_cache)
+    if cache_key and not refresh_cache and (reply := await asyncio.to_thread(response_cache.cache.get, cache_key)) is not None:
+        return True, reply
+    client = openai_util.get_async_client(meta.OPEN_AI_KEY_AIGC)
+    retry = 0
+    while retry < retry_max:
+        retry += 1
+        try:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature
+            )
+            if response and response.choices and response.choices[0].message:
+                reply = response.choices[0].message.content
+                if cache_key and reply:
+                    await asyncio.to_thread(response_cache.cache.put, cache_key, model, reply)
+                return True, reply
         except Exception as e:
-            logger.error('[openai chat exception] {}'.format(traceback.format_exc()))
-            Lark(constant.LARK_CHAT_ID_P0).send_rich_text('openai chat exception', traceback.format_exc())
-            if not auto_retry:
+            logger.error('[openai chat exception] retry: {}/{}, {}'.format(retry, retry_max, traceback.format_exc()))
+            if not openai_util.is_retryable(e) or retry >= retry_max:
+                await asyncio.to_thread(openai_util.alert, 'openai chat exception', e, traceback.format_exc())
                 break
-            time.sleep(1)
+            await asyncio.sleep(openai_util.retry_delay(retry, e))
 
-    return False, 'error in parsing, please retry later or contact Luke.'
+    return False, ERROR_REPLY
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+"""
+对话上下文: redis list存放各轮消息('role::content'), 旁路key记录累计token数.
+写入时累加token数, 超出预算前用LTRIM删除最早的轮次(可选替换为摘要), 请求不会因上下文过长被拒
+"""
+import threading
+
+import tiktoken
+from redis.exceptions import WatchError
+
+from home.gpt import chat_client, meta, cache_key
+from util import redis_util, token_count
+from util.log_util import logger
+
+REPLY_RESERVE = 1500  # 给回答预留的token
+COMPACT_RATIO = 0.6  # 压缩后保留预算的比例, 避免每轮都压缩
+TOKENS_PER_MESSAGE = 4  # 每条消息的格式开销
+DEFAULT_ENCODING = 'cl100k_base'
+TRIM_RETRY = 3  # 压缩期间列表被改写时重试的次数
+SUMMARY_PREFIX = 'system::Summary of the earlier conversation:\n'
+SUMMARY_PROMPT = """
+Summarize the conversation below in no more than 200 words. Keep the facts, names, numbers, decisions and open
+questions the assistant needs to continue the conversation, and write it in the language of the conversation.
+
+{}
+"""
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(model):
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+        return _encodings[model]
+
+
+def count(model, entries):
+    return [n + TOKENS_PER_MESSAGE for n in token_count.count_many(get_encoding(model), entries)]
+
+
+def budget(model, system_prompt=''):
+    """上下文可用的token数"""
+    window = meta.CONTEXT_WINDOW.get(model, meta.CONTEXT_WINDOW[meta.MODEL_CHAT])
+    limit = min(meta.MAX_CONTEXT_TOKENS, window - REPLY_RESERVE)
+    if system_prompt:
+        limit -= count(model, [system_prompt])[0]
+    return limit
+
+
+def plan_compaction(counts, limit):
+    """从最新的一轮往前保留到预算的COMPACT_RATIO, 返回要删除的最早条数, 最新一轮总是保留"""
+    target, kept, keep = int(limit * COMPACT_RATIO), 0, 0
+    for n in reversed(counts):
+        if keep and kept + n > target:
+            break
+        kept += n
+        keep += 1
+    return len(counts) - keep
+
+
+def summary_prompt(dropped):
+    lines = []
+    for entry in dropped:
+        role, content = entry.split('::', 1) if '::' in entry else ('user', entry)
+        lines.append('{}: {}'.format(role, content))
+    return ['user::{}'.format(SUMMARY_PROMPT.format('\n'.join(lines)).strip())]
+
+
+def _keys(chat_id):
+    return cache_key.get_context_key(chat_id), cache_key.get_context_tokens_key(chat_id)
+
+
+def _redis_keys(chat_id):
+    return tuple(redis_util.key_prefix + k for k in _keys(chat_id))
+
+
+def _queue_push(pipe, key, tokens_key, entry, model, reset=False, read=False):
+    """写入消息的命令, 同步的redis_util.Batch与redis.asyncio的pipeline共用, key由调用方按各自的客户端给出"""
+    if reset:
+        pipe.delete(key, tokens_key)
+    pipe.rpush(key, entry).incrby(tokens_key, count(model, [entry])[0])
+    pipe.expire(key, meta.TIMEOUT_CHAT_CONTEXT).expire(tokens_key, meta.TIMEOUT_CHAT_CONTEXT)
+    if read:
+        pipe.lrange(key, 0, -1)
+
+
+def _push_result(result, entry):
+    """(累计token数, 全部上下文), 命令失败(None或异常)时退回0与只含本条消息的上下文"""
+    total, entries = (None if isinstance(value, Exception) else value for value in (result[-4], result[-1]))
+    return total or 0, entries or [entry]
+
+
+def push_user(chat_id, content, model=meta.MODEL_CHAT, reset=False):
+    """写入用户消息, 一次往返返回 (累计token数, 全部上下文)"""
+    entry = 'user::{}'.format(content)
+    # 消息与token数在同一事务中写入, 压缩时看到的两者总是一致
+    batch = redis_util.batch(transaction=True)
+    _queue_push(batch, *_keys(chat_id), entry, model, reset=reset, read=True)
+    return _push_result(batch.execute(), entry)
+
+
+def push_reply(chat_id, reply, model=meta.MODEL_CHAT):
+    batch = redis_util.batch(transaction=True)
+    _queue_push(batch, *_keys(chat_id), 'assistant::{}'.format(reply), model)
+    batch.execute()
+
+
+def _summary_entry(summary):
+    return SUMMARY_PREFIX + summary.strip() if summary else None
+
+
+def trimmed(prompt_list, current, drop, summary, model=meta.MODEL_CHAT):
+    """
+    按trim时的实际列表计算压缩结果: 删除最早的drop条, 期间新写入的消息保留, token数按保留内容重算
+    returns: (保留的上下文, token数), 最早的条目已被其它请求改写时返回None
+    """
+    if len(current) < drop or current[:drop] != prompt_list[:drop]:
+        return None
+    kept = ([summary] if summary else []) + current[drop:]
+    return kept, sum(count(model, kept))
+
+
+def _log_trim(chat_id, drop, kept, total, summary):
+    logger.info('[chat context] compact chat: {}, drop: {} turns, keep: {}, tokens: {}, summary: {}'.format(
+        chat_id, drop, len(kept), total, bool(summary)))
+
+
+def _plan(total, prompt_list, model, system_prompt):
+    """要删除的最早条数, 未超出预算时为0"""
+    limit = budget(model, system_prompt)
+    if total <= limit:
+        return 0
+    return plan_compaction(count(model, prompt_list), limit)
+
+
+def _queue_trim(pipe, key, tokens_key, drop, summary, kept_total):
+    """WATCH之后的压缩事务, 同步与异步pipeline共用"""
+    pipe.multi()
+    pipe.ltrim(key, drop, -1)
+    if summary:
+        pipe.lpush(key, summary)
+    pipe.set(tokens_key, kept_total, ex=meta.TIMEOUT_CHAT_CONTEXT)
+
+
+def _compacted_in_request(prompt_list, drop, summary):
+    # 一直有写入, 本次只在请求中压缩, 下一条消息再写回
+    return ([summary] if summary else []) + prompt_list[drop:]
+
+
+def fit(chat_id, total, prompt_list, model=meta.MODEL_CHAT, system_prompt=''):
+    """累计token数超出预算时删除最早的轮次, 返回压缩后的上下文"""
+    drop = _plan(total, prompt_list, model, system_prompt)
+    if not drop:
+        return prompt_list
+    summary = None
+    if meta.CONTEXT_SUMMARY:
+        ok, summary = chat_client.ask(summary_prompt(prompt_list[:drop]), model=meta.MODEL_SUMMARY, temperature=0)
+        summary = summary if ok else None
+    summary = _summary_entry(summary)
+    # 摘要请求耗时, 期间列表可能被写入或被其它请求压缩: WATCH后按当时的列表删除与重算
+    key, tokens_key = _redis_keys(chat_id)
+    for _ in range(TRIM_RETRY):
+        with redis_util.r.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key, tokens_key)
+                current = pipe.lrange(key, 0, -1)
+                result = trimmed(prompt_list, current, drop, summary, model)
+                if result is None:
+                    logger.info('[chat context] chat: {} compacted by another request, skip'.format(chat_id))
+                    return current
+                kept, kept_total = result
+                _queue_trim(pipe, key, tokens_key, drop, summary, kept_total)
+                pipe.execute()
+                _log_trim(chat_id, drop, kept, kept_total, summary)
+                return kept
+            except WatchError:
+                continue
+    return _compacted_in_request(prompt_list, drop, summary)
+
+
+async def _execute_async(pipe, chat_id):
+    """与redis_util.Batch一致: 失败的命令给出异常对象而不是中断整个事务, 连接失败时全部为None"""
+    # execute结束时会清空命令队列, 先记下条数
+    size = len(pipe)
+    try:
+        return await pipe.execute(raise_on_error=False)
+    except Exception as e:
+        logger.error('[chat context] chat: {} redis pipeline error: {}'.format(chat_id, e))
+        return [None] * size
+
+
+async def push_user_async(chat_id, content, model=meta.MODEL_CHAT, reset=False):
+    """push_user() 的协程版本"""
+    entry = 'user::{}'.format(content)
+    pipe = redis_util.async_client().pipeline(transaction=True)
+    _queue_push(pipe, *_redis_keys(chat_id), entry, model, reset=reset, read=True)
+    return _push_result(await _execute_async(pipe, chat_id), entry)
+
+
+async def push_reply_async(chat_id, reply, model=meta.MODEL_CHAT):
+    pipe = redis_util.async_client().pipeline(transaction=True)
+    _queue_push(pipe, *_redis_keys(chat_id), 'assistant::{}'.format(reply), model)
+    await _execute_async(pipe, chat_id)
+
+
+async def fit_async(chat_id, total, prompt_list, model=meta.MODEL_CHAT, system_prompt=''):
+    """fit() 的协程版本"""
+    drop = _plan(total, prompt_list, model, system_prompt)
+    if not drop:
+        return prompt_list
+    summary = None
+    if meta.CONTEXT_SUMMARY:
+        ok, summary = await chat_client.ask_async(summary_prompt(prompt_list[:drop]), model=meta.MODEL_SUMMARY, temperature=0)
+        summary = summary if ok else None
+    summary = _summary_entry(summary)
+    key, tokens_key = _redis_keys(chat_id)
+    for _ in range(TRIM_RETRY):
+        async with redis_util.async_client().pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key, tokens_key)
+                current = await pipe.lrange(key, 0, -1)
+                result = trimmed(prompt_list, current, drop, summary, model)
+                if result is None:
+                    logger.info('[chat context] chat: {} compacted by another request, skip'.format(chat_id))
+                    return current
+                kept, kept_total = result
+                _queue_trim(pipe, key, tokens_key, drop, summary, kept_total)
+                await pipe.execute()
+                _log_trim(chat_id, drop, kept, kept_total, summary)
+                return kept
+            except WatchError:
+                continue
+    return _compacted_in_request(prompt_list, drop, summary)
@@ -12,7 +12,7 @@ django.setup()
 from home.config import constant
 from home.gpt import cache, meta, cache_key
 from home.models import AigcPrompt, ChatTone
-from util import redis_util
+from util import redis_util, local_cache
 from util.log_util import logger
 
 CHAT_PREFIX = 'devmode:'
@@ -42,6 +42,7 @@ def reply_in_dev(user_id: str, chat_id: str, text: str):
     elif text == 'clear context':
         logger.info('[chat dev mode] clear context with chat_id: {}'.format(chat_id))
         redis_util.del_(cache_key.get_context_key(chat_id))
+        redis_util.del_(cache_key.get_context_tokens_key(chat_id))
         reply = 'Complete. You can start the conversation now.'
     elif text == 'list tones':
         reply, _ = list_tones(user_id, chat_id)
@@ -116,6 +117,7 @@ def list_tones(user_id, chat_id):
     # 5. empty using, may not auth to old tone or just old tone deleted, reset to default then.
     if not hit_using and using_prompt_id != DEFAULT_PROMPT_ID:
         redis_util.del_(cache_key.get_tone_key(chat_id))
+        local_cache.invalidate(cache_key.get_tone_key(chat_id))
         chat_tone.prompt_id = DEFAULT_PROMPT_ID
         chat_tone.save()
         reply.replace('1. default', '1. default (USING)')
@@ -235,12 +237,14 @@ def use_model(index, chat_id):
         return False, 'Index not available in "list models"'
     obj_model = available_models[index-1]
     redis_util.set_(cache_key.get_model_key(chat_id), obj_model, 2*3600)
+    local_cache.invalidate(cache_key.get_model_key(chat_id))
     return True, 'Success, {} will apply for 2 hours, then reset to default model'.format(obj_model)
 
 
 def get_model(user_id, chat_id):
     model = meta.MODEL_CHAT
-    appoint_model = redis_util.get(cache_key.get_model_key(chat_id))
+    appoint_model = local_cache.get_or_load(cache_key.get_model_key(chat_id),
+                                            lambda: redis_util.get(cache_key.get_model_key(chat_id)))
     if appoint_model:
         model = appoint_model
     return model
@@ -1,7 +1,9 @@
 
 
 WORK_SYMBOL = 'chatgpt-reviews-analyze'
-JSON_KEY_EXCEL_DATA = 'excel_data'
+JSON_KEY_EXCEL_DATA = 'excel_data'  # legacy, reviews are stored in observer_archive_review
+JSON_KEY_REVIEWS_DIGEST = 'reviews_digest'
+JSON_KEY_EXCEL_COUNT = 'excel_count'
 JSON_KEY_EXCEL_NAME = 'excel_name'
 JSON_KEY_EXCEL_COLUMNS = 'excel_columns'
 JSON_KEY_REVIEW_FORMAT = 'review_format'
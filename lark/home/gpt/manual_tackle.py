@@ -6,12 +6,12 @@ import requests
 os.environ['DJANGO_SETTINGS_MODULE'] = 'lark.settings'
 django.setup()
 
-from home.gpt.dto import WORK_SYMBOL, JSON_KEY_EXCEL_DATA, JSON_KEY_EXCEL_NAME
+from home.gpt.dto import WORK_SYMBOL, JSON_KEY_EXCEL_NAME
 from home.models import LarkUserWorkbench
 from util import http_util
 
 from home.config import constant
-from home.gpt import review, script, dto
+from home.gpt import review, script, dto, review_store
 from home.gpt.review_reader import warehouse, self_tag, meta
 from home.idea_bot import client as bot_client
 
@@ -36,7 +36,7 @@ def manual_trim(reply):
         bot_client.send_text_with_title('user_id', constant.LARK_USER_ID_LUKE, 'no record of {}'.format(WORK_SYMBOL), constant.LARK_USER_ID_LUKE)
         return
 
-    excel_data = record.detail.get(JSON_KEY_EXCEL_DATA, [])
+    excel_data = review_store.get_excel_data(record.detail)
     excel_name = record.detail.get(JSON_KEY_EXCEL_NAME, '')
     map_reviews = dto.get_db_map_reviews(excel_data)
     point_list, out_ids = self_tag.check_report(point_list, map_reviews, meta.CHECK_TOP_COUNT, auto_trim=True)
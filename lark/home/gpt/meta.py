@@ -23,6 +23,16 @@ MODEL_CHAT_4_O = 'gpt-4'  # Changed to standard GPT-4
 # Default models for different purposes
 MODEL_CHAT = MODEL_CHAT_4  # Changed to standard GPT-4
 MODEL_REVIEW = MODEL_CHAT_4_TURBO
+MODEL_EMBEDDING = 'text-embedding-3-small'
+MODEL_SUMMARY = MODEL_CHAT_3_5
+MODEL_SPEECH = 'whisper-1'
+
+# 模型上下文窗口(tokens), 未列出的模型按MODEL_CHAT计
+CONTEXT_WINDOW = {
+    MODEL_CHAT_3_5: 16385,
+    MODEL_CHAT_4: 8192,
+    MODEL_CHAT_4_TURBO: 128000,
+}
 
 # Lark chat configurations
 LARK_CHAT_GPT_4_ADS = 'oc_eaf81600be37424fdf033ba9a7e33a4c'
@@ -30,4 +40,6 @@ LARK_CHAT_GPT_4_VIP = 'oc_aee6fb383282ad5b554e237c6439d93b'
 
 CHAT_BOT_NAME = 'lark_bot'
 TIMEOUT_CHAT_CONTEXT = 60 * 60  # 1 hour in seconds
+MAX_CONTEXT_TOKENS = 6000  # 单次对话上下文上限, 超出后压缩最早的轮次
+CONTEXT_SUMMARY = True  # 压缩时用摘要替换被删除的轮次
 
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from lark.settings import GPT_RESPONSE_CACHE_PATH, GPT_RESPONSE_CACHE_MAX_MB
+from util.log_util import logger
+
+EVICT_EVERY = 100  # puts between size checks
+EVICT_BATCH = 500
+
+DDL = """
+CREATE TABLE IF NOT EXISTS response (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_accessed ON response (accessed_at);
+"""
+
+
+class ResponseCache:
+    """
+    Size-bounded on-disk LRU of chat completions in SQLite, shared by the worker processes of one host.
+    Keys are hashes of (model, system prompt, messages, temperature); the least recently read replies
+    are evicted once the stored replies exceed max_bytes.
+    """
+
+    def __init__(self, path: str = GPT_RESPONSE_CACHE_PATH, max_bytes: int = GPT_RESPONSE_CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts = 0
+        self.stats = {'hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0, 'errors': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(DDL)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(model, system_prompt, messages, temperature) -> str:
+        raw = json.dumps([model, system_prompt, messages, temperature], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('SELECT reply FROM response WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.stats['misses'] += 1
+                    return None
+                conn.execute('UPDATE response SET accessed_at = ? WHERE key = ?', (time.time(), key))
+                self.stats['hits'] += 1
+                return row[0]
+        except Exception:
+            self.stats['errors'] += 1
+            logger.error('[response cache] get error: {}'.format(traceback.format_exc()))
+            return None
+
+    def put(self, key: str, model: str, reply: str):
+        try:
+            now = time.time()
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO response (key, model, reply, size, created_at, accessed_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (key, model, reply, len(reply.encode('utf-8')), now, now))
+                self.stats['puts'] += 1
+                self._puts += 1
+                if self._puts % EVICT_EVERY == 0:
+                    self._evict(conn)
+        except Exception:
+            self.stats['errors'] += 1
+            logger.error('[response cache] put error: {}'.format(traceback.format_exc()))
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute('SELECT key, size FROM response ORDER BY accessed_at LIMIT ?', (EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            conn.executemany('DELETE FROM response WHERE key = ?', [(row[0],) for row in rows])
+            total -= sum(row[1] for row in rows)
+            self.stats['evictions'] += len(rows)
+
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return round(self.stats['hits'] / lookups, 4) if lookups else 0.0
+
+
+cache = ResponseCache()
+
+
+def log_stats():
+    """Scheduler entry: log the hit rate of this process since start"""
+    logger.info('[response cache] hit rate: {}, {}'.format(cache.hit_rate(), cache.stats))
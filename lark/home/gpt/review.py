@@ -4,20 +4,19 @@ Replace placeholder values with actual credentials for production use.
 """
 
 import copy
-import random
-import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import openpyxl
 import tiktoken
 
 from home import redis_key
 from home.config import constant
-from home.gpt import chat_client, meta, script, dto, algo_client
+from home.gpt import chat_client, meta, script, dto, algo_client, review_store
 from home.gpt.review_reader import self_tag
 from home.gpt.review_reader.enums import ArchiveType, ExtractType
 from home.models import LarkUserWorkbench, ObserverArchive
-from util import redis_util
+from util import redis_util, token_count
+from util.rate_limit import get_limiter
 from util.lark_util import Lark
 from util.log_util import logger
 from home.idea_bot import client as bot_client
@@ -74,6 +73,13 @@ DEFAULT_WORDS_BATCH = 3000
 MAX_REVIEWS_BATCH = 100
 MAX_WORDS_BATCH = 3000
 MAX_TOKENS_IN_MERGE = 1500
+# 并发提取, 共享模型限流
+MAX_CONCURRENT_SEGMENTS = 4
+REPLY_TOKENS_ESTIMATE = 1000
+# 树形合并, 每组不超过MAX_TOKENS_IN_MERGE
+MAX_REPLIES_IN_MERGE = 20
+MAX_MERGE_LEVELS = 10
+MAX_FILTER_QUOTE = 5
 
 USE_MODEL = meta.MODEL_REVIEW
 encoding = tiktoken.encoding_for_model(USE_MODEL)
@@ -119,43 +125,32 @@ def tackle_excel(user_id, file_obj, columns_str, max_row=3000, archive_type=Arch
     columns = []
     for co in str(columns_str).strip().split(constant.COMMA):
         columns.append(co.strip())
-    wb = openpyxl.load_workbook(file_obj)
-    ws = wb.active
-    count = 0
-    for i in range(2, ws.max_row+1):
-        data = {}
-        for col in columns:
-            index = int(col.strip('#'))
-            each = ws.cell(i, index).value
-            if each is None:
-                continue
-            data[col] = str(each)
-        count += 1
-        if count > max_row:
-            break
-        reviews.append(data)
+    reviews = review_store.read_excel(file_obj, columns, max_row=max_row)
 
-    # 2. write in workflow db
-    record = LarkUserWorkbench.objects.filter(lark_user_id=user_id, work_symbol=dto.WORK_SYMBOL).first()
-    if not record:
-        record = LarkUserWorkbench(lark_user_id=user_id, work_symbol=dto.WORK_SYMBOL, detail={})
-    record.detail[dto.JSON_KEY_EXCEL_NAME] = file_name
-    record.detail[dto.JSON_KEY_EXCEL_DATA] = reviews
-    record.detail[dto.JSON_KEY_EXCEL_COLUMNS] = columns_str
-    record.save()
+    # 2. reviews are stored once per content in observer_archive_review, never rewritten
+    digest = review_store.save_reviews(reviews)
 
-    # 3. write in archive db
+    # 3. write in archive db, an existing archive keeps the reviews of its first upload
     if archive_type == ArchiveType.UNKNOWN:
         archive_type = get_archive_type_by_file_name(file_name)
-    key_id = '#{}'.format(review_meta.INDEX_ID)
-    key_content = '#{}'.format(review_meta.INDEX_CONTENT)
-    origin_info = {'reviews': list(map(lambda x: {'id': x[key_id], 'content': x[key_content]}, reviews))}
     archive = ObserverArchive.objects.filter(archive_type=archive_type.value, archive_name=file_name, record_count=len(reviews)).first()
     if not archive:
+        origin_info = {'columns': columns_str, review_store.ORIGIN_KEY_DIGEST: digest}
         archive = ObserverArchive(archive_type=archive_type.value, archive_name=file_name, record_count=len(reviews),
                                   origin_url='', origin_info=origin_info, process_info={})
         archive.save()
 
+    # 4. write in workflow db, reference to this upload's reviews only
+    record = LarkUserWorkbench.objects.filter(lark_user_id=user_id, work_symbol=dto.WORK_SYMBOL).first()
+    if not record:
+        record = LarkUserWorkbench(lark_user_id=user_id, work_symbol=dto.WORK_SYMBOL, detail={})
+    record.detail.pop(dto.JSON_KEY_EXCEL_DATA, None)
+    record.detail[dto.JSON_KEY_EXCEL_NAME] = file_name
+    record.detail[dto.JSON_KEY_REVIEWS_DIGEST] = digest
+    record.detail[dto.JSON_KEY_EXCEL_COUNT] = len(reviews)
+    record.detail[dto.JSON_KEY_EXCEL_COLUMNS] = columns_str
+    record.save()
+
     return True, reviews
 
 
@@ -207,19 +202,25 @@ def run_review(req: RequestRunReview):
         record = LarkUserWorkbench.objects.filter(lark_user_id=req.user_id, work_symbol=dto.WORK_SYMBOL).first()
         if not record:
             return None
-        excel_data = record.detail.get(dto.JSON_KEY_EXCEL_DATA, [])
+        excel_data = review_store.get_excel_data(record.detail)
         map_reviews = dto.get_db_map_reviews(excel_data)
         excel_name = record.detail.get(dto.JSON_KEY_EXCEL_NAME, '')
         req.archive_name = excel_name
         req.archive_data = excel_data
         sys_words_count = len(req.ask_prompt.split(' ')) + len(req.system_prompt.split(' '))
-        review_index, words_count, separate_index_list = 0, sys_words_count, [0]
+        texts = []
         for each in excel_data:
-            review_index += 1
             each_text = req.review_format
             for k, v in each.items():
                 each_text = each_text.replace(k, str(v).strip())
-            words_count += len(encoding.encode(each_text))
+            texts.append(each_text)
+        # token数按内容缓存, 同一存档再次运行不用重新编码
+        digest = record.detail.get(dto.JSON_KEY_REVIEWS_DIGEST, None)
+        counts = token_count.count_many(encoding, texts, store_key=redis_key.gpt_token_counts(digest) if digest else None)
+        review_index, words_count, separate_index_list, review_tokens = 0, sys_words_count, [0], []
+        for each_text, each_tokens in zip(texts, counts):
+            review_index += 1
+            words_count += each_tokens
             if words_count > req.words_batch or (review_index - separate_index_list[-1]) > MAX_REVIEWS_BATCH:
                 if review_index-1 == separate_index_list[-1]:
                     # 单个评论已经超过了，报错
@@ -230,6 +231,7 @@ def run_review(req: RequestRunReview):
                 separate_index_list.append(review_index-1)
                 words_count = sys_words_count
             reviews.append(each_text)
+            review_tokens.append(each_tokens)
         # 2. save params config
         record.detail[dto.JSON_KEY_REVIEW_FORMAT] = req.review_format
         record.detail[dto.JSON_KEY_ASK_PROMPT] = req.ask_prompt
@@ -242,6 +244,7 @@ def run_review(req: RequestRunReview):
 
         # 3. wrap full ask text
         user_prompt_list = []
+        ask_tokens = token_count.count(encoding, req.ask_prompt)
         for i in range(len(separate_index_list)):
             index_from = separate_index_list[i]
             if i == len(separate_index_list) - 1:
@@ -249,46 +252,15 @@ def run_review(req: RequestRunReview):
             else:
                 index_to = separate_index_list[i+1]
             user_prompt = '{}\n\n{}'.format(req.ask_prompt, '\n\n'.join(reviews[index_from:index_to]))
-            body = {'index_from': index_from, 'index_to': index_to, 'content': user_prompt}
+            body = {'index_from': index_from, 'index_to': index_to, 'content': user_prompt,
+                    'tokens': ask_tokens + sum(review_tokens[index_from:index_to])}
             user_prompt_list.append(body)
         if req.max_segments and len(user_prompt_list) > req.max_segments:
             replies.append('too many reviews to tackle in page, pls click use-lark-notify mode')
             return replies
 
-        # 4. ask chatGPT
-        for i in range(len(user_prompt_list)):
-            body = user_prompt_list[i]
-            prompt_list = ['user::{}'.format(body['content'].strip())]
-            time.sleep(0.7 + random.randint(1, 5))
-            retry, retry_max, hit, reply = 0, 3, False, ''
-            while retry < retry_max:
-                retry += 1
-                hit, reply = chat_client.ask(prompt_list, system_prompt=req.system_prompt, model=USE_MODEL,
-                                             temperature=req.temperature, auto_retry=True)
-                if hit and script.check_reply_ok(reply):
-                    break
-            if not hit:
-                ok = False
-                Lark(constant.LARK_CHAT_ID_P0).send_rich_text('ChatGPT reviews stop: {}'.format(excel_name),
-                                                              'batch failed: {}'.format(reply))
-                bot_client.send_text_with_title('user_id', req.user_id, 'ChatGPT reviews stop: {}'.format(excel_name),
-                                                'batch failed: {}'.format(reply))
-                break
-            if not script.check_reply_ok(reply):
-                Lark(constant.LARK_CHAT_ID_P0).send_rich_text('ChatGPT reviews extract stop: {}'.format(excel_name),
-                                                              'batch failed for error point format: {}'.format(reply))
-                bot_client.send_text_with_title('user_id', req.user_id, 'ChatGPT reviews extract stop: {}'.format(excel_name),
-                                                'batch failed for error point format: {}'.format(reply))
-                break
-
-            replies.append(reply)
-            if req.use_lark:
-                # lark notify
-                title = 'Reviews Part {} ({}: {}-{}), extract: {}'.format(i+1, excel_name, body['index_from']+1, body['index_to'], req.extract_type.name())
-                msg = reply
-                # if req.auto_merge:
-                #     msg = 'Done'
-                bot_client.send_text_with_title('user_id', req.user_id, title, msg)
+        # 4. ask chatGPT, segments run concurrently under the model's rate limit, results are kept in order
+        replies, ok = ask_segments(user_prompt_list, req, excel_name)
 
         # write process info
         write_process_info(req, replies=replies)
@@ -324,6 +296,79 @@ def run_review(req: RequestRunReview):
     return replies
 
 
+def ask_segments(user_prompt_list, req: RequestRunReview, excel_name):
+    """并发提问各分段, 返回第一个失败分段之前的回答(按顺序)和是否没有请求失败"""
+    results, failed_index, alerted, ok, next_notify = {}, len(user_prompt_list), False, True, 0
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SEGMENTS) as pool:
+        futures = {pool.submit(ask_segment, body, req): i for i, body in enumerate(user_prompt_list)}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            i = futures[future]
+            try:
+                hit, reply = future.result()
+            except Exception as e:
+                # 分段异常按请求失败处理
+                logger.error('[chatGPT review run] segment {} exception: {}'.format(i, traceback.format_exc()))
+                hit, reply = False, 'exception: {}'.format(e)
+            if not hit or not script.check_reply_ok(reply):
+                if i < failed_index:
+                    failed_index = i
+                # 失败后不再发起新的分段
+                for f in futures:
+                    f.cancel()
+                if not hit:
+                    ok = False
+                # 并发中的分段可能相继失败, 每次运行只通知一次
+                if alerted:
+                    continue
+                alerted = True
+                if not hit:
+                    Lark(constant.LARK_CHAT_ID_P0).send_rich_text('ChatGPT reviews stop: {}'.format(excel_name),
+                                                                  'batch failed: {}'.format(reply))
+                    bot_client.send_text_with_title('user_id', req.user_id, 'ChatGPT reviews stop: {}'.format(excel_name),
+                                                    'batch failed: {}'.format(reply))
+                else:
+                    Lark(constant.LARK_CHAT_ID_P0).send_rich_text('ChatGPT reviews extract stop: {}'.format(excel_name),
+                                                                  'batch failed for error point format: {}'.format(reply))
+                    bot_client.send_text_with_title('user_id', req.user_id, 'ChatGPT reviews extract stop: {}'.format(excel_name),
+                                                    'batch failed for error point format: {}'.format(reply))
+                continue
+
+            results[i] = reply
+            # lark notify, 按分段顺序推送, 只推送第一个缺口或失败分段之前的结果, 推送过的分段一定会被采用
+            while req.use_lark and next_notify < failed_index and next_notify in results:
+                body = user_prompt_list[next_notify]
+                title = 'Reviews Part {} ({}: {}-{}), extract: {}'.format(next_notify+1, excel_name, body['index_from']+1, body['index_to'], req.extract_type.name())
+                bot_client.send_text_with_title('user_id', req.user_id, title, results[next_notify])
+                next_notify += 1
+    # 按顺序组装, 保留第一个失败分段之前的结果
+    replies = []
+    for i in range(failed_index):
+        if i not in results:
+            break
+        replies.append(results[i])
+    return replies, ok
+
+
+def ask_segment(body, req: RequestRunReview):
+    prompt_list = ['user::{}'.format(body['content'].strip())]
+    tokens = body['tokens'] + REPLY_TOKENS_ESTIMATE
+    limiter = get_limiter(USE_MODEL, review_meta.REVIEW_RPM, review_meta.REVIEW_TPM)
+    retry, retry_max, hit, reply = 0, 3, False, ''
+    while retry < retry_max:
+        retry += 1
+        waited = limiter.acquire(tokens)
+        if waited:
+            logger.info('[chatGPT review run] rate limited {:.1f}s, user: {}, segment: {}-{}'.format(
+                waited, req.user_id, body['index_from'], body['index_to']))
+        hit, reply = chat_client.ask(prompt_list, system_prompt=req.system_prompt, model=USE_MODEL,
+                                     temperature=req.temperature, auto_retry=True, refresh_cache=retry > 1)
+        if hit and script.check_reply_ok(reply):
+            break
+    return hit, reply
+
+
 def merge_replies_by_algo(req: RequestMergeReview):
     if not req.use_lark or not req.replies:
         return False
@@ -331,14 +376,14 @@ def merge_replies_by_algo(req: RequestMergeReview):
     if len(req.replies) == 1:
         algo_point_list = script.parse_analyze(req.replies[0])
     else:
-        # 使用算法embedding api进行合并结果
+        # 本地embedding聚类合并结果
         algo_point_list = algo_client.merge_points(req.replies)
     return send_lark_result(req.user_id, title, algo_point_list)
 
 
 def merge_replies_by_chatgpt(req: RequestMergeReview):
     reply, ok = None, False
-    reply, cursor, loop_max, loop, filter_quote = '', 0, 100, 0, 0
+    reply, cursor, filter_quote = '', 0, 0
     try:
         if not req.replies or not req.merge_prompt:
             return None
@@ -367,18 +412,13 @@ def merge_replies_by_chatgpt(req: RequestMergeReview):
                                                 'Reviews Report: {}'.format(excel_name), one_reply)
             replies.append({'index_from': 1, 'index_to': 1, 'reply': one_reply})
         else:
-            while cursor < len(req.replies) and loop < loop_max:
-                loop += 1
-                time.sleep(0.7 + random.randint(1, 5))
-                ok, reply, cursor, filter_quote = each_merge(reply, cursor, req, filter_quote, loop=loop)
-                if ok is False:
-                    break
-                else:
-                    # 累积
-                    replies.append({'index_from': 1, 'index_to': cursor, 'reply': reply})
-                    if req.use_lark:
-                        title = 'Reviews Report: {} (1-{}), extract: {}, filter_quote: {}'.format(excel_name, cursor, extract_type, filter_quote)
-                        bot_client.send_text_with_title('user_id', req.user_id, title, reply)
+            ok, reply, filter_quote = tree_merge(req)
+            if ok:
+                cursor = len(req.replies)
+                replies.append({'index_from': 1, 'index_to': cursor, 'reply': reply})
+                if req.use_lark:
+                    title = 'Reviews Report: {} (1-{}), extract: {}, filter_quote: {}'.format(excel_name, cursor, extract_type, filter_quote)
+                    bot_client.send_text_with_title('user_id', req.user_id, title, reply)
         # 最后一次结果要trim检查，只取前20条
         trim_reply = ''
         if req.use_lark and replies:
@@ -408,6 +448,71 @@ def merge_replies_by_chatgpt(req: RequestMergeReview):
     return reply
 
 
+def build_merge_groups(replies, filter_quote=0):
+    # 按token预算将同一层的结果顺序分组, 每组一次合并
+    groups, group, words = [], [], 0
+    texts = [script.transform_analyze(each, 0, filter_quote=filter_quote)[0] for each in replies]
+    for i, tokens in enumerate(token_count.count_many(encoding, texts)):
+        if group and (words + tokens > MAX_TOKENS_IN_MERGE or len(group) >= MAX_REPLIES_IN_MERGE):
+            groups.append(group)
+            group, words = [], 0
+        group.append(i)
+        words += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+def merge_group(replies, req, filter_quote=0):
+    batch_content, map_reviews, item_index = [], {}, 0
+    for each in replies:
+        text, map_reviews_each = script.transform_analyze(each, item_index, filter_quote=filter_quote)
+        item_index += len(map_reviews_each)
+        map_reviews.update(map_reviews_each)
+        batch_content.append(text)
+    return ask_merge(batch_content, map_reviews, req)
+
+
+def tree_merge(req: RequestMergeReview):
+    """
+    树形合并: 同一层按token预算分组, 各组并发合并, 结果作为上一层的输入, 直到只剩一条
+    returns: ok, reply, filter_quote
+    """
+    level_replies, level, filter_quote = list(req.replies), 0, 0
+    while len(level_replies) > 1:
+        level += 1
+        groups = build_merge_groups(level_replies, filter_quote)
+        if len(groups) == len(level_replies) or level > MAX_MERGE_LEVELS:
+            # 两两合并都超出预算, 清理提及次数少的
+            if filter_quote >= MAX_FILTER_QUOTE or level > MAX_MERGE_LEVELS:
+                logger.error('[chatGPT merge review] failed, {}'.format('single merge reply exceed'))
+                Lark(constant.LARK_CHAT_ID_P0).send_rich_text('[chatGPT merge review] failed {}'.format(req.user_id),
+                                                              'single merge reply exceed')
+                return None, None, filter_quote
+            filter_quote += 1
+            continue
+        logger.info('[chatGPT merge review] user: {}, level: {}, {} replies -> {} groups, filter_quote: {}'.format(
+            req.user_id, level, len(level_replies), len(groups), filter_quote))
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SEGMENTS) as pool:
+            futures = [pool.submit(merge_group, [level_replies[i] for i in group], req, filter_quote)
+                       if len(group) > 1 else None for group in groups]
+            next_replies = []
+            for group, future in zip(groups, futures):
+                if future is None:
+                    # 单独一组不用merge, 直接进入上一层
+                    next_replies.append(level_replies[group[0]])
+                    continue
+                ok, reply = future.result()
+                if ok is False:
+                    for f in futures:
+                        if f:
+                            f.cancel()
+                    return False, None, filter_quote
+                next_replies.append(reply)
+        level_replies = next_replies
+    return True, level_replies[0], filter_quote
+
+
 def each_merge(reply, cursor, req, filter_quote, model=meta.MODEL_CHAT_3_5, loop=None):
     # parse points and hide massive id list
     item_index, map_reviews, words, batch_content = 0, {}, 0, []
@@ -420,14 +525,14 @@ def each_merge(reply, cursor, req, filter_quote, model=meta.MODEL_CHAT_3_5, loop
         text, map_reviews_each = script.transform_analyze(reply, item_index, filter_quote=filter_quote)
         item_index += len(map_reviews_each)
         map_reviews.update(map_reviews_each)
-        words += len(encoding.encode(text))
+        words += token_count.count(encoding, text)
         batch_content.append(text)
     for i in range(cursor, len(req.replies)):
         each = req.replies[i]
         text, map_reviews_each = script.transform_analyze(each, item_index)
         item_index += len(map_reviews_each)
         map_reviews.update(map_reviews_each)
-        words += len(encoding.encode(text))
+        words += token_count.count(encoding, text)
         if words <= MAX_TOKENS_IN_MERGE and len(batch_content) <= 20:
             batch_content.append(text)
             cursor += 1
@@ -442,14 +547,21 @@ def each_merge(reply, cursor, req, filter_quote, model=meta.MODEL_CHAT_3_5, loop
                                                       'single merge reply exceed')
         return None, reply, cursor, filter_quote
 
+    ok, reply = ask_merge(batch_content, map_reviews, req, model=model, cursor=cursor)
+    return ok, reply, (cursor if ok else None), filter_quote
+
+
+def ask_merge(batch_content, map_reviews, req, model=meta.MODEL_CHAT_3_5, cursor=None):
     user_prompt = '{}\n\n{}'.format(req.merge_prompt, '\n'.join(batch_content))
     prompt_list = ['user::{}'.format(user_prompt.strip())]
     retry_max = 3
     hit, retry = False, 0
+    tokens = token_count.count(encoding, req.merge_prompt) + sum(token_count.count_many(encoding, batch_content)) + REPLY_TOKENS_ESTIMATE
     while retry < retry_max:
         retry += 1
+        get_limiter(model, review_meta.REVIEW_RPM, review_meta.REVIEW_TPM).acquire(tokens)
         hit, reply = chat_client.ask(prompt_list, system_prompt=req.system_prompt, model=model,
-                                     temperature=req.temperature, auto_retry=True)
+                                     temperature=req.temperature, auto_retry=True, refresh_cache=retry > 1)
         if not script.transform_result(reply, map_reviews) and len(prompt_list) == 1:
             prompt_list.append('assistant::{}'.format(reply))
             prompt_list.append('user::{}'.format('try again, notice the format requirement.'))
@@ -466,12 +578,12 @@ def each_merge(reply, cursor, req, filter_quote, model=meta.MODEL_CHAT_3_5, loop
             logger.error('[chatGPT merge review] reply empty, {} at {}'.format(req.user_id, cursor))
             Lark(constant.LARK_CHAT_ID_P0).send_rich_text('[chatGPT merge review] reply empty {}'.format(req.user_id),
                                                           'cursor: {}'.format(cursor))
-        return True, reply, cursor, filter_quote
+        return True, reply
     else:
         logger.error('[chatGPT merge review] failed, {}'.format(reply))
         Lark(constant.LARK_CHAT_ID_P0).send_rich_text('[chatGPT merge review] failed {}'.format(req.user_id),
                                                       reply)
-        return False, None, None, filter_quote
+        return False, None
 
 
 def send_lark_result(user_id, title, point_list):
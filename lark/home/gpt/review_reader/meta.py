@@ -3,3 +3,7 @@ INDEX_ID = 1
 INDEX_CONTENT = 2
 
 CHECK_TOP_COUNT = 20
+
+# 评论提取/合并/校验共用同一模型限流
+REVIEW_RPM = 60
+REVIEW_TPM = 80000
@@ -10,6 +10,7 @@ from util import time_util
 os.environ['DJANGO_SETTINGS_MODULE'] = 'lark.settings'
 django.setup()
 
+from home.gpt import review_store
 from home.models import ObserverArchive
 
 
@@ -21,7 +22,7 @@ def export_review_dimensions():
         wb.create_sheet(archive_name)
         ws = wb[archive_name]
         ws.append(['id', 'content', 'pros', 'cons', 'scenario'])
-        reviews = archive.origin_info.get('reviews', [])
+        reviews = review_store.get_archive_reviews(archive)
         process_info = archive.process_info
         map_pros = tackle_process_info(process_info, ExtractType.PROS)
         map_cons = tackle_process_info(process_info, ExtractType.CONS)
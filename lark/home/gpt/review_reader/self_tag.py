@@ -3,20 +3,27 @@ NOTE: This file has been sanitized for portfolio display.
 Replace placeholder values with actual credentials for production use.
 """
 
+import hashlib
 import json
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import tiktoken
 
+from home import redis_key
 from home.config import constant
 from home.gpt import script, chat_client, meta
 from home.gpt.review_reader import warehouse
+from home.gpt.review_reader import meta as review_meta
 from lark.settings import BASE_DIR
+from util import redis_util, token_count
 from util.lark_util import Lark
+from util.rate_limit import get_limiter
 from util.log_util import logger
 
 # use GPT-4
 MAX_TOKENS_CHECK = 1500
+MAX_CONCURRENT_CHECKS = 4
+VERDICT_CACHE_TTL = 7 * 86400
 PROMPT_CHECK = """
 Below is the list of women's clothing customer reviews(format: id / content).
 Your task is to identify the reviews that do not mention the point "{}".
@@ -28,59 +35,96 @@ USE_MODEL = meta.MODEL_REVIEW
 encoding = tiktoken.encoding_for_model(USE_MODEL)
 
 
-def check_report(points, map_reviews, check_top=20, auto_trim=False):
-    rank, in_ids, notice_ids, out_ids = 0, set(), set(), set()
-    for i in range(len(points)):
-        logger.info('[chatgpt reviews check] {} / {}'.format(i+1, min(check_top, len(points))))
-        false_ids = []
-        each = points[i]
-        rank += 1
-        if rank > check_top:
-            break
-        point = each['point']
-        check_prompt = PROMPT_CHECK.format(point, point)
-        tokens, batch_content, batch_ids = len(encoding.encode(check_prompt)), [], []
+def build_check_jobs(points, map_reviews, check_top, verdicts):
+    """
+    预先生成所有(point, batch)校验任务, 每条评论的token数只计算一次, 已有结论的(point, review)不再校验
+    returns: jobs [(point index, check_prompt, batch_content, batch_ids, tokens)], in_ids
+    """
+    jobs, in_ids = [], set()
+    for i, each in enumerate(points[:check_top]):
         ids = each['ids']
         # 如果只有一条，不用检查直接通过
         if len(ids) <= 1:
-            points[i]['false_ids'] = []
             continue
         in_ids = in_ids.union(set(ids))
+        point = each['point']
+        check_prompt = PROMPT_CHECK.format(point, point)
+        prompt_tokens = token_count.count(encoding, check_prompt)
+        tokens, batch_content, batch_ids, point_jobs, cached = prompt_tokens, [], [], [], None
         for id_ in ids:
-            if review := map_reviews.get(str(id_), None):
-                each_text = """[id] {}\n[content] {}""".strip().format(id_, review.strip())
-                each_tokens = len(encoding.encode(each_text))
-                if tokens + each_tokens < MAX_TOKENS_CHECK:
-                    tokens += each_tokens
-                    batch_content.append(each_text)
-                    batch_ids.append(str(id_))
-                else:
-                    # run
-                    time.sleep(1.2)
-                    reply_ids = do_check(check_prompt, batch_content, batch_ids)
-                    if reply_ids:
-                        false_ids += reply_ids
-                    # reset
-                    tokens, batch_content, batch_ids = len(encoding.encode(check_prompt)), [], []
+            review = map_reviews.get(str(id_), None)
+            if not review:
+                continue
+            each_text = """[id] {}\n[content] {}""".strip().format(id_, review.strip())
+            if (point, str(id_)) in verdicts:
+                cached = cached or (each_text, str(id_))
+                continue
+            each_tokens = token_count.count(encoding, each_text)
+            if batch_content and tokens + each_tokens >= MAX_TOKENS_CHECK:
+                point_jobs.append([i, check_prompt, batch_content, batch_ids, tokens])
+                tokens, batch_content, batch_ids = prompt_tokens, [], []
+            tokens += each_tokens
+            batch_content.append(each_text)
+            batch_ids.append(str(id_))
+        if len(batch_content) == 1:
+            # 单条批次不会真正校验, 并入上一批或带上一条已有结论的评论一起校验
+            if point_jobs:
+                point_jobs[-1][2].extend(batch_content)
+                point_jobs[-1][3].extend(batch_ids)
+                point_jobs[-1][4] += tokens - prompt_tokens
+                batch_content = []
+            elif cached:
+                batch_content.append(cached[0])
+                batch_ids.append(cached[1])
+                tokens += token_count.count(encoding, cached[0])
         if batch_content:
-            # run
-            time.sleep(0.5)
-            reply_ids = do_check(check_prompt, batch_content, batch_ids)
-            if reply_ids:
-                false_ids += reply_ids
+            point_jobs.append([i, check_prompt, batch_content, batch_ids, tokens])
+        jobs += point_jobs
+    return jobs, in_ids
 
+
+def check_report(points, map_reviews, check_top=20, auto_trim=False):
+    notice_ids, out_ids = set(), set()
+    # 1. 读取已缓存的校验结论 (point, review id) -> 是否提及
+    verdicts = load_verdicts(points[:check_top], map_reviews)
+    jobs, in_ids = build_check_jobs(points, map_reviews, check_top, verdicts)
+    logger.info('[chatgpt reviews check] points: {}, jobs: {}, cached verdicts: {}'.format(
+        min(check_top, len(points)), len(jobs), len(verdicts)))
+
+    # 2. 并发校验
+    fresh = {}
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHECKS) as pool:
+        futures = {pool.submit(run_check, check_prompt, batch_content, batch_ids, tokens): (i, batch_ids)
+                   for i, check_prompt, batch_content, batch_ids, tokens in jobs}
+        for future in as_completed(futures):
+            i, batch_ids = futures[future]
+            reply_ids = future.result()
+            if reply_ids is None:
+                continue
+            reply_ids = set(map(lambda x: str(x), reply_ids))
+            for id_ in batch_ids:
+                verdicts[(points[i]['point'], id_)] = id_ not in reply_ids
+                # 只有一条的批次未实际校验, 不缓存
+                if len(batch_ids) > 1:
+                    fresh[(points[i]['point'], id_)] = id_ not in reply_ids
+    save_verdicts(fresh, map_reviews)
+
+    for i, each in enumerate(points[:check_top]):
+        if len(each['ids']) <= 1:
+            points[i]['false_ids'] = []
+            continue
         # 确保id都是字符串格式
-        false_ids = list(map(lambda x: str(x), false_ids))
+        false_ids = [str(id_) for id_ in each['ids'] if verdicts.get((each['point'], str(id_))) is False]
         notice_ids = notice_ids.union(set(false_ids))
         points[i]['false_ids'] = false_ids
-        print('false_ids: {}'.format(false_ids))
+        logger.info('[chatgpt reviews check] {} / {}, false_ids: {}'.format(i+1, min(check_top, len(points)), false_ids))
     # cal out_ids
     for each in notice_ids:
         if each not in in_ids:
             out_ids.add(each)
     out_ids = list(out_ids)
     out_ids.sort(key=lambda x: int(x))
-    print('out_ids: {}'.format(out_ids))
+    logger.info('[chatgpt reviews check] out_ids: {}'.format(out_ids))
 
     # auto_trim ids
     if auto_trim:
@@ -99,6 +143,40 @@ def check_report(points, map_reviews, check_top=20, auto_trim=False):
     return points, out_ids
 
 
+def _verdict_field(id_, review):
+    # 评论id在不同表格中会重复, 带上内容摘要
+    return '{}:{}'.format(id_, hashlib.md5(review.strip().encode('utf-8')).hexdigest()[:12])
+
+
+def load_verdicts(points, map_reviews):
+    verdicts = {}
+    for each in points:
+        ids = [str(id_) for id_ in each['ids'] if map_reviews.get(str(id_), None)]
+        if len(ids) <= 1:
+            continue
+        key = redis_key.gpt_review_check(hashlib.md5(each['point'].encode('utf-8')).hexdigest())
+        values = redis_util.hmget(key, [_verdict_field(id_, map_reviews[id_]) for id_ in ids])
+        for id_, value in zip(ids, values):
+            if value is not None:
+                verdicts[(each['point'], id_)] = bool(value)
+    return verdicts
+
+
+def save_verdicts(verdicts, map_reviews):
+    map_fields = {}
+    for (point, id_), mentioned in verdicts.items():
+        key = redis_key.gpt_review_check(hashlib.md5(point.encode('utf-8')).hexdigest())
+        map_fields.setdefault(key, {})[_verdict_field(id_, map_reviews[id_])] = 1 if mentioned else 0
+    for key, mapping in map_fields.items():
+        redis_util.hset_many(key, mapping)
+        redis_util.expire(key, VERDICT_CACHE_TTL)
+
+
+def run_check(check_prompt, batch_content, batch_ids, tokens):
+    get_limiter(USE_MODEL, review_meta.REVIEW_RPM, review_meta.REVIEW_TPM).acquire(tokens)
+    return do_check(check_prompt, batch_content, batch_ids)
+
+
 def do_check(check_prompt, batch_content, batch_ids):
     # 如果只有一条没必要检查
     if len(batch_content) <= 1:
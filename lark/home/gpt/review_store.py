@@ -0,0 +1,96 @@
+import hashlib
+import json
+
+import openpyxl
+from django.db import IntegrityError, transaction
+
+from home.gpt import dto
+from home.gpt.review_reader import meta as review_meta
+from home.models import ObserverArchiveReview
+
+STORE_BATCH = 1000
+ORIGIN_KEY_DIGEST = 'reviews_digest'
+
+
+def read_excel(file_obj, columns, max_row=3000):
+    """
+    流式读取表格: read_only模式, 只遍历选中列所在的范围, 不加载整个工作簿
+    returns: [{'#1': '...', '#2': '...'}, ...]
+    """
+    indexes = [int(col.strip('#')) for col in columns]
+    min_col, max_col = min(indexes), max(indexes)
+    reviews = []
+    wb = openpyxl.load_workbook(file_obj, read_only=True)
+    try:
+        ws = wb.active
+        for row in ws.iter_rows(min_row=2, max_row=max_row+1, min_col=min_col, max_col=max_col, values_only=True):
+            data = {}
+            for col, index in zip(columns, indexes):
+                offset = index - min_col
+                each = row[offset] if offset < len(row) else None
+                if each is None:
+                    continue
+                data[col] = str(each)
+            # 跳过空行
+            if data:
+                reviews.append(data)
+    finally:
+        wb.close()
+    return reviews
+
+
+def reviews_digest(reviews):
+    raw = json.dumps(reviews, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def save_reviews(reviews):
+    """
+    按内容摘要存储评论, 同样的内容只写一次, 写入后不再修改, 不同上传互不覆盖
+    returns: 摘要, 工作台与存档只保存该引用
+    """
+    digest = reviews_digest(reviews)
+    if not reviews or ObserverArchiveReview.objects.filter(digest=digest).exists():
+        return digest
+    try:
+        # 整体提交, 读取方不会看到写了一半的数据
+        with transaction.atomic():
+            ObserverArchiveReview.objects.bulk_create(
+                [ObserverArchiveReview(digest=digest, seq=i, data=each) for i, each in enumerate(reviews)],
+                batch_size=STORE_BATCH)
+    except IntegrityError:
+        # 相同内容被并发上传, 已由另一请求写入
+        pass
+    return digest
+
+
+def load_reviews(digest):
+    return list(ObserverArchiveReview.objects.filter(digest=digest).order_by('seq').values_list('data', flat=True))
+
+
+def get_excel_data(detail):
+    """工作台中只保存存档引用, 兼容旧记录中直接保存的excel_data"""
+    if not detail:
+        return []
+    if digest := detail.get(dto.JSON_KEY_REVIEWS_DIGEST, None):
+        return load_reviews(digest)
+    return detail.get(dto.JSON_KEY_EXCEL_DATA, [])
+
+
+def get_excel_count(detail):
+    if not detail:
+        return 0
+    if dto.JSON_KEY_EXCEL_COUNT in detail:
+        return detail[dto.JSON_KEY_EXCEL_COUNT]
+    return len(detail.get(dto.JSON_KEY_EXCEL_DATA, []))
+
+
+def get_archive_reviews(archive):
+    """存档的评论列表 [{'id', 'content'}], 兼容旧存档中直接保存的origin_info.reviews"""
+    origin_info = archive.origin_info or {}
+    if 'reviews' in origin_info:
+        return origin_info['reviews']
+    key_id = '#{}'.format(review_meta.INDEX_ID)
+    key_content = '#{}'.format(review_meta.INDEX_CONTENT)
+    reviews = load_reviews(origin_info[ORIGIN_KEY_DIGEST]) if ORIGIN_KEY_DIGEST in origin_info else []
+    return [{'id': each.get(key_id, ''), 'content': each.get(key_content, '')} for each in reviews]
@@ -1,5 +1,7 @@
 import re
 import os
+import threading
+import time
 
 import django
 
@@ -11,64 +13,84 @@ django.setup()
 import openpyxl
 
 from home.config import constant
-from home.gpt import dto
+from home.gpt import dto, review_store
 from home.gpt.review_reader import warehouse
 from home.models import LarkUserWorkbench
 from util.log_util import logger
 
-pt = re.compile(r'^(.*)\(([^()]*)\).*$')
 pt_colon = re.compile(r'^(.*): *([\d, ]+).*$')
-pt_num_range = re.compile(r'^(\d+) *- *(\d+)$')
 pt_filter_quote = re.compile(r'^.*filter_quote: (\d+)\D*$')
-pt_num_has = re.compile(r'^.*\d+.*$')
-pt_num_trim = re.compile(r'^\D*([\d\- ]+)\D*$')
+pt_id_token = re.compile(r'^\D*(\d+)(?: *- *(\d+))?\D*$')
+
+# 无法解析的行聚合告警, 每个周期最多一条
+PARSE_ALERT_INTERVAL = 600
+PARSE_ALERT_SAMPLES = 5
+_unparsed = {'count': 0, 'samples': [], 'alert_at': None}
+_unparsed_lock = threading.Lock()
+
+
+def _report_unparsed(line):
+    now = time.monotonic()
+    with _unparsed_lock:
+        _unparsed['count'] += 1
+        if len(_unparsed['samples']) < PARSE_ALERT_SAMPLES:
+            _unparsed['samples'].append(line)
+        if _unparsed['alert_at'] is not None and now - _unparsed['alert_at'] < PARSE_ALERT_INTERVAL:
+            return
+        count, samples = _unparsed['count'], _unparsed['samples']
+        _unparsed.update(count=0, samples=[], alert_at=now)
+    logger.warning('[chatgpt reviews error] {} lines unparsed, e.g. {}'.format(count, samples))
+    Lark(constant.LARK_CHAT_ID_P0).send_rich_text('[chatgpt reviews error] parse analyze empty',
+                                                  '{} lines unparsed, e.g.\n{}'.format(count, '\n'.join(samples)))
+
+
+def parse_ids(ids_str):
+    # 支持 1, 2, 5-8 这类写法, 返回有序整数列表; 每个逗号分隔项只取一个id或区间, 12a3 这类混写的项丢弃
+    ids = set()
+    for token in ids_str.split(','):
+        mt = pt_id_token.match(token)
+        if not mt:
+            continue
+        if mt.group(2):
+            ids.update(range(int(mt.group(1)), int(mt.group(2)) + 1))
+        else:
+            ids.add(int(mt.group(1)))
+    return sorted(ids)
 
 
 def parse_analyze(raw):
     points, filter_quote = [], 0
-    lines = raw.strip().split('\n')
-    for line in lines:
+    for line in raw.split('\n'):
         line = line.strip()
         # get filter_quote
         if 'Reviews Report' in line:
             if mt := pt_filter_quote.match(line):
                 filter_quote = int(mt.group(1))
-        if not line.startswith('-') or ('(' not in line and ':' not in line):
+        if not line.startswith('-'):
+            continue
+        has_paren = '(' in line
+        if not has_paren and ':' not in line:
             continue
         line = line.strip(',.- ')
-        if '(' in line and not line.endswith(')'):
-            line += ')'
-        # print(line)
-        if mt := pt.match(line):
-            point = str(mt.group(1)).strip('. ')
-            ids_str = mt.group(2).strip().strip('[]').split(',')
+        if has_paren:
+            # 取最后一对括号中的内容作为id
+            left = line.rfind('(')
+            right = line.find(')', left)
+            point, ids_str = line[:left], line[left+1:] if right < 0 else line[left+1:right]
         elif mt := pt_colon.match(line):
-            point = str(mt.group(1)).strip('. ')
-            ids_str = mt.group(2).strip().strip('[]').split(',')
+            point, ids_str = mt.group(1), mt.group(2)
         else:
-            point, ids_str = None, None
-            Lark(constant.LARK_CHAT_ID_P0).send_rich_text('[chatgpt reviews error] parse analyze empty', raw)
-        if point and ids_str:
-            ids = []
-            ids_raw = []
-            for each in ids_str:
-                each = each.strip().strip("'")
-                if pt_num_has.match(each):
-                    if mt_num_trim := pt_num_trim.match(each):
-                        ids_raw.append(mt_num_trim.group(1))
-            for each in ids_raw:
-                ids += parse_num(each)
-            ids = list(set(ids))
-            if len(ids) <= filter_quote:
-                continue
-            ids.sort(key=lambda x: int(x))
-            points.append({'point': point, 'ids': ids})
+            _report_unparsed(line)
+            continue
+        point = point.strip('. ')
+        if not point:
+            continue
+        ids = parse_ids(ids_str)
+        if len(ids) <= filter_quote:
+            continue
+        points.append({'point': point, 'ids': list(map(str, ids))})
     # rank
     points.sort(key=lambda x: len(x['ids']), reverse=True)
-
-    # for each in points:
-    #     print(each['point'], each['ids'])
-
     return points
 
 
@@ -106,7 +128,7 @@ def export(file_path=None):
     else:
         need_write_reviews = True
         record = LarkUserWorkbench.objects.filter(lark_user_id=constant.LARK_USER_ID_LUKE, work_symbol=dto.WORK_SYMBOL).first()
-        excel_data = record.detail.get(dto.JSON_KEY_EXCEL_DATA, [])
+        excel_data = review_store.get_excel_data(record.detail)
         excel_name = record.detail.get(dto.JSON_KEY_EXCEL_NAME, 'tmp.xlsx')
         map_review = dto.get_db_map_reviews(excel_data)
         wb = openpyxl.Workbook()
@@ -161,18 +183,6 @@ def export(file_path=None):
     wb.save(file_path)
 
 
-def parse_num(raw):
-    nums = []
-    if mt := pt_num_range.match(raw):
-        int_from = int(mt.group(1))
-        int_to = int(mt.group(2))
-        for i in range(int_from, int_to+1):
-            nums.append(str(i))
-    else:
-        nums.append(str(raw))
-    return nums
-
-
 # 将中间评论trim掉id list节约tokens
 def transform_analyze(raw, item_index, filter_quote=0):
     points_raw = parse_analyze(raw)
@@ -1,56 +1,144 @@
 import os
+import re
+import tempfile
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI
-from home.config import constant
 from home.gpt import meta
-from lark.settings import BASE_DIR
-from util import ffmpeg_util
-from util.lark_util import Lark
+from util import ffmpeg_util, openai_util
 from util.log_util import logger
+from util.rate_limit import get_limiter
 
 
 FILE_SIZE_MAX = 20 * 1024 * 1024  # MB, openai whisper limits to 25M
-client = OpenAI(api_key=meta.OPEN_AI_KEY_AIGC)
+# 长音频切段: 目标10分钟一段, 在静音处切开, 相邻段重叠避免切断的词丢失
+SEGMENT_SECONDS = 600
+SEGMENT_MIN_SECONDS = 300
+SEGMENT_MAX_SECONDS = 900  # 48kbps下约5.4MB
+SEGMENT_OVERLAP = 1.5
+MAX_CONCURRENT_SEGMENTS = 4
+WHISPER_RPM = 50
+STITCH_MAX_UNITS = 30  # 拼接时查找重复的最大词(字)数
+STITCH_MIN_UNITS = 2  # 单个词(字)重复可能是原文, 不去重
+ERROR_REPLY = 'error in parsing, pls retry later or contact Luke.'
+client = openai_util.get_client(meta.OPEN_AI_KEY_AIGC)
 
+pt_unit_strip = re.compile(r'[^\w]+')
 
-def to_text(file_blob=None, file_path=None, retry_max=2):
-    if file_blob:
-        audio_file = file_blob
-    elif file_path:
-        del_tmp = False
-        file_size = os.path.getsize(file_path)
-        is_audio_raw = file_path.endswith('mp3') or file_path.endswith('wav') or file_path.endswith('mpga')
-        if file_size > FILE_SIZE_MAX and not is_audio_raw:
-            output_path = '{}/home/gpt/data/tmp.mp3'.format(str(BASE_DIR))
-            _, mp3_file = ffmpeg_util.convert_video_to_audio_moviepy(file_path, output_path)
-            if mp3_file:
-                file_path = mp3_file
-                del_tmp = True
-        audio_file = open(file_path, "rb")
-        if del_tmp:
-            os.remove(file_path)
-    else:
-        return False, 'no input'
+
+def transcribe(audio_file, retry_max=2):
+    """单个文件(句柄或路径)请求whisper, 返回 (ok, text)"""
     retry = 0
     while retry < retry_max:
         retry += 1
+        get_limiter(meta.MODEL_SPEECH, WHISPER_RPM).acquire()
         try:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-            if hasattr(transcript, 'text') and transcript.text:
-                return True, transcript.text
+            if isinstance(audio_file, str):
+                with open(audio_file, 'rb') as f:
+                    transcript = client.audio.transcriptions.create(model=meta.MODEL_SPEECH, file=f)
+            else:
+                audio_file.seek(0)
+                transcript = client.audio.transcriptions.create(model=meta.MODEL_SPEECH, file=audio_file)
+            if hasattr(transcript, 'text'):
+                return True, transcript.text or ''
         except Exception as e:
-            logger.error('[openai whisper exception] {}'.format(traceback.format_exc()))
-            Lark(constant.LARK_CHAT_ID_P0).send_rich_text('openai whisper exception', traceback.format_exc())
+            logger.error('[openai whisper exception] retry: {}/{}, {}'.format(retry, retry_max, traceback.format_exc()))
+            if not openai_util.is_retryable(e) or retry >= retry_max:
+                openai_util.alert('openai whisper exception', e, traceback.format_exc())
+                break
+            time.sleep(openai_util.retry_delay(retry, e))
+    return False, ERROR_REPLY
+
+
+def plan_segments(duration, silences):
+    """
+    按静音切段: 每段在 [SEGMENT_MIN_SECONDS, SEGMENT_MAX_SECONDS] 内取最接近SEGMENT_SECONDS的静音中点切开,
+    没有静音时硬切; 下一段从切点前SEGMENT_OVERLAP秒开始
+    returns: [(start, end), ...]
+    """
+    cuts = [(start + end) / 2 for start, end in silences]
+    segments, start = [], 0.0
+    while duration - start > SEGMENT_MAX_SECONDS:
+        lo, hi = start + SEGMENT_MIN_SECONDS, start + SEGMENT_MAX_SECONDS
+        candidates = [c for c in cuts if lo <= c <= hi]
+        cut = min(candidates, key=lambda c: abs(c - start - SEGMENT_SECONDS)) if candidates else start + SEGMENT_SECONDS
+        segments.append((start, cut))
+        start = cut - SEGMENT_OVERLAP
+    segments.append((start, duration))
+    return segments
+
+
+def _units(text):
+    # 有空格按词, 否则(如中文)按字
+    return text.split() if ' ' in text.strip() else list(text)
+
+
+def stitch(texts):
+    """按顺序拼接各段文本, 去掉重叠区在上一段结尾和下一段开头重复的内容"""
+    result = []
+    for text in texts:
+        text = text.strip()
+        if not text:
+            continue
+        if result:
+            prev, units = _units(result[-1]), _units(text)
+            norm_prev = [pt_unit_strip.sub('', u).lower() for u in prev[-STITCH_MAX_UNITS:]]
+            norm_next = [pt_unit_strip.sub('', u).lower() for u in units[:STITCH_MAX_UNITS]]
+            for k in range(min(len(norm_prev), len(norm_next)), STITCH_MIN_UNITS - 1, -1):
+                if norm_prev[-k:] == norm_next[:k] and any(norm_next[:k]):
+                    units = units[k:]
+                    break
+            text = (' ' if ' ' in text else '').join(units)
+        if text:
+            result.append(text)
+    joiner = ' ' if any(' ' in each for each in result) else ''
+    return joiner.join(result)
 
-    return False, 'error in parsing, pls retry later or contact Luke.'
+
+def _transcribe_segment(audio_path, tmp_dir, index, start, end, retry_max):
+    segment_path = os.path.join(tmp_dir, 'segment_{:04d}.mp3'.format(index))
+    if not ffmpeg_util.cut(audio_path, segment_path, start, end - start):
+        return False, 'cut segment failed'
+    return transcribe(segment_path, retry_max=retry_max)
+
+
+def transcribe_long(audio_path, tmp_dir, retry_max=2):
+    """长音频按静音切段后并发转写, 按顺序拼接"""
+    start_time = time.monotonic()
+    duration = ffmpeg_util.probe_duration(audio_path)
+    if not duration or duration <= SEGMENT_MAX_SECONDS:
+        return transcribe(audio_path, retry_max=retry_max)
+    segments = plan_segments(duration, ffmpeg_util.detect_silences(audio_path))
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_SEGMENTS, len(segments))) as executor:
+        futures = [executor.submit(_transcribe_segment, audio_path, tmp_dir, i, start, end, retry_max)
+                   for i, (start, end) in enumerate(segments)]
+        results = [future.result() for future in futures]
+    failed = [i for i, (ok, _) in enumerate(results) if not ok]
+    logger.info('[speech to text] duration: {:.0f}s, segments: {}, failed: {}, cost: {:.1f}s'.format(
+        duration, len(segments), failed, time.monotonic() - start_time))
+    if failed:
+        return False, ERROR_REPLY
+    return True, stitch([text for _, text in results])
+
+
+def to_text(file_blob=None, file_path=None, retry_max=2):
+    if file_blob:
+        return transcribe(file_blob, retry_max=retry_max)
+    if not file_path:
+        return False, 'no input'
+    # 每次转写使用独立的临时目录, 并发请求互不覆盖
+    with tempfile.TemporaryDirectory(prefix='speech_') as tmp_dir:
+        audio_path = os.path.join(tmp_dir, 'audio.mp3')
+        if ffmpeg_util.extract_audio(file_path, audio_path):
+            return transcribe_long(audio_path, tmp_dir, retry_max=retry_max)
+    # 无法解码时按原文件直接请求
+    if os.path.getsize(file_path) > FILE_SIZE_MAX:
+        return False, 'file too large to transcribe without ffmpeg'
+    return transcribe(file_path, retry_max=retry_max)
 
 
 if __name__ == '__main__':
     file_input = '/Users/liuqingliang/Downloads/20230325-162627.mp4'
     o = to_text(file_path=file_input)
     print(o)
-
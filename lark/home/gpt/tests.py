@@ -0,0 +1,482 @@
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from home.gpt import algo_client, broker_async, context_store, dto, meta, response_cache, review, review_store, script, speech_client
+from home.gpt.review_reader import self_tag
+
+
+class ContextStoreTest(SimpleTestCase):
+
+    def test_budget_reserves_reply_and_system_prompt(self):
+        window = meta.CONTEXT_WINDOW[meta.MODEL_CHAT]
+        limit = min(meta.MAX_CONTEXT_TOKENS, window - context_store.REPLY_RESERVE)
+        self.assertEqual(context_store.budget(meta.MODEL_CHAT), limit)
+        with mock.patch.object(context_store, 'count', return_value=[120]):
+            self.assertEqual(context_store.budget(meta.MODEL_CHAT, system_prompt='be brief'), limit - 120)
+
+    def test_budget_unknown_model_uses_chat_window(self):
+        self.assertEqual(context_store.budget('unknown-model'), context_store.budget(meta.MODEL_CHAT))
+
+    def test_plan_compaction_keeps_ratio_of_budget(self):
+        # 预算500, 保留300: 最新3条
+        self.assertEqual(context_store.plan_compaction([100] * 10, 500), 7)
+
+    def test_plan_compaction_always_keeps_latest(self):
+        self.assertEqual(context_store.plan_compaction([10, 1000], 100), 1)
+        self.assertEqual(context_store.plan_compaction([1000], 100), 0)
+
+    def test_trimmed_keeps_messages_pushed_during_summary(self):
+        prompt_list = ['user::a', 'assistant::b', 'user::c']
+        current = prompt_list + ['user::d']
+        with mock.patch.object(context_store, 'count', side_effect=lambda model, entries: [10] * len(entries)):
+            kept, total = context_store.trimmed(prompt_list, current, 2, 'system::summary')
+        self.assertEqual(kept, ['system::summary', 'user::c', 'user::d'])
+        self.assertEqual(total, 30)
+
+    def test_trimmed_skips_when_compacted_by_another_request(self):
+        prompt_list = ['user::a', 'assistant::b', 'user::c']
+        self.assertIsNone(context_store.trimmed(prompt_list, ['system::other', 'user::c'], 2, None))
+        self.assertIsNone(context_store.trimmed(prompt_list, ['user::a'], 2, None))
+
+    def pipe(self, result):
+        """记录命令的pipeline, 同步的Batch与异步的pipeline共用"""
+        pipe = mock.MagicMock()
+        for name in ('delete', 'rpush', 'incrby', 'expire', 'lrange'):
+            getattr(pipe, name).return_value = pipe
+        pipe.__len__.return_value = 5
+        pipe.execute.return_value = result
+        return pipe
+
+    def push_both(self, result):
+        """同一结果下分别调用push_user与push_user_async, 返回两边的结果与命令"""
+        sync_pipe, async_pipe = self.pipe(result), self.pipe(None)
+        async_pipe.execute = mock.AsyncMock(return_value=result)
+        with mock.patch.object(context_store, 'count', return_value=[7]), \
+                mock.patch.object(context_store.redis_util, 'key_prefix', ''), \
+                mock.patch.object(context_store.redis_util, 'batch', return_value=sync_pipe), \
+                mock.patch.object(context_store.redis_util, 'async_client') as async_client:
+            async_client.return_value.pipeline.return_value = async_pipe
+            sync = context_store.push_user('c1', 'hi', reset=True)
+            async_ = asyncio.run(context_store.push_user_async('c1', 'hi', reset=True))
+        return sync, async_, sync_pipe.method_calls, async_pipe.method_calls
+
+    def test_push_user_sync_and_async_queue_same_commands(self):
+        result = [1, 1, 12, True, True, ['user::a', 'user::hi']]
+        sync, async_, sync_calls, async_calls = self.push_both(result)
+        self.assertEqual(sync, (12, ['user::a', 'user::hi']))
+        self.assertEqual(async_, sync)
+        self.assertEqual([c for c in async_calls if c[0] != 'execute'], [c for c in sync_calls if c[0] != 'execute'])
+
+    def test_push_user_failed_commands_fall_back(self):
+        # 同步Batch给出None, 异步pipeline给出异常对象, 两边都退回只含本条消息
+        sync, _, _, _ = self.push_both([1, 1, None, True, True, None])
+        _, async_, _, _ = self.push_both([1, 1, RuntimeError('oom'), True, True, RuntimeError('oom')])
+        self.assertEqual(sync, (0, ['user::hi']))
+        self.assertEqual(async_, sync)
+
+    def test_push_user_async_connection_error_falls_back(self):
+        pipe = self.pipe(None)
+        pipe.execute = mock.AsyncMock(side_effect=ConnectionError('down'))
+        with mock.patch.object(context_store, 'count', return_value=[7]), \
+                mock.patch.object(context_store.redis_util, 'async_client') as async_client:
+            async_client.return_value.pipeline.return_value = pipe
+            self.assertEqual(asyncio.run(context_store.push_user_async('c1', 'hi')), (0, ['user::hi']))
+
+    def test_fit_within_budget_skips_redis(self):
+        with mock.patch.object(context_store, 'budget', return_value=100), \
+                mock.patch.object(context_store.redis_util, 'async_client') as async_client:
+            self.assertEqual(context_store.fit('c1', 50, ['user::a']), ['user::a'])
+            self.assertEqual(asyncio.run(context_store.fit_async('c1', 50, ['user::a'])), ['user::a'])
+        async_client.assert_not_called()
+
+
+class ReviewSegmentsTest(SimpleTestCase):
+
+    def ask(self, replies, order):
+        """各分段按replies返回(异常则抛出), 完成顺序为order"""
+        segments = [{'index_from': i * 10, 'index_to': i * 10 + 10, 'content': str(i), 'tokens': 1} for i in range(len(replies))]
+
+        def ask_segment(body, req):
+            reply = replies[int(body['content'])]
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        req = mock.MagicMock(user_id='u1', use_lark=True)
+        with mock.patch.object(review, 'ask_segment', side_effect=ask_segment), \
+                mock.patch.object(review, 'as_completed', side_effect=lambda futures: [list(futures)[i] for i in order]), \
+                mock.patch.object(review.script, 'check_reply_ok', side_effect=lambda reply: reply != 'bad'), \
+                mock.patch.object(review, 'bot_client') as bot_client, \
+                mock.patch.object(review, 'Lark') as lark:
+            result = review.ask_segments(segments, req, 'archive')
+        notified = [c[0][2] for c in bot_client.send_text_with_title.call_args_list if c[0][2].startswith('Reviews Part')]
+        return result, notified, lark.return_value.send_rich_text.call_count
+
+    def test_parts_notified_in_order(self):
+        (replies, ok), notified, alerts = self.ask([(True, 'r0'), (True, 'r1'), (True, 'r2')], [2, 0, 1])
+        self.assertEqual((replies, ok, alerts), (['r0', 'r1', 'r2'], True, 0))
+        self.assertEqual([title.split(' (')[0] for title in notified], ['Reviews Part 1', 'Reviews Part 2', 'Reviews Part 3'])
+
+    def test_parts_after_failure_never_notified(self):
+        (replies, ok), notified, alerts = self.ask([(True, 'r0'), (True, 'bad'), (True, 'r2')], [2, 0, 1])
+        self.assertEqual((replies, ok, alerts), (['r0'], True, 1))
+        self.assertEqual(len(notified), 1)
+
+    def test_segment_exception_counts_as_failed_request(self):
+        (replies, ok), notified, alerts = self.ask([(True, 'r0'), RuntimeError('boom'), (False, 'timeout')], [0, 1, 2])
+        self.assertEqual((replies, ok, alerts), (['r0'], False, 1))
+        self.assertEqual(len(notified), 1)
+
+
+class MergeGroupTest(SimpleTestCase):
+
+    def build(self, tokens):
+        # 每条回复的token数直接给出, 不经过解析与编码
+        with mock.patch.object(review.script, 'transform_analyze', side_effect=lambda raw, index, filter_quote=0: (raw, {})), \
+                mock.patch.object(review.token_count, 'count_many', return_value=tokens):
+            return review.build_merge_groups(['reply'] * len(tokens))
+
+    def test_groups_by_token_budget(self):
+        self.assertEqual(self.build([600, 600, 600, 200, 1400]), [[0, 1], [2, 3], [4]])
+
+    def test_oversized_reply_is_its_own_group(self):
+        self.assertEqual(self.build([2000, 100, 2000]), [[0], [1], [2]])
+
+    def test_groups_by_reply_count(self):
+        groups = self.build([1] * (review.MAX_REPLIES_IN_MERGE + 1))
+        self.assertEqual([len(each) for each in groups], [review.MAX_REPLIES_IN_MERGE, 1])
+
+    def test_empty(self):
+        self.assertEqual(self.build([]), [])
+
+
+
+class ClusterTest(SimpleTestCase):
+
+    @staticmethod
+    def unit(degrees):
+        return [np.cos(np.radians(degrees)), np.sin(np.radians(degrees))]
+
+    def test_cluster_by_threshold_around_heaviest(self):
+        # cos(30°)=0.866 在阈值内, cos(40°)=0.766 不在
+        vectors = np.asarray([self.unit(0), self.unit(30), self.unit(40), self.unit(70)], dtype=np.float32)
+        self.assertEqual(algo_client.cluster(vectors, [1, 5, 1, 1]), [[1, 0, 2], [3]])
+        self.assertEqual(algo_client.cluster(vectors, [5, 1, 1, 1]), [[0, 1], [2, 3]])
+        self.assertEqual(algo_client.cluster(vectors, [1, 1, 5, 1]), [[2, 1, 3], [0]])
+
+    def test_threshold_is_inclusive(self):
+        vectors = np.asarray([self.unit(0), self.unit(0)], dtype=np.float32)
+        self.assertEqual(algo_client.cluster(vectors, [1, 1], threshold=1.0), [[0, 1]])
+        self.assertEqual(algo_client.cluster(np.zeros((0, 2), dtype=np.float32), []), [])
+
+    def test_embed_normalizes_api_vectors(self):
+        with mock.patch.object(algo_client, '_get_local_model', return_value=None), \
+                mock.patch.object(algo_client, '_embed_by_api', return_value=np.asarray([[3, 4], [0, 0]], dtype=np.float32)):
+            vectors = algo_client.embed(['a', 'b'])
+        np.testing.assert_allclose(vectors, [[0.6, 0.8], [0, 0]])
+
+    def test_embed_by_api_only_requests_uncached(self):
+        client = mock.MagicMock()
+        client.embeddings.create.return_value.data = [mock.MagicMock(embedding=[0.0, 1.0])]
+        with mock.patch.object(algo_client.redis_util, 'mget', return_value=[[1.0, 0.0], None]), \
+                mock.patch.object(algo_client.redis_util, 'set_many') as set_many, \
+                mock.patch.object(algo_client.openai_util, 'get_client', return_value=client):
+            vectors = algo_client._embed_by_api(['cached', 'fresh'])
+        self.assertEqual(client.embeddings.create.call_args.kwargs['input'], ['fresh'])
+        self.assertEqual(list(set_many.call_args[0][0].values()), [[0.0, 1.0]])
+        np.testing.assert_allclose(vectors, [[1, 0], [0, 1]])
+
+    def test_merge_points_unions_ids(self):
+        points = [{'point': 'slow', 'ids': ['3', '1']}, {'point': 'laggy', 'ids': ['2']}, {'point': 'cheap', 'ids': ['4']},
+                  {'point': 'slow', 'ids': ['10']}]
+        vectors = np.asarray([self.unit(0), self.unit(10), self.unit(90)], dtype=np.float32)
+        with mock.patch.object(algo_client.script, 'parse_analyze', return_value=points), \
+                mock.patch.object(algo_client, 'embed', return_value=vectors):
+            merged = algo_client.merge_points(['reply'])
+        self.assertEqual(merged, [{'point': 'slow', 'ids': ['1', '2', '3', '10']}, {'point': 'cheap', 'ids': ['4']}])
+
+    def test_merge_points_unmerged_when_embedding_fails(self):
+        points = [{'point': 'slow', 'ids': ['1']}, {'point': 'laggy', 'ids': ['2', '3']}]
+        with mock.patch.object(algo_client.script, 'parse_analyze', return_value=points), \
+                mock.patch.object(algo_client, 'embed', return_value=None), \
+                mock.patch.object(algo_client, 'Lark'):
+            merged = algo_client.merge_points(['reply'])
+        self.assertEqual(merged, [{'point': 'laggy', 'ids': ['2', '3']}, {'point': 'slow', 'ids': ['1']}])
+
+
+
+class SelfTagTest(SimpleTestCase):
+    map_reviews = {'1': 'too small', '2': 'runs small', '3': 'nice color', '4': 'small in the waist'}
+
+    def setUp(self):
+        # redis hash 用字典代替
+        self.store = {}
+        patchers = [
+            mock.patch.object(self_tag.redis_util, 'hmget',
+                              side_effect=lambda key, fields: [self.store.get(key, {}).get(f) for f in fields]),
+            mock.patch.object(self_tag.redis_util, 'hset_many',
+                              side_effect=lambda key, mapping: self.store.setdefault(key, {}).update(mapping)),
+            mock.patch.object(self_tag.redis_util, 'expire'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def check(self, points, reply_ids):
+        def run_check(check_prompt, batch_content, batch_ids, tokens):
+            self.checked.append(list(batch_ids))
+            return [i for i in batch_ids if i in reply_ids]
+        self.checked = []
+        with mock.patch.object(self_tag, 'run_check', side_effect=run_check):
+            return self_tag.check_report(points, self.map_reviews)
+
+    def test_verdicts_round_trip(self):
+        self_tag.save_verdicts({('small', '1'): True, ('small', '3'): False}, self.map_reviews)
+        verdicts = self_tag.load_verdicts([{'point': 'small', 'ids': ['1', '3', '4']}], self.map_reviews)
+        self.assertEqual(verdicts, {('small', '1'): True, ('small', '3'): False})
+
+    def test_verdict_field_depends_on_content(self):
+        self.assertNotEqual(self_tag._verdict_field('1', 'too small'), self_tag._verdict_field('1', 'nice color'))
+
+    def test_cached_verdicts_are_not_checked_again(self):
+        points, _ = self.check([{'point': 'small', 'ids': ['1', '2', '3']}], reply_ids={'3'})
+        self.assertEqual(self.checked, [['1', '2', '3']])
+        self.assertEqual(points[0]['false_ids'], ['3'])
+        # 第二次只校验新评论, 单条新评论带上一条已有结论的评论
+        points, _ = self.check([{'point': 'small', 'ids': ['1', '2', '3', '4']}], reply_ids=set())
+        self.assertEqual(self.checked, [['4', '1']])
+        self.assertEqual(points[0]['false_ids'], ['3'])
+
+    def test_single_review_point_is_not_checked(self):
+        points, out_ids = self.check([{'point': 'color', 'ids': ['3']}], reply_ids=set())
+        self.assertEqual((self.checked, points[0]['false_ids'], out_ids), ([], [], []))
+
+
+
+class FakeReviewRows:
+    """ObserverArchiveReview.objects 的内存替代, 只支持review_store用到的查询"""
+
+    def __init__(self):
+        self.rows = []
+        self.digest = None
+
+    def filter(self, digest):
+        query = FakeReviewRows()
+        query.rows = [row for row in self.rows if row.digest == digest]
+        return query
+
+    def exists(self):
+        return bool(self.rows)
+
+    def order_by(self, field):
+        query = FakeReviewRows()
+        query.rows = sorted(self.rows, key=lambda row: getattr(row, field))
+        return query
+
+    def values_list(self, field, flat=True):
+        return [getattr(row, field) for row in self.rows]
+
+    def bulk_create(self, rows, batch_size=None):
+        self.rows.extend(rows)
+
+
+class ReviewStoreTest(SimpleTestCase):
+    reviews = [{'#1': '1', '#2': 'too small'}, {'#1': '2', '#2': 'nice color'}]
+
+    def setUp(self):
+        self.objects = FakeReviewRows()
+        patchers = [mock.patch.object(review_store.ObserverArchiveReview, 'objects', self.objects),
+                    mock.patch.object(review_store.transaction, 'atomic')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_digest_round_trip(self):
+        digest = review_store.save_reviews(self.reviews)
+        self.assertEqual(review_store.load_reviews(digest), self.reviews)
+        self.assertEqual(review_store.get_excel_data({dto.JSON_KEY_REVIEWS_DIGEST: digest}), self.reviews)
+
+    def test_same_content_is_stored_once(self):
+        first = review_store.save_reviews(self.reviews)
+        second = review_store.save_reviews([dict(each) for each in self.reviews])
+        self.assertEqual((first, len(self.objects.rows)), (second, 2))
+        self.assertNotEqual(review_store.save_reviews(self.reviews[:1]), first)
+        self.assertEqual(len(self.objects.rows), 3)
+
+    def test_digest_ignores_key_order(self):
+        self.assertEqual(review_store.reviews_digest([{'#1': '1', '#2': 'a'}]), review_store.reviews_digest([{'#2': 'a', '#1': '1'}]))
+
+    def test_legacy_records(self):
+        self.assertEqual(review_store.get_excel_data({dto.JSON_KEY_EXCEL_DATA: self.reviews}), self.reviews)
+        self.assertEqual(review_store.get_excel_data(None), [])
+        archive = mock.MagicMock(origin_info={'reviews': [{'id': '1', 'content': 'x'}]})
+        self.assertEqual(review_store.get_archive_reviews(archive), [{'id': '1', 'content': 'x'}])
+
+    def test_archive_reviews_by_digest(self):
+        digest = review_store.save_reviews([{'#{}'.format(review_store.review_meta.INDEX_ID): '7',
+                                              '#{}'.format(review_store.review_meta.INDEX_CONTENT): 'fits well'}])
+        archive = mock.MagicMock(origin_info={review_store.ORIGIN_KEY_DIGEST: digest})
+        self.assertEqual(review_store.get_archive_reviews(archive), [{'id': '7', 'content': 'fits well'}])
+
+
+class SpeechSegmentTest(SimpleTestCase):
+
+    def test_plan_segments_short_audio_is_one_segment(self):
+        self.assertEqual(speech_client.plan_segments(500, []), [(0.0, 500)])
+
+    def test_plan_segments_hard_cut_without_silence(self):
+        segments = speech_client.plan_segments(2000, [])
+        overlap = speech_client.SEGMENT_OVERLAP
+        self.assertEqual(segments, [(0.0, 600.0), (600.0 - overlap, 1200.0 - overlap), (1200.0 - 2 * overlap, 2000)])
+
+    def test_plan_segments_cuts_at_nearest_silence(self):
+        # 静音中点 400 / 710, 取最接近600的710; 超出最大段长的静音不采用
+        segments = speech_client.plan_segments(1600, [(390, 410), (700, 720), (950, 960)])
+        self.assertEqual(segments[0], (0.0, 710.0))
+        self.assertEqual(segments[1][0], 710.0 - speech_client.SEGMENT_OVERLAP)
+        self.assertEqual(segments[-1][1], 1600)
+        for start, end in segments:
+            self.assertLessEqual(end - start, speech_client.SEGMENT_MAX_SECONDS)
+
+    def test_stitch_removes_overlap_words(self):
+        self.assertEqual(speech_client.stitch(['hello world this is', 'This is, a test']), 'hello world this is a test')
+
+    def test_stitch_removes_overlap_chars(self):
+        self.assertEqual(speech_client.stitch(['今天天气很好', '很好我们出去']), '今天天气很好我们出去')
+
+    def test_stitch_keeps_single_repeated_word(self):
+        self.assertEqual(speech_client.stitch(['a b c', 'c d', '', '  ']), 'a b c c d')
+
+
+class ScriptParseTest(SimpleTestCase):
+
+    def test_parse_ids(self):
+        self.assertEqual(script.parse_ids('3, 1, 2, 3'), [1, 2, 3])
+        self.assertEqual(script.parse_ids('1, 5-8, 6'), [1, 5, 6, 7, 8])
+        self.assertEqual(script.parse_ids('[1, 2 - 3]'), [1, 2, 3])
+        self.assertEqual(script.parse_ids("'#4', id 9"), [4, 9])
+
+    def test_parse_ids_drops_malformed(self):
+        self.assertEqual(script.parse_ids('12a3, 4'), [4])
+        self.assertEqual(script.parse_ids('1 2, 5-x, '), [5])
+        self.assertEqual(script.parse_ids(''), [])
+
+    def test_parse_analyze(self):
+        raw = '\n'.join([
+            'Reviews Report (filter_quote: 1)',
+            '- Too small (1, 2, 5-7).',
+            '- Color fades: 3, 4',
+            '- Loose seam (12a3, 4)',
+            '- Runs large (see note) (8, 9',
+            '- no ids here',
+            'not a point (10, 11)',
+        ])
+        self.assertEqual(script.parse_analyze(raw), [
+            {'point': 'Too small', 'ids': ['1', '2', '5', '6', '7']},
+            {'point': 'Color fades', 'ids': ['3', '4']},
+            {'point': 'Runs large (see note)', 'ids': ['8', '9']},
+        ])
+
+
+
+class ResponseCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = response_cache.ResponseCache(path=os.path.join(tmp.name, 'gpt', 'responses.db'), max_bytes=10)
+        self.addCleanup(lambda: self.cache._conn and self.cache._conn.close())
+        self.now = 1000.0
+        patchers = [mock.patch.object(response_cache.time, 'time', side_effect=self.tick),
+                    mock.patch.object(response_cache, 'EVICT_EVERY', 1),
+                    mock.patch.object(response_cache, 'EVICT_BATCH', 1)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tick(self):
+        self.now += 1
+        return self.now
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('k'))
+        self.cache.put('k', 'gpt', 'abc')
+        self.assertEqual(self.cache.get('k'), 'abc')
+        self.assertEqual((self.cache.stats['hits'], self.cache.stats['misses'], self.cache.hit_rate()), (1, 1, 0.5))
+
+    def test_least_recently_read_evicted_over_max_bytes(self):
+        self.cache.put('a', 'gpt', 'aaaa')
+        self.cache.put('b', 'gpt', 'bbbb')
+        self.cache.get('a')
+        self.cache.put('c', 'gpt', 'cccc')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual((self.cache.get('a'), self.cache.get('c')), ('aaaa', 'cccc'))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    def test_size_counts_utf8_bytes(self):
+        self.cache.put('a', 'gpt', '评论')
+        self.cache.put('b', 'gpt', '评论')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), '评论')
+
+    def test_key_depends_on_every_part(self):
+        key = response_cache.ResponseCache.make_key('gpt', 'sys', ['user::hi'], 0.7)
+        self.assertEqual(key, response_cache.ResponseCache.make_key('gpt', 'sys', ['user::hi'], 0.7))
+        self.assertNotEqual(key, response_cache.ResponseCache.make_key('gpt', 'sys', ['user::hi'], 0.2))
+        self.assertNotEqual(key, response_cache.ResponseCache.make_key('gpt', None, ['user::hi'], 0.7))
+
+
+
+def run_in_loop(func, **kwargs):
+    """sync_to_async的替代: 在测试里直接调用同步函数"""
+    async def call(*args, **kw):
+        return func(*args, **kw)
+    return call
+
+
+class BrokerAsyncTest(SimpleTestCase):
+    body = {'event': {'open_message_id': 'm1', 'chat_type': 'private', 'employee_id': 'u1', 'open_chat_id': 'c1',
+                      'text_without_at_bot': 'hello', 'msg_type': 'text'}}
+
+    def setUp(self):
+        patchers = [mock.patch.object(broker_async, 'sync_to_async', side_effect=run_in_loop),
+                    mock.patch.object(broker_async, 'chat_persister')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, hit):
+        with mock.patch.object(broker_async.dev_mode, 'get_model', return_value=meta.MODEL_CHAT), \
+                mock.patch.object(broker_async, 'do_ask_with_context', new=mock.AsyncMock(return_value=(hit, 'hi'))) as do_ask, \
+                mock.patch.object(broker_async.sender, 'reply_text_async', new=mock.AsyncMock(return_value={})) as reply_text, \
+                mock.patch.object(broker_async.context_store, 'push_reply_async', new=mock.AsyncMock()) as push_reply:
+            self.assertTrue(asyncio.run(broker_async.ask(self.body)))
+        do_ask.assert_awaited_once_with('c1', 'hello', model=meta.MODEL_CHAT)
+        reply_text.assert_awaited_once_with('c1', 'u1', 'hi')
+        self.assertEqual(broker_async.chat_persister.save.call_count, 2)
+        return push_reply
+
+    def test_reply_pushed_to_context_on_hit(self):
+        self.ask(hit=True).assert_awaited_once_with('c1', 'hi', model=meta.MODEL_CHAT)
+
+    def test_failed_reply_not_pushed_to_context(self):
+        self.ask(hit=False).assert_not_awaited()
+
+    def test_ignored_event(self):
+        self.assertIsNone(asyncio.run(broker_async.ask({})))
+        broker_async.chat_persister.save.assert_not_called()
+
+    def test_do_ask_with_context(self):
+        with mock.patch.object(broker_async.context_store, 'push_user_async', new=mock.AsyncMock(return_value=(10, ['user::a']))), \
+                mock.patch.object(broker_async.context_store, 'fit_async', new=mock.AsyncMock(return_value=['user::a'])) as fit, \
+                mock.patch.object(broker_async.cache, 'get_tone', return_value='be brief'), \
+                mock.patch.object(broker_async.cache, 'get_temp', return_value=0.2), \
+                mock.patch.object(broker_async.chat_client, 'ask_async', new=mock.AsyncMock(return_value=(True, 'ok'))) as ask:
+            self.assertEqual(asyncio.run(broker_async.do_ask_with_context('c1', 'a')), (True, 'ok'))
+        fit.assert_awaited_once_with('c1', 10, ['user::a'], model=meta.MODEL_CHAT, system_prompt='be brief')
+        ask.assert_awaited_once_with(['user::a'], system_prompt='be brief', model=meta.MODEL_CHAT, temperature=0.2)
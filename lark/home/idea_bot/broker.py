@@ -5,7 +5,7 @@ import uuid
 import django
 from datetime import datetime
 from home.enums import MaterialType
-from util import redis_util, s3_util
+from util import redis_util, s3_util, local_cache, dedup
 import pandas as pd
 from typing import Dict, Optional, Tuple, List
 import json
@@ -17,10 +17,11 @@ django.setup()
 
 from home.lark_client import bot
 from home.config import constant
-from home.idea_bot import client, spider, meta, openai_client, file_client
+from home.idea_bot import client, spider, meta, openai_client, file_client, file_profile, chunk_analyzer, pdf_index
 from home.idea_bot.enum import VideoSource, FileType
 from home.message import LarkEvent
 from home.models import ChatMsg, IdeaMaterial
+from home.services import chat_persister
 from util.lark_util import Lark
 from util.log_util import logger
 from home.idea_bot.version import get_version_info, get_capabilities, CAPABILITIES
@@ -35,6 +36,7 @@ from home.idea_bot.message_helpers import (
 
 
 PT_LINK = re.compile(r'^.*(https?://[^ ,，?)\]]*).*$')
+MSG_DEDUP_TTL = 24 * 3600  # lark does not redeliver messages after a day
 
 # ============================================================================
 # MAIN EVENT HANDLERS
@@ -59,7 +61,7 @@ def tackle_event(lark_event: LarkEvent):
         return False
     #deduplicate
     event_id = lark_event.event_id
-    if not redis_util.set_nx('idea:lock:event:{}'.format(event_id), ex=3600):
+    if dedup.first_seen('idea:lock:event', event_id, ttl=3600) is False:
         #filter duplicate events
         return None
     #message
@@ -71,8 +73,13 @@ def tackle_event(lark_event: LarkEvent):
             
         #get message details
         msg_id = body.message_id
-        if ChatMsg.objects.filter(msg_id=msg_id, deleted=constant.NO_IN_DB).count() > 0:
-            #filter duplicate messages
+        #filter duplicate messages, the database is only asked when redis cannot answer
+        seen = dedup.first_seen('idea:lock:msg', msg_id, ttl=MSG_DEDUP_TTL)
+        if seen is False:
+            return None
+        #saved messages may still be buffered by chat_persister
+        if seen is None and (chat_persister.is_pending(msg_id) or
+                             ChatMsg.objects.filter(msg_id=msg_id, deleted=constant.NO_IN_DB).exists()):
             return None
             
         text = body.text
@@ -320,15 +327,21 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
         
         #check for clear command
         if text.lower().strip() == '/clear':
-            #clear all context and tokens for this user
-            redis_util.delete(f'file_context:{user_id}')
-            redis_util.delete(f'full_file_context:{user_id}')
-            redis_util.delete(f'chat_context:{chat_id}:{user_id}')
-            redis_util.delete(f'chat_context:{chat_id}')
-            redis_util.delete(f'chat_context_hash:{chat_id}')
-            redis_util.hdel(f"user_preferences:{user_id}", "language")
+            #clear all context and tokens for this user, in one transaction
+            b = redis_util.batch(transaction=True) \
+                .delete(f'file_context:{user_id}', f'full_file_context:{user_id}', f'chat_context:{chat_id}:{user_id}',
+                        f'chat_context:{chat_id}', f'chat_context_hash:{chat_id}') \
+                .hdel(f"user_preferences:{user_id}", "language")
+            local_cache.invalidate(_language_cache_key(user_id), batch=b)
+            b.execute()
             return "Chat history and file context cleared. How can I help you?"
         
+        #detect language preference from user message
+        language_preference = detect_language_preference(text)
+        
+        #load language preference, file context and chat context in one round trip
+        current_language, file_context, full_file_context, chat_context = _load_message_state(chat_id, user_id, language_preference)
+        
         #check for analyze files command
         if text.lower().strip() in ['analyze these files', 'analyze files', 'ready for files', 'prepare for analysis']:
             return "I'm ready to analyze your files! Please upload the files you'd like me to analyze, and I'll provide detailed insights on the data."
@@ -346,26 +359,13 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
             #check if there's recent file context and provide detailed analysis
             return handle_detailed_analysis_request(text, user_id, current_language, 'file')
         
-        #detect language preference from user message
-        language_preference = detect_language_preference(text)
-        
-        #update language preference in redis if detected
-        if language_preference:
-            redis_util.hset(f"user_preferences:{user_id}", "language", language_preference)
-        
-        #get current language preference
-        current_language = redis_util.hget(f"user_preferences:{user_id}", "language")
-        
-        #get file context from redis
-        file_context = redis_util.get(f'file_context:{user_id}')
-        
-        #ensure file_context is a dictionary if it exists
-        if file_context and isinstance(file_context, str):
-            try:
-                file_context = json.loads(file_context)
-            except json.JSONDecodeError:
-                logger.warning(f'[handle_text_message] Invalid JSON in file_context for user {user_id}')
-                file_context = None
+        #get the precomputed dataset profile so prompts carry statistics instead of raw rows
+        profile, relevant_pages = None, []
+        if file_context and isinstance(file_context, dict):
+            profile = file_profile.get_profile(file_context.get('file_hash'))
+            #for documents, retrieve only the pages relevant to this question
+            if file_context.get('file_type') == FileType.PDF.name.lower():
+                relevant_pages = pdf_index.retrieve(file_context.get('file_hash'), text)
         
         #check if this is a follow-up question about a recently uploaded file
         #look for analysis-related keywords in the user's message
@@ -383,19 +383,7 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
         #if user is asking for analysis or asking a question and we have file context, treat it as a file analysis request
         if (is_analysis_request or is_question) and file_context:
             logger.info(f'[handle_text_message] Detected analysis/question request with file context, treating as file analysis')
-            #use stored file context for analysis instead of conversation context
-            analysis_messages = [
-                get_system_message(file_context, current_language),
-                {"role": "user", "content": f"Analyze this data and answer: {text}"}
-            ]
-            
-            #get full file data for analysis if available
-            full_file_context = get_full_file_context_from_redis(user_id)
-            if full_file_context:
-                analysis_system = get_analysis_system_message(full_file_context, current_language)
-                analysis_messages[0] = analysis_system
-            
-            response = openai_client.chat_completion(analysis_messages)
+            response = _answer_file_question(text, file_context, full_file_context, current_language, profile, relevant_pages)
             if response:
                 return response
             else:
@@ -410,14 +398,11 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
                 rows = processed_data.get('rows', 0)
                 is_large_dataset = rows > 50
         
-        #get chat context from redis
-        chat_context = _get_chat_context(chat_id, user_id)
-        
         #prepare messages for openai
         messages = []
         
         #add system message with file context
-        system_message = get_system_message(file_context, current_language)
+        system_message = get_system_message(file_context, current_language, profile, relevant_pages)
         messages.append(system_message)
         
         #add chat history
@@ -429,19 +414,7 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
         
         #for datasets with file context, use analysis path
         if file_context:
-            #use stored file context for analysis instead of conversation context
-            analysis_messages = [
-                system_message,
-                {"role": "user", "content": f"Analyze this data and answer: {text}"}
-            ]
-            
-            #get full file data for analysis if available
-            full_file_context = get_full_file_context_from_redis(user_id)
-            if full_file_context:
-                analysis_system = get_analysis_system_message(full_file_context, current_language)
-                analysis_messages[0] = analysis_system
-            
-            response = openai_client.chat_completion(analysis_messages)
+            response = _answer_file_question(text, file_context, full_file_context, current_language, profile, relevant_pages)
         else:
             #normal conversation flow
             response = openai_client.chat_completion(messages)
@@ -464,6 +437,56 @@ def handle_text_message(text: str, chat_id: str, user_id: str, msg_id: str = '')
         logger.error(f'[handle_text_message] Current language: {current_language}')
         return get_error_response("I encountered an error processing your message. Please try again.")
 
+def _answer_file_question(text: str, file_context: dict, full_file_context: Optional[dict], current_language: Optional[str],
+                          profile: Optional[dict] = None, relevant_pages: Optional[List[Dict]] = None) -> Optional[str]:
+    """
+    Answers a question about the user's uploaded file. Documents with pages matching the question are answered 
+    from those retrieved pages only. Otherwise files too large for a single prompt (large datasets and long 
+    documents) go through chunk_analyzer's map-reduce over the full content, so every row or page is considered 
+    instead of a sample. Smaller files are answered in one call from the stored file context, with the full dataset 
+    or the precomputed profile in the system message. Called by handle_text_message() for both the explicit 
+    analysis/question path and the general file-context path.
+
+    params:
+    - text (str): The user's question
+    - file_context (dict): The file context loaded from Redis
+    - full_file_context (dict, optional): The full file context of a large dataset, loaded from Redis
+    - current_language (str, optional): User's preferred language
+    - profile (dict, optional): Precomputed profile of the uploaded file
+    - relevant_pages (List[Dict], optional): Document pages retrieved for the question (see pdf_index.retrieve)
+
+    returns:
+    Returns the AI-generated answer, or None if the model call fails
+    """
+    #documents: answer from the pages that match the question
+    if relevant_pages:
+        logger.info(f'[handle_text_message] Answering from {len(relevant_pages)} retrieved pages')
+        return openai_client.chat_completion([
+            get_system_message(file_context, current_language, profile, relevant_pages),
+            {"role": "user", "content": f"Analyze this document and answer: {text}"}
+        ])
+    
+    #use full file data for analysis if available
+    analysis_context = full_file_context or file_context
+    
+    #large files are analyzed in chunks over the full content
+    if chunk_analyzer.needs_chunking(analysis_context):
+        logger.info(f'[handle_text_message] Large file context, using chunked map-reduce analysis')
+        response = chunk_analyzer.analyze(analysis_context, text, current_language)
+        if response:
+            return response
+        logger.warning(f'[handle_text_message] Chunked analysis failed, falling back to single prompt')
+    
+    #use stored file context for analysis instead of conversation context
+    analysis_messages = [
+        get_system_message(file_context, current_language, profile),
+        {"role": "user", "content": f"Analyze this data and answer: {text}"}
+    ]
+    if full_file_context:
+        analysis_messages[0] = get_analysis_system_message(full_file_context, current_language, profile)
+    
+    return openai_client.chat_completion(analysis_messages)
+
 def detect_language_preference(text: str) -> Optional[str]:
     """
     Detect if user is requesting language preference change from their message text.
@@ -562,6 +585,14 @@ def _handle_local_file(file_name: str, chat_id: str, user_id: str, msg_id: str)
         save_error_message(msg_id, chat_id, user_id, error_msg, msg_id, msg_id)
         return error_msg
 
+# Kind of content expected for each file type when downloading (see file_client.read_content)
+EXPECTED_CONTENT_KINDS = {
+    FileType.IMAGE: 'image',
+    FileType.PDF: 'pdf',
+    FileType.EXCEL: 'excel',
+    FileType.CSV: 'csv',
+}
+
 def _handle_lark_file(file_key: str, file_name: str, chat_id: str, user_id: str, msg_id: str) -> Optional[str]:
     """
     Processes files that were uploaded through the Lark platform and need to be downloaded before processing. This function 
@@ -584,9 +615,15 @@ def _handle_lark_file(file_key: str, file_name: str, chat_id: str, user_id: str,
     try:
         logger.info(f'[handle_file_message] Getting file info for key: {file_key}')
         file_info, file_name = file_client.get_file_info(msg_id, file_key, file_name)
-        file_data = file_info.content
         file_type = FileType.from_extension(file_name)
         
+        # Stream the download with a size cap, rejecting content that does not match the extension
+        file_data = file_client.read_content(file_info, EXPECTED_CONTENT_KINDS.get(file_type))
+        if file_data is None:
+            error_msg = get_error_response("File is too large (maximum size is 20MB) or its content does not match its type")
+            save_error_message(msg_id, chat_id, user_id, error_msg, msg_id, msg_id)
+            return error_msg
+        
         # Handle image files
         if file_type == FileType.IMAGE:
             return _process_lark_image_file(file_data, file_key, file_name, chat_id, user_id, msg_id)
@@ -627,7 +664,7 @@ def _process_image_file(file_data: bytes, file_name: str, chat_id: str, user_id:
     logger.info(f'[handle_file_message] Starting image processing for local file: {file_name}')
     try:
         # Get current language preference
-        current_language = redis_util.hget(f"user_preferences:{user_id}", "language")
+        current_language = get_language_preference(user_id)
         
         # Process image with GPT-4 Vision
         logger.info(f'[handle_file_message] Calling OpenAI Vision API for file: {file_name}')
@@ -672,14 +709,14 @@ def _process_lark_image_file(file_data, file_key: str, file_name: str, chat_id:
     logger.info(f'[handle_file_message] Starting image processing for Lark file: {file_name}')
     try:
         # Get current language preference
-        current_language = redis_util.hget(f"user_preferences:{user_id}", "language")
+        current_language = get_language_preference(user_id)
         
         # Get image content
         logger.info(f'[handle_file_message] Getting image content for Lark file: {file_name}')
         logger.info(f'[handle_file_message] File data type: {type(file_data)}')
         logger.info(f'[handle_file_message] File data size: {len(file_data) if isinstance(file_data, bytes) else "not bytes"}')
         
-        image_content = file_data if isinstance(file_data, bytes) else file_client.download_file(file_key)
+        image_content = file_data if isinstance(file_data, bytes) else file_client.download_file(file_key, 'image')
         if not image_content:
             logger.error(f'[handle_file_message] Failed to get image content for Lark file: {file_name}')
             error_msg = get_error_response("Could not process image content")
@@ -728,16 +765,31 @@ def _process_regular_file(file_data: bytes, file_type: FileType, file_name: str,
     """
     try:
         #get current language preference
-        current_language = redis_util.hget(f"user_preferences:{user_id}", "language")
+        current_language = get_language_preference(user_id)
         
         #process file content
         result = process_file_content(file_data, file_type, file_name)
         
         if result:
+            #profile the dataset once in the background, keyed by content hash
+            file_hash = file_profile.get_file_hash(file_data)
+            
+            #documents: keep pages in the page-indexed store, file_context only references them
+            pages = result.pop('pages', None)
+            if pages:
+                result['page_count'] = len(pages)
+                if not pdf_index.store_pages(file_hash, pages):
+                    #no page store to refer to, fall back to the full text in file_context
+                    result['data'] = '\n\n'.join(pages)
+                    result.pop('page_count')
+            
+            profile = file_profile.submit_profile(file_hash, dict(result, pages=pages) if pages else result)
+            
             #store file context in redis
             file_context = {
                 'file_name': file_name,
                 'file_type': file_type.name.lower(),
+                'file_hash': file_hash,
                 'processed_data': result,
                 'timestamp': time.time()
             }
@@ -753,13 +805,11 @@ def _process_regular_file(file_data: bytes, file_type: FileType, file_name: str,
                     file_context['full_data_available'] = True
                     file_context['is_large_dataset'] = True
                     
-                    #store full data for analysis
-                    redis_util.setex(f'full_file_context:{user_id}', 3600, json.dumps(file_context))
-                    
                     #create summary for conversation context
                     summary_context = {
                         'file_name': file_name,
                         'file_type': file_type.name.lower(),
+                        'file_hash': file_hash,
                         'processed_data': {
                             'type': 'tabular',
                             'rows': rows,
@@ -770,23 +820,26 @@ def _process_regular_file(file_data: bytes, file_type: FileType, file_name: str,
                         'is_summary': True
                     }
                     
-                    #store summary in conversation context
-                    redis_util.setex(f'file_context:{user_id}', 3600, json.dumps(summary_context))
+                    #store full data for analysis and the summary in conversation context, in one round trip
+                    redis_util.setex_many({
+                        f'full_file_context:{user_id}': file_context,
+                        f'file_context:{user_id}': summary_context,
+                    }, 3600)
                     
                     logger.info(f'[process_regular_file] Large dataset detected ({rows} rows), stored summary in conversation context')
                 else:
                     #for small datasets, store full data in conversation context
-                    redis_util.setex(f'file_context:{user_id}', 3600, json.dumps(file_context))
+                    _store_file_context(user_id, file_context)
             else:
                 #for non-tabular files, store normally
-                redis_util.setex(f'file_context:{user_id}', 3600, json.dumps(file_context))
+                _store_file_context(user_id, file_context)
             
             #get response with language preference
-            response = get_file_processing_response(file_type, file_name, result, current_language)
+            response = get_file_processing_response(file_type, file_name, result, current_language, profile)
             
             #update chat context with the file processing response
             chat_context = _get_chat_context(chat_id, user_id)
-            system_message = get_system_message(file_context, current_language)
+            system_message = get_system_message(file_context, current_language, profile)
             
             messages = [system_message]
             if chat_context:
@@ -810,6 +863,90 @@ def _process_regular_file(file_data: bytes, file_type: FileType, file_name: str,
 # Context storage configuration
 USE_HASH_STORAGE = False  # Disabled - using string-based storage
 
+def _store_file_context(user_id: str, file_context: dict):
+    """Store the file context of a file without separate full data, dropping the full data left by a previous large file"""
+    redis_util.batch() \
+        .setex(f'file_context:{user_id}', 3600, file_context) \
+        .delete(f'full_file_context:{user_id}') \
+        .execute()
+
+def _parse_file_context(context_data, name: str, user_id: str) -> Optional[dict]:
+    """File contexts are stored as dictionaries, older keys hold a JSON string inside JSON which is decoded here"""
+    if not context_data:
+        return None
+    if isinstance(context_data, str):
+        try:
+            context_data = json.loads(context_data)
+        except json.JSONDecodeError:
+            logger.warning(f'[handle_text_message] Invalid JSON in {name} for user {user_id}')
+            return None
+    if not isinstance(context_data, dict):
+        logger.warning(f'[handle_text_message] Unexpected type for {name}: {type(context_data)}')
+        return None
+    return context_data
+
+def _language_cache_key(user_id: str) -> str:
+    return f'user_preferences:{user_id}:language'
+
+def get_language_preference(user_id: str) -> Optional[str]:
+    """
+    Get the user's language preference, from the in-process cache when possible (see util.local_cache) 
+    and otherwise from the user_preferences hash in Redis.
+
+    params:
+    - user_id (str): Unique identifier for the user
+
+    returns:
+    Returns "chinese", "english", or None if the user has not set a preference
+    """
+    return local_cache.get_or_load(_language_cache_key(user_id),
+                                   lambda: redis_util.hget(f"user_preferences:{user_id}", "language"))
+
+def _load_message_state(chat_id: str, user_id: str, language_preference: Optional[str] = None) -> Tuple[Optional[str], Optional[dict], Optional[dict], List[Dict]]:
+    """
+    Loads everything handle_text_message() needs from Redis in one pipelined round trip: the user's language 
+    preference (updated first when the message sets a new one, and skipped when it is cached in process), the file 
+    context, the full file context of a large dataset and the chat context. It replaces the separate hset/hget/get calls that used to run one after another 
+    for every message, and keeps the same fallback from user-specific to chat-wide context as _get_chat_context().
+
+    params:
+    - chat_id (str): Unique identifier for the chat session
+    - user_id (str): Unique identifier for the user sending the message
+    - language_preference (str, optional): Language preference detected in the message, stored before it is read back
+
+    returns:
+    Returns a tuple of (current language, file context, full file context, chat context list)
+    """
+    try:
+        language_key = _language_cache_key(user_id)
+        current_language = language_preference or local_cache.get(language_key)
+        b = redis_util.batch()
+        if language_preference:
+            b.hset(f"user_preferences:{user_id}", "language", language_preference)
+            local_cache.invalidate(language_key, batch=b)
+        elif current_language is local_cache.MISSING:
+            b.hget(f"user_preferences:{user_id}", "language")
+        b.get(f'file_context:{user_id}') \
+            .get(f'full_file_context:{user_id}') \
+            .get(f"chat_context:{chat_id}:{user_id}") \
+            .get(f"chat_context:{chat_id}")
+        results = b.execute()
+        file_context, full_file_context, user_context, chat_context = results[-4:]
+        if current_language is local_cache.MISSING:
+            current_language = results[0]
+        local_cache.put(language_key, current_language)
+        
+        context = user_context or chat_context or []
+        return (
+            current_language,
+            _parse_file_context(file_context, 'file_context', user_id),
+            _parse_file_context(full_file_context, 'full_file_context', user_id),
+            context if isinstance(context, list) else []
+        )
+    except Exception as e:
+        logger.error(f'[_load_message_state] Error: {str(e)}')
+        return language_preference, None, None, []
+
 def get_full_file_context_from_redis(user_id: str) -> Optional[dict]:
     """
     Get full file context from Redis for large dataset analysis.
@@ -901,12 +1038,9 @@ def _update_chat_context(chat_id: str, user_id: str, messages: List[Dict]):
         context_key = f"chat_context:{chat_id}:{user_id}"
         chat_context_key = f"chat_context:{chat_id}"
         
-        # Store the context with TTL (1 hour)
-        result1 = redis_util.setex(context_key, 3600, messages)
-        result2 = redis_util.setex(chat_context_key, 3600, messages)
-        
-        if not result1 or not result2:
-            logger.error(f"[CONTEXT] Failed to store context: result1={result1}, result2={result2}")
+        # Store the context with TTL (1 hour), both keys in one round trip
+        if not redis_util.setex_many({context_key: messages, chat_context_key: messages}, 3600):
+            logger.error(f"[CONTEXT] Failed to store context for {context_key}")
         
     except Exception as e:
         logger.error(f"Error updating chat context: {str(e)}")
@@ -1056,56 +1190,57 @@ def handle_copy_pasted_image(body, chat_id: str, user_id: str, msg_id: str) -> O
 # UTILITY FUNCTIONS
 # ============================================================================
 
+#uploads above this are spilled to disk before parsing, so pdf page workers open the file by path instead of
+#each receiving a pickled copy; derived from the download cap so the spill path is reachable
+INMEMORY_FILE_MAX_BYTES = file_client.MAX_DOWNLOAD_BYTES // 4
+
 def process_file_content(file_data: bytes, file_type: FileType, file_name: str) -> Optional[Dict]:
     """
     Low-level utility function that extracts and processes content from various file types (CSV, Excel, PDF). This function 
-    handles the actual file parsing and content extraction, creating temporary files and using appropriate libraries to read 
-    and analyze file content. It's the core utility that enables the bot to understand and work with different file formats. 
-    Called by _process_regular_file() to perform the actual file content extraction, this function is a utility that focuses 
-    solely on file parsing and content extraction, leaving higher-level concerns like context storage and response formatting 
-    to the calling functions. It's the foundation that enables file analysis capabilities.
+    handles the actual file parsing and content extraction, using appropriate libraries to read and analyze file content. 
+    Uploads up to INMEMORY_FILE_MAX_BYTES are parsed directly from the in-memory bytes, which avoids writing every upload 
+    to disk and reading it back; larger ones (up to the download cap) are spilled to a temporary file that is removed when 
+    parsing finishes. It's 
+    the core utility that enables the bot to understand and work with different file formats. Called by _process_regular_file() 
+    to perform the actual file content extraction, this function is a utility that focuses solely on file parsing and content 
+    extraction, leaving higher-level concerns like context storage and response formatting to the calling functions. It's the 
+    foundation that enables file analysis capabilities.
 
     params:
     - file_data (bytes): The raw binary data of the file to be processed
     - file_type (FileType): The enumerated type of the file (CSV, EXCEL, PDF, etc.)
-    - file_name (str): The name of the file being processed (used for temporary file creation)
+    - file_name (str): The name of the file being processed (used to tell xls from xlsx)
 
     returns:
     Returns a dictionary containing the processed file data and metadata, or None if processing fails
     """
     try:
-        #create a temporary file to store the content
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_type.name.lower()}') as temp_file:
-            temp_file.write(file_data)
-            temp_path = temp_file.name
-            
-        try:
-            #process different excel file types first, then get result
-            if file_type == FileType.EXCEL:
-                ext = file_name.split('.')[-1].lower()
-                if ext in ['xlsx', 'xls']:
-                    file_type_str = ext
-                else:
-                    logger.error(f"[process_file_content] File marked as Excel but has extension '{ext}': {file_name}")
-                    file_type_str = 'xlsx'
+        #process different excel file types first, then get result
+        if file_type == FileType.EXCEL:
+            ext = file_name.split('.')[-1].lower()
+            if ext in ['xlsx', 'xls']:
+                file_type_str = ext
             else:
-                file_type_str = file_type.name.lower()
-            
-            result = openai_client.process_file(temp_path, file_type_str)
-            
-            #clean up the temporary file
-            os.unlink(temp_path)
-            
-            if result.get('error'):
-                logger.error(f'Error processing file content: {result["error"]}')
-                return None
-                
-            return result
+                logger.error(f"[process_file_content] File marked as Excel but has extension '{ext}': {file_name}")
+                file_type_str = 'xlsx'
+        else:
+            file_type_str = file_type.name.lower()
+        
+        if len(file_data) <= INMEMORY_FILE_MAX_BYTES:
+            result = openai_client.process_file(file_data, file_type_str)
+        else:
+            #spill large uploads to disk, the file is deleted when the with block exits
+            logger.info(f'[process_file_content] Spilling {len(file_data)} bytes to disk for {file_name}')
+            with tempfile.NamedTemporaryFile(suffix=f'.{file_type_str}') as temp_file:
+                temp_file.write(file_data)
+                temp_file.flush()
+                result = openai_client.process_file(temp_file.name, file_type_str)
+        
+        if result.get('error'):
+            logger.error(f'Error processing file content: {result["error"]}')
+            return None
             
-        finally:
-            #ensure temp file is cleaned up even if processing fails
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        return result
                 
     except Exception as e:
         logger.error(f'Error in process_file_content: {str(e)}')
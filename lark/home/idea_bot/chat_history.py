@@ -1,11 +1,18 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from django.utils import timezone
 from home.models import ChatMsg, ChatContext
+from home.services import chat_persister, context_reaper
+from lark.settings import CHAT_CONTEXT_PARTITIONED
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+#columns returned by get_chat_history_page, the msg json is the only large one; msg is not in
+#idx_chat_deleted_id, so every returned row is also read from the primary key
+HISTORY_FIELDS = ('id', 'msg_id', 'direction', 'msg_type', 'user_id', 'msg', 'created_at')
+
 class ChatHistoryService:
     """
     Service class for managing chat history and context in the mySQL database,
@@ -19,10 +26,14 @@ class ChatHistoryService:
     @staticmethod
     def save_message(msg_id: str, direction: str, msg_type: str, chat_type: str, 
                     chat_id: str, user_id: str, content: Dict, 
-                    parent_id: str = '', root_id: str = '') -> ChatMsg:
-        """Save a chat message using the existing ChatMsg model"""
-        logger.info(f"[KIBANA] Saving message: chat_id={chat_id}, msg_id={msg_id}, user_id={user_id}, direction={direction}, msg_type={msg_type}, chat_type={chat_type}, parent_id={parent_id}, root_id={root_id}, content={content}")
-        return ChatMsg.objects.create(
+                    parent_id: str = '', root_id: str = '', sync: bool = False) -> ChatMsg:
+        """
+        Save a chat message using the existing ChatMsg model. The insert is done in the background by
+        chat_persister and the returned message has no id until it is flushed; with sync=True it is
+        inserted before returning and has its id.
+        """
+        logger.info(f"[KIBANA] Saving message: chat_id={chat_id}, msg_id={msg_id}, user_id={user_id}, direction={direction}, msg_type={msg_type}, chat_type={chat_type}, parent_id={parent_id}, root_id={root_id}, content_size={len(str(content))}")
+        msg = ChatMsg(
             msg_id=msg_id,
             direction=direction,
             msg_type=msg_type,
@@ -39,15 +50,46 @@ class ChatHistoryService:
             dev_mode=0,
             chat_bot='default'
         )
+        return chat_persister.save(msg, sync=sync)
 
     @staticmethod
     def get_chat_history(chat_id: str, limit: int = 10) -> List[ChatMsg]:
-        """Get chat history for a specific chat"""
+        """Get chat history for a specific chat, newest first, including messages chat_persister has not written yet"""
         logger.info(f"[KIBANA] Getting chat history: chat_id={chat_id}, limit={limit}")
-        return ChatMsg.objects.filter(
+        rows = list(ChatMsg.objects.filter(
             chat_id=chat_id,
             deleted=0
-        ).order_by('-created_at')[:limit]
+        ).order_by('-id')[:limit])
+        pending = chat_persister.pending(chat_id)
+        if not pending:
+            return rows
+        #a message may be written between the query and the snapshot of the buffer
+        saved = {row.msg_id for row in rows}
+        return ([msg for msg in reversed(pending) if msg.msg_id not in saved] + rows)[:limit]
+
+    @staticmethod
+    def get_chat_history_page(chat_id: str, before_id: Optional[int] = None, limit: int = 20,
+                              fields: Tuple[str, ...] = HISTORY_FIELDS) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Get one page of chat history, newest first, paginated by keyset on (chat_id, id): the next page
+        is requested with the cursor returned by this one instead of an offset, so every page seeks into
+        idx_chat_deleted_id and reads limit + 1 entries in index order however deep it is. The index is
+        not covering, each of those rows costs one primary key lookup for the requested columns.
+        Messages still buffered by chat_persister show up once they are written.
+
+        Returns the rows as dicts and the cursor of the next page (None on the last page)
+        """
+        #a page of zero rows would return the last row of the previous page as its cursor
+        limit = max(1, limit)
+        logger.info(f"[KIBANA] Getting chat history page: chat_id={chat_id}, before_id={before_id}, limit={limit}")
+        query = ChatMsg.objects.filter(chat_id=chat_id, deleted=0)
+        if before_id is not None:
+            query = query.filter(id__lt=before_id)
+        fields = tuple(fields) if 'id' in fields else ('id',) + tuple(fields)
+        rows = list(query.order_by('-id').values(*fields)[:limit + 1])
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1]['id']
+        return rows, None
 
     @staticmethod
     def save_context(user_id: str, context_key: str, 
@@ -57,6 +99,8 @@ class ChatHistoryService:
         expires_at = None
         if ttl_minutes:
             expires_at = timezone.now() + timedelta(minutes=ttl_minutes)
+        elif CHAT_CONTEXT_PARTITIONED:
+            expires_at = context_reaper.NO_EXPIRY
         
         return ChatContext.objects.create(
             user_id=user_id,
@@ -70,8 +114,11 @@ class ChatHistoryService:
         """Get chat context if it exists and hasn't expired"""
         logger.info(f"[KIBANA] Getting context: user_id={user_id}, context_key={context_key}")
         now = timezone.now()
-        return ChatContext.objects.filter(
+        start = time.perf_counter()
+        context = ChatContext.objects.filter(
             user_id=user_id,
             context_key=context_key,
             expires_at__gt=now
-        ).first()
\ No newline at end of file
+        ).first()
+        context_reaper.record_lookup((time.perf_counter() - start) * 1000)
+        return context
\ No newline at end of file
@@ -0,0 +1,283 @@
+import hashlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import tiktoken
+
+from home.idea_bot import openai_client, pdf_index
+from util import redis_util
+from util.log_util import logger
+from util.rate_limit import get_limiter
+
+ANALYSIS_MODEL = 'gpt-4'
+CHUNK_TOKEN_BUDGET = 3000  # data tokens per map prompt, leaves room for instructions and the answer
+CHUNK_CACHE_TTL = 3600  # same lifetime as file_context
+MAX_CHUNKS = 40
+PARTIAL_ANSWER_TOKENS = 500  # completion cap of a map or intermediate reduce answer
+REDUCE_TOKEN_BUDGET = 4000  # partial findings per reduce prompt, gpt-4 has an 8k context
+MAX_REDUCE_LEVELS = 4
+MAX_CONCURRENT_CHUNKS = 4
+MODEL_RPM = 60
+MODEL_TPM = 40000
+LARGE_DATASET_ROWS = 50  # rows above which the broker stores only a summary in file_context
+TEXT_INLINE_CHARS = 1000  # text above this is truncated by get_system_message
+
+encoding = tiktoken.encoding_for_model(ANALYSIS_MODEL)
+
+MAP_PROMPT = """You are idea_bot, a data analyst for Halara. You are looking at part {index} of {total} of the file "{file_name}".
+Answer the question using only this part. Report concrete findings (counts, sums, values, row references) that can be
+combined with the findings from the other parts, in no more than 300 words. If this part contains nothing relevant,
+reply "No relevant data"."""
+
+REDUCE_GROUP_PROMPT = """You are idea_bot, a data analyst for Halara. The file "{file_name}" was split into parts and each part
+was analyzed separately. Merge the partial findings below into combined findings for the question, in no more than 300 words:
+combine counts and totals, deduplicate repeated points and ignore parts without relevant data. Keep concrete numbers and row
+references, the result will be merged with the findings from the other parts."""
+
+REDUCE_PROMPT = """You are idea_bot, a data analyst for Halara. The file "{file_name}" was split into {total} parts and each part
+was analyzed separately. Merge the partial findings below into one complete answer to the question: combine counts and
+totals across parts, deduplicate repeated points and ignore parts without relevant data. Provide clear, actionable insights."""
+
+
+def _question_hash(question: str) -> str:
+    return hashlib.sha256(question.strip().lower().encode('utf-8')).hexdigest()[:16]
+
+
+def _chunk_key(file_hash: str, question_hash: str, language_preference: Optional[str], index) -> str:
+    return f'chunk_answer:{file_hash}:{question_hash}:{language_preference or "auto"}:{index}'
+
+
+def _language_instruction(language_preference: Optional[str]) -> str:
+    if language_preference == "chinese":
+        return " Respond in Chinese (简体中文)."
+    elif language_preference == "english":
+        return " Respond in English."
+    return ''
+
+
+def _pack(units: List[str], header: str, token_budget: int) -> List[str]:
+    """Greedily pack text units into chunks of at most token_budget tokens, each chunk starting with header"""
+    chunks, current, tokens = [], [], 0
+    header_tokens = len(encoding.encode(header)) if header else 0
+    for unit, unit_tokens in zip(units, (len(t) for t in encoding.encode_batch(units))):
+        if current and tokens + unit_tokens > token_budget:
+            chunks.append(header + ''.join(current))
+            current, tokens = [], header_tokens
+        if not current:
+            tokens = header_tokens
+        current.append(unit)
+        tokens += unit_tokens
+    if current:
+        chunks.append(header + ''.join(current))
+    return chunks
+
+
+def split_rows(columns: List[str], data: List, token_budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    Split tabular rows into token-budgeted chunks. Every chunk repeats the column header and keeps
+    the original row numbers, so findings from different chunks can be referenced and merged.
+
+    params:
+    - columns (List[str]): The dataset column names
+    - data (List): The dataset rows, as dictionaries keyed by column
+    - token_budget (int, optional): Maximum number of tokens per chunk
+
+    returns:
+    Returns a list of chunk texts
+    """
+    header = f"Columns: {', '.join(str(c) for c in columns)}\n"
+    units = []
+    for i, row in enumerate(data):
+        if isinstance(row, dict):
+            row_parts = [f"{col}: {row.get(col, '')}" for col in columns]
+            units.append(f"{i+1}: {' | '.join(row_parts)}\n")
+        else:
+            units.append(f"{i+1}: {row}\n")
+    return _pack(units, header, token_budget)
+
+
+def split_text(text: str, token_budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    Split document text into token-budgeted chunks on paragraph boundaries.
+
+    params:
+    - text (str): The extracted document text
+    - token_budget (int, optional): Maximum number of tokens per chunk
+
+    returns:
+    Returns a list of chunk texts
+    """
+    units = []
+    for paragraph in text.split('\n\n'):
+        if not paragraph.strip():
+            continue
+        tokens = encoding.encode(paragraph)
+        #paragraphs longer than the budget are cut on token boundaries
+        for start in range(0, len(tokens), token_budget):
+            units.append(encoding.decode(tokens[start:start + token_budget]) + '\n\n')
+    return _pack(units, '', token_budget)
+
+
+def split_file_context(file_context: Dict, token_budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    Split the processed data of a file context into chunks.
+
+    params:
+    - file_context (Dict): The (full) file context stored at upload
+    - token_budget (int, optional): Maximum number of tokens per chunk
+
+    returns:
+    Returns a list of chunk texts, empty if the file has no analyzable content
+    """
+    processed_data = file_context.get('processed_data', {}) if isinstance(file_context, dict) else {}
+    if not isinstance(processed_data, dict):
+        return []
+    if processed_data.get('type') == 'tabular':
+        return split_rows(processed_data.get('columns', []), processed_data.get('data', []), token_budget)
+    if processed_data.get('type') == 'text':
+        #documents keep their pages in the page store, data is only a preview
+        if processed_data.get('page_count'):
+            pages = pdf_index.load_pages(file_context.get('file_hash'))
+            if pages:
+                return split_text('\n\n'.join(pages), token_budget)
+        return split_text(processed_data.get('data', ''), token_budget)
+    return []
+
+
+def needs_chunking(file_context: Dict) -> bool:
+    """Check if a file context is too large to be put in a single prompt (the same limits the system message applies)"""
+    processed_data = file_context.get('processed_data', {}) if isinstance(file_context, dict) else {}
+    if not isinstance(processed_data, dict):
+        return False
+    if processed_data.get('type') == 'tabular':
+        return processed_data.get('rows', 0) > LARGE_DATASET_ROWS
+    if processed_data.get('type') == 'text':
+        return processed_data.get('chars', len(processed_data.get('data', ''))) > TEXT_INLINE_CHARS
+    return False
+
+
+def _map_chunk(index: int, total: int, chunk: str, question: str, file_name: str, file_hash: str,
+               question_hash: str, language_preference: Optional[str]) -> Optional[str]:
+    cache_key = _chunk_key(file_hash, question_hash, language_preference, index)
+    if file_hash and (cached := redis_util.get(cache_key)):
+        return cached
+    messages = [
+        {"role": "system", "content": MAP_PROMPT.format(index=index+1, total=total, file_name=file_name) + _language_instruction(language_preference)},
+        {"role": "user", "content": f"{chunk}\n\nQuestion: {question}"}
+    ]
+    answer = _complete(messages, max_tokens=PARTIAL_ANSWER_TOKENS)
+    if answer and file_hash:
+        redis_util.setex(cache_key, CHUNK_CACHE_TTL, answer)
+    return answer
+
+
+def _complete(messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Optional[str]:
+    prompt_tokens = openai_client.num_tokens_from_messages(messages, ANALYSIS_MODEL)
+    get_limiter(ANALYSIS_MODEL, MODEL_RPM, MODEL_TPM).acquire(prompt_tokens + (max_tokens or 0))
+    return openai_client.chat_completion(messages, max_tokens=max_tokens)
+
+
+def _reduce_group(group: str, question: str, file_name: str, language_preference: Optional[str]) -> Optional[str]:
+    messages = [
+        {"role": "system", "content": REDUCE_GROUP_PROMPT.format(file_name=file_name) + _language_instruction(language_preference)},
+        {"role": "user", "content": f"Question: {question}\n\nPartial findings:\n{group}"}
+    ]
+    return _complete(messages, max_tokens=PARTIAL_ANSWER_TOKENS)
+
+
+def reduce_findings(partials: List[str], question: str, file_name: str, language_preference: Optional[str],
+                    token_budget: int = REDUCE_TOKEN_BUDGET) -> Optional[str]:
+    """
+    Merge partial findings until they fit in one reduce prompt. Findings are packed into groups of at most
+    token_budget tokens; while there is more than one group, each group is merged into one shorter finding
+    concurrently, and the merged findings are packed again.
+
+    params:
+    - partials (List[str]): The map answers in part order, empty answers are skipped
+    - question (str): The user's question
+    - file_name (str): The analyzed file, for the prompts
+    - language_preference (str, optional): User's preferred language ("chinese" or "english")
+    - token_budget (int, optional): Maximum number of finding tokens per reduce prompt
+
+    returns:
+    Returns the findings text for the final reduce prompt, or None if there are no findings
+    """
+    total = len(partials)
+    units = [f'[Part {i+1}/{total}]\n{p}\n\n' for i, p in enumerate(partials) if p]
+    for level in range(MAX_REDUCE_LEVELS):
+        if not units:
+            return None
+        groups = _pack(units, '', token_budget)
+        if len(groups) == 1:
+            return groups[0].strip()
+        logger.info(f'[chunk_analyzer] Reduce level {level+1}: {len(units)} findings in {len(groups)} groups')
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHUNKS) as pool:
+            merged = list(pool.map(lambda g: _reduce_group(g, question, file_name, language_preference), groups))
+        units = [f'[Group {i+1}/{len(groups)}]\n{m}\n\n' for i, m in enumerate(merged) if m]
+    if not units:
+        return None
+    # still too long after the last level, keep the findings that fit
+    groups = _pack(units, '', token_budget)
+    logger.warning(f'[chunk_analyzer] Findings still in {len(groups)} groups after {MAX_REDUCE_LEVELS} levels, using the first')
+    return groups[0].strip()
+
+
+def analyze(file_context: Dict, question: str, language_preference: Optional[str] = None) -> Optional[str]:
+    """
+    Answer a question about a large file with map-reduce. The file is split into token-budgeted chunks,
+    each chunk is asked the question concurrently under the shared model rate limit (map), then the partial
+    findings are merged into one answer (reduce). Chunk answers and the merged answer are cached by
+    (file hash, question hash), so asking the same question again is answered from Redis.
+
+    params:
+    - file_context (Dict): The (full) file context stored at upload
+    - question (str): The user's question
+    - language_preference (str, optional): User's preferred language ("chinese" or "english")
+
+    returns:
+    Returns the merged answer, or None if analysis fails
+    """
+    try:
+        file_name = file_context.get('file_name', 'Unknown')
+        file_hash = file_context.get('file_hash', '')
+        question_hash = _question_hash(question)
+        reduce_key = _chunk_key(file_hash, question_hash, language_preference, 'reduce')
+        if file_hash and (cached := redis_util.get(reduce_key)):
+            logger.info(f'[chunk_analyzer] Cache hit for {file_name}, question {question_hash}')
+            return cached
+
+        chunks = split_file_context(file_context)
+        if not chunks:
+            return None
+        if len(chunks) > MAX_CHUNKS:
+            logger.warning(f'[chunk_analyzer] {file_name} has {len(chunks)} chunks, analyzing the first {MAX_CHUNKS}')
+            chunks = chunks[:MAX_CHUNKS]
+        total = len(chunks)
+        logger.info(f'[chunk_analyzer] Analyzing {file_name} in {total} chunks')
+
+        # 1. map
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHUNKS) as pool:
+            futures = [pool.submit(_map_chunk, i, total, chunk, question, file_name, file_hash, question_hash, language_preference)
+                       for i, chunk in enumerate(chunks)]
+            partials = [f.result() for f in futures]
+        if total == 1:
+            return partials[0]
+
+        # 2. reduce, hierarchically when the findings do not fit in one prompt
+        findings = reduce_findings(partials, question, file_name, language_preference)
+        if not findings:
+            return None
+        messages = [
+            {"role": "system", "content": REDUCE_PROMPT.format(file_name=file_name, total=total) + _language_instruction(language_preference)},
+            {"role": "user", "content": f"Question: {question}\n\nPartial findings:\n{findings}"}
+        ]
+        answer = _complete(messages)
+        if answer and file_hash and all(partials):
+            redis_util.setex(reduce_key, CHUNK_CACHE_TTL, answer)
+        return answer
+
+    except Exception as e:
+        logger.error(f'[chunk_analyzer] Error: {str(e)}')
+        logger.error(f'[chunk_analyzer] Traceback: {traceback.format_exc()}')
+        return None
@@ -24,7 +24,8 @@ def get_file_info_from_msg(msg_id: str, file_key: str) -> dict:
     info_url = f'https://your-feishu-instance.com'
     params = {'type': 'file'}
     logger.info(f'[get_file_info] Trying files endpoint: {info_url}')
-    response = requests.get(info_url, headers=headers, params=params)
+    # body is left unread, see file_client.read_content
+    response = requests.get(info_url, headers=headers, params=params, stream=True)
     if not response or not response.ok:
         logger.error(f'[get_file_info] failed, resp: {response.text}')
     return response
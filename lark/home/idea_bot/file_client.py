@@ -5,6 +5,87 @@ from util.log_util import logger
 from home.idea_bot import client, meta
 from typing import Optional
 
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024  # same limit as CAPABILITIES['file_handling']['max_size']
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+#magic numbers of the formats idea_bot can handle, checked on the first chunk of a download
+CONTENT_SIGNATURES = [
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),  # xlsx
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),  # xls
+]
+#sniffed content types accepted for each expected kind of file
+EXPECTED_CONTENT_TYPES = {
+    'image': ('image/png', 'image/jpeg', 'image/gif', 'image/webp'),
+    'pdf': ('application/pdf',),
+    'excel': ('application/zip', 'application/x-ole-storage'),
+    'csv': ('text/plain', 'application/octet-stream', 'application/json'),  # csv exports are not always utf-8, and may start with a bracket
+}
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Guess the content type from the first bytes of a file"""
+    for signature, content_type in CONTENT_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.lstrip().startswith((b'{', b'[')):
+        return 'application/json'
+    try:
+        head[:1024].decode('utf-8')
+        return 'text/plain'
+    except UnicodeDecodeError:
+        #the first chunk may end inside a multi-byte character
+        try:
+            head[:1020].decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError:
+            return 'application/octet-stream'
+
+
+def read_content(response, expected: Optional[str] = None, max_bytes: int = MAX_DOWNLOAD_BYTES) -> Optional[bytes]:
+    """
+    Read a streamed download in chunks with a hard size cap. The download is rejected before the body
+    is read when Content-Length is over the cap, when the first chunk does not look like the expected kind
+    of file, or as soon as the streamed size goes over the cap, so oversized or wrong uploads never sit
+    fully in memory.
+
+    params:
+    - response: A requests response opened with stream=True
+    - expected (str, optional): Expected kind of file, a key of EXPECTED_CONTENT_TYPES ('image', 'pdf', 'excel', 'csv')
+    - max_bytes (int, optional): Maximum accepted size in bytes
+
+    returns:
+    Returns the file content, or None if the download was rejected
+    """
+    try:
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > max_bytes:
+            logger.warning(f'[read_content] Rejected download, Content-Length {content_length} > {max_bytes}')
+            return None
+        chunks, size = [], 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            if not chunk:
+                continue
+            if not chunks and expected:
+                sniffed = sniff_content_type(chunk)
+                if sniffed not in EXPECTED_CONTENT_TYPES.get(expected, (sniffed,)):
+                    logger.warning(f'[read_content] Rejected download, expected {expected} but got {sniffed}')
+                    return None
+            size += len(chunk)
+            if size > max_bytes:
+                logger.warning(f'[read_content] Rejected download, streamed size over {max_bytes} bytes')
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        response.close()
+
 def get_file_info(msg_id: str, file_key: str, file_name: str):
     """Get file information from Lark"""
     try:
@@ -70,8 +151,8 @@ def get_file_info(msg_id: str, file_key: str, file_name: str):
         logger.error(f'[get_file_info] Traceback: {traceback.format_exc()}')
         return None
 
-def download_file(file_key: str) -> Optional[bytes]:
-    """Download a file from Lark using idea_bot's credentials"""
+def download_file(file_key: str, expected: Optional[str] = None) -> Optional[bytes]:
+    """Download a file from Lark using idea_bot's credentials, streamed with a size cap (see read_content)"""
     try:
         # Get headers without content-type for file download
         headers = meta.get_headers(content_type=None)
@@ -106,8 +187,10 @@ def download_file(file_key: str) -> Optional[bytes]:
             logger.error(f'Response text: {response.text}')
             return None
             
-        # Read the entire response content
-        content = response.content
+        # Stream the response content with a size cap
+        content = read_content(response, expected)
+        if content is None:
+            return None
         
         logger.info(f'Successfully downloaded file content, size: {len(content)} bytes')
         return content
@@ -117,8 +200,8 @@ def download_file(file_key: str) -> Optional[bytes]:
         logger.error(f'Traceback: {traceback.format_exc()}')
         return None
 
-def get_file(file_key: str) -> dict:
-    """Download a file from Lark using idea_bot's credentials"""
+def get_file(file_key: str, expected: Optional[str] = None) -> dict:
+    """Download a file from Lark using idea_bot's credentials, streamed with a size cap (see read_content)"""
     try:
         # Get headers without content-type for file download
         headers = meta.get_headers(content_type=None)
@@ -165,8 +248,10 @@ def get_file(file_key: str) -> dict:
         # Get content type
         content_type = response.headers.get('Content-Type', '')
         
-        # Read the entire response content
-        content = response.content
+        # Stream the response content with a size cap
+        content = read_content(response, expected)
+        if content is None:
+            return None
         
         logger.info(f'Successfully downloaded file: {filename} ({content_type})')
         logger.info(f'Content size: {len(content)} bytes')
@@ -0,0 +1,269 @@
+import hashlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+import pandas as pd
+
+from util import redis_util
+from util.log_util import logger
+
+PROFILE_TTL = 3600  # same lifetime as file_context
+PROFILE_WAIT_SECONDS = 2  # how long the upload reply waits for a profile before going without it
+PROFILE_HISTOGRAM_BINS = 10
+PROFILE_TOP_VALUES = 5
+PROFILE_SAMPLE_ROWS = 5
+
+#profiles are computed off the handler thread, one small pool per process is enough
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='file_profile')
+
+
+def get_file_hash(file_data: bytes) -> str:
+    """
+    Get a stable content hash for an uploaded file. The hash is used as the cache key for the
+    dataset profile, so re-uploading the same file (or the same file under another name) reuses
+    the profile that was already computed.
+
+    params:
+    - file_data (bytes): The raw binary data of the uploaded file
+
+    returns:
+    Returns the sha256 hex digest of the file content
+    """
+    return hashlib.sha256(file_data).hexdigest()
+
+
+def _profile_key(file_hash: str) -> str:
+    return f'file_profile:{file_hash}'
+
+
+def _to_native(value: Any) -> Any:
+    """Convert numpy/pandas scalars into plain python values so the profile is JSON serializable"""
+    if value is None:
+        return None
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating,)):
+        return None if np.isnan(value) else round(float(value), 4)
+    if isinstance(value, (np.bool_,)):
+        return bool(value)
+    if isinstance(value, float):
+        return None if np.isnan(value) else round(value, 4)
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(value)
+    return value
+
+
+def _profile_numeric(series: pd.Series) -> Dict:
+    values = series.dropna().to_numpy(dtype=float)
+    if values.size == 0:
+        return {}
+    quantiles = np.percentile(values, [25, 50, 75])
+    counts, edges = np.histogram(values, bins=min(PROFILE_HISTOGRAM_BINS, max(1, np.unique(values).size)))
+    return {
+        'min': _to_native(values.min()),
+        'max': _to_native(values.max()),
+        'mean': _to_native(values.mean()),
+        'std': _to_native(values.std()),
+        'p25': _to_native(quantiles[0]),
+        'p50': _to_native(quantiles[1]),
+        'p75': _to_native(quantiles[2]),
+        'sum': _to_native(values.sum()),
+        'histogram': {
+            'counts': [int(c) for c in counts],
+            'edges': [_to_native(e) for e in edges],
+        },
+    }
+
+
+def _profile_categorical(series: pd.Series) -> Dict:
+    top = series.dropna().astype(str).value_counts().head(PROFILE_TOP_VALUES)
+    return {'top_values': [[str(k), int(v)] for k, v in top.items()]}
+
+
+def _profile_datetime(series: pd.Series) -> Dict:
+    values = series.dropna()
+    if values.empty:
+        return {}
+    return {'min': str(values.min()), 'max': str(values.max())}
+
+
+def profile_dataframe(df: pd.DataFrame) -> Dict:
+    """
+    Compute a compact statistical profile of a tabular dataset. Null counts and cardinalities are computed
+    for all columns at once, then each column gets type-specific statistics: min/max/mean/std/quartiles and a
+    histogram for numeric columns, min/max for datetime columns and the most frequent values for everything else.
+    A handful of sample rows is kept so the model still sees what a record looks like.
+
+    params:
+    - df (pd.DataFrame): The parsed dataset
+
+    returns:
+    Returns a JSON-serializable dictionary describing the dataset
+    """
+    null_counts = df.isna().sum()
+    unique_counts = df.nunique(dropna=True)
+    columns = []
+    for col in df.columns:
+        series = df[col]
+        info = {
+            'name': str(col),
+            'dtype': str(series.dtype),
+            'nulls': int(null_counts[col]),
+            'unique': int(unique_counts[col]),
+        }
+        if pd.api.types.is_bool_dtype(series):
+            info.update(_profile_categorical(series))
+        elif pd.api.types.is_numeric_dtype(series):
+            info.update(_profile_numeric(series))
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            info.update(_profile_datetime(series))
+        else:
+            info.update(_profile_categorical(series))
+        columns.append(info)
+
+    sample = df.head(PROFILE_SAMPLE_ROWS).astype(object).where(df.head(PROFILE_SAMPLE_ROWS).notna(), None)
+    return {
+        'type': 'tabular',
+        'rows': int(len(df)),
+        'column_count': int(len(df.columns)),
+        'columns': columns,
+        'sample_rows': [{str(k): _to_native(v) for k, v in row.items()} for row in sample.to_dict('records')],
+    }
+
+
+def profile_text(text: str) -> Dict:
+    """
+    Compute a compact profile of an extracted document (PDF text).
+
+    params:
+    - text (str): The extracted text content
+
+    returns:
+    Returns a JSON-serializable dictionary describing the document
+    """
+    words = text.split()
+    lines = [line for line in text.splitlines() if line.strip()]
+    return {
+        'type': 'text',
+        'chars': len(text),
+        'words': len(words),
+        'lines': len(lines),
+        'excerpt': text[:300],
+    }
+
+
+def build_profile(result: Dict) -> Optional[Dict]:
+    """
+    Build a profile from the output of process_file_content (see openai_client.process_file).
+
+    params:
+    - result (Dict): The processed file data, either tabular ('data' is a list of records) or text
+
+    returns:
+    Returns the profile dictionary, or None if the result type cannot be profiled
+    """
+    if result.get('type') == 'tabular':
+        df = pd.DataFrame.from_records(result.get('data', []), columns=result.get('columns') or None)
+        return profile_dataframe(df)
+    if result.get('type') == 'text':
+        #documents pass their pages, data then only holds a preview
+        pages = result.get('pages')
+        return profile_text('\n\n'.join(pages) if pages else result.get('data', ''))
+    return None
+
+
+def _build_and_store(file_hash: str, result: Dict) -> Optional[Dict]:
+    try:
+        profile = build_profile(result)
+        if profile is not None:
+            redis_util.setex(_profile_key(file_hash), PROFILE_TTL, profile)
+        return profile
+    except Exception as e:
+        logger.error(f'[file_profile] Error building profile for {file_hash}: {str(e)}')
+        logger.error(f'[file_profile] Traceback: {traceback.format_exc()}')
+        return None
+
+
+def get_profile(file_hash: Optional[str]) -> Optional[Dict]:
+    """
+    Get a cached profile by file hash.
+
+    params:
+    - file_hash (str): The content hash returned by get_file_hash
+
+    returns:
+    Returns the cached profile dictionary, or None if it is missing or not computed yet
+    """
+    if not file_hash:
+        return None
+    profile = redis_util.get(_profile_key(file_hash))
+    return profile if isinstance(profile, dict) else None
+
+
+def submit_profile(file_hash: str, result: Dict, wait: float = PROFILE_WAIT_SECONDS) -> Optional[Dict]:
+    """
+    Profile an uploaded file once in the background worker and cache the result under its hash. A cached
+    profile is returned immediately; otherwise the job is submitted and the caller waits at most `wait`
+    seconds so the upload reply can include the profile when it is cheap to compute. Slower profiles keep
+    running and land in Redis for later questions.
+
+    params:
+    - file_hash (str): The content hash returned by get_file_hash
+    - result (Dict): The processed file data returned by process_file_content
+    - wait (float, optional): Seconds to wait for the background job, 0 to not wait at all
+
+    returns:
+    Returns the profile dictionary if available within the wait budget, otherwise None
+    """
+    cached = get_profile(file_hash)
+    if cached:
+        logger.info(f'[file_profile] Reusing cached profile for {file_hash}')
+        return cached
+    future = _executor.submit(_build_and_store, file_hash, result)
+    if not wait:
+        return None
+    try:
+        return future.result(timeout=wait)
+    except FutureTimeoutError:
+        logger.info(f'[file_profile] Profile for {file_hash} still running after {wait}s, continuing without it')
+        return None
+
+
+def format_profile(profile: Dict, max_columns: int = 40) -> str:
+    """
+    Render a profile as compact text for a system prompt.
+
+    params:
+    - profile (Dict): The profile returned by build_profile
+    - max_columns (int, optional): Maximum number of columns to describe
+
+    returns:
+    Returns a multi-line string summary of the profile
+    """
+    if not profile:
+        return ''
+    if profile.get('type') == 'text':
+        return (f"Document: {profile.get('words', 0)} words, {profile.get('lines', 0)} lines, "
+                f"{profile.get('chars', 0)} characters")
+
+    lines: List[str] = [f"Dataset profile: {profile.get('rows', 0)} rows, {profile.get('column_count', 0)} columns"]
+    for col in profile.get('columns', [])[:max_columns]:
+        parts = [f"{col['name']} ({col['dtype']})", f"nulls={col['nulls']}", f"unique={col['unique']}"]
+        if 'mean' in col:
+            parts.append(f"min={col['min']} max={col['max']} mean={col['mean']} "
+                         f"std={col['std']} p25={col['p25']} p50={col['p50']} p75={col['p75']} sum={col['sum']}")
+            hist = col.get('histogram', {})
+            if hist.get('counts'):
+                parts.append(f"hist={hist['counts']} over [{hist['edges'][0]}, {hist['edges'][-1]}]")
+        elif 'top_values' in col:
+            top = ', '.join(f"{value}({count})" for value, count in col['top_values'])
+            parts.append(f"top: {top}")
+        elif 'min' in col:
+            parts.append(f"range: {col['min']} .. {col['max']}")
+        lines.append('- ' + '; '.join(parts))
+    hidden = len(profile.get('columns', [])) - max_columns
+    if hidden > 0:
+        lines.append(f'- ... {hidden} more columns')
+    return '\n'.join(lines)
@@ -1,15 +1,21 @@
 import os
-from typing import List, Dict, Optional, Any
-from openai import OpenAI
+from io import BytesIO
+from typing import List, Dict, Optional, Any, Union, BinaryIO, Tuple
 from datetime import datetime
 import tiktoken
 import json
+from util import openai_util
 from util.log_util import logger
 from home.gpt import meta as gpt_meta
 import traceback
 import base64
+from home.idea_bot import pdf_index
+from home.idea_bot.file_client import sniff_content_type
+from PIL import Image
 
 CHAT_CONTEXT_TTL = 3600  # 1 hour cache TTL
+IMAGE_MAX_SIDE = 2048  # the vision model downsamples larger images anyway
+IMAGE_JPEG_QUALITY = 85
 
 def get_openai_client():
     """
@@ -27,7 +33,7 @@ def get_openai_client():
         if not api_key:
             logger.error("OpenAI API key is not set")
             return None
-        return OpenAI(api_key=api_key)
+        return openai_util.get_client(api_key)
     except Exception as e:
         logger.error(f"Failed to initialize OpenAI client: {str(e)}")
         return None
@@ -125,16 +131,19 @@ Format the summary to clearly distinguish between context and conversation."""
         logger.error(f"Error summarizing conversation: {str(e)}")
         return messages[-5:]  # Fall back to just keeping last 5 messages
 
-def process_file(file_path: str, file_type: str, query: str = None) -> Dict[str, Any]:
+def process_file(source: Union[str, bytes, bytearray, memoryview, BinaryIO], file_type: str, query: str = None) -> Dict[str, Any]:
     """
     Process different types of files using appropriate methods. This function handles the extraction and 
     analysis of various file formats including CSV, Excel, and PDF files. It uses appropriate libraries (pandas 
     for tabular data, PyPDF2 for PDFs) to read and parse file content, returning structured data that can be used 
     for further analysis. For tabular files, it returns column information, row count, and data preview. For PDF 
-    files, it extracts text content. This function serves as the foundation for file analysis capabilities in the bot.
+    files, it extracts text content page by page (in a process pool for large documents, see pdf_index) and also 
+    returns the page list so it can be indexed. The source can be a path or the file content itself (bytes or a 
+    binary buffer), so uploads are parsed straight from memory without a temporary file. This function serves as 
+    the foundation for file analysis capabilities in the bot.
 
     params:
-    - file_path (str): The path to the file to be processed
+    - source (Union[str, bytes, bytearray, memoryview, BinaryIO]): The path to the file, or its raw content / binary buffer
     - file_type (str): The type of file (csv, xlsx, xls, pdf)
     - query (str, optional): Optional query parameter for future use
 
@@ -142,9 +151,14 @@ def process_file(file_path: str, file_type: str, query: str = None) -> Dict[str,
     Returns a dictionary containing processed file data and metadata, or an error dictionary if processing fails
     """
     try:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            #BytesIO over bytes shares the buffer instead of copying it
+            buffer = BytesIO(source)
+        else:
+            buffer = source
         if file_type.lower() in ['csv', 'xlsx', 'xls']:
             import pandas as pd
-            df = pd.read_csv(file_path) if file_type.lower() == 'csv' else pd.read_excel(file_path)
+            df = pd.read_csv(buffer) if file_type.lower() == 'csv' else pd.read_excel(buffer)
             return {
                 'type': 'tabular',
                 'data': df.to_dict('records'),
@@ -152,14 +166,20 @@ def process_file(file_path: str, file_type: str, query: str = None) -> Dict[str,
                 'rows': len(df)
             }
         elif file_type.lower() == 'pdf':
-            from PyPDF2 import PdfReader
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text()
+            #page workers need picklable input: a path or bytes
+            if isinstance(source, (bytes, str)):
+                pdf_source = source
+            elif isinstance(source, (bytearray, memoryview)):
+                pdf_source = bytes(source)
+            else:
+                pdf_source = source.read()
+            pages = pdf_index.extract_pages(pdf_source)
+            #the full text lives in the page store only (see pdf_index.store_pages), data keeps a preview
             return {
                 'type': 'text',
-                'data': text
+                'data': pdf_index.preview(pages),
+                'chars': sum(len(text) for text in pages) + 2 * max(len(pages) - 1, 0),
+                'pages': pages
             }
         else:
             raise ValueError(f"Unsupported file type: {file_type}")
@@ -168,7 +188,7 @@ def process_file(file_path: str, file_type: str, query: str = None) -> Dict[str,
         logger.error(f"Error processing file: {str(e)}")
         return {'error': str(e)}
 
-def chat_completion(messages: List[Dict[str, str]]) -> Optional[str]:
+def chat_completion(messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Optional[str]:
     """
     Get a chat completion from OpenAI with enhanced file analysis capabilities. This function sends 
     a conversation to OpenAI's GPT-4 model and retrieves a response. It uses optimized parameters for 
@@ -178,6 +198,7 @@ def chat_completion(messages: List[Dict[str, str]]) -> Optional[str]:
 
     params:
     - messages (List[Dict[str, str]]): List of message dictionaries containing the conversation history
+    - max_tokens (int, optional): Upper bound for the completion length, otherwise the rest of the context window
 
     returns:
     Returns the AI-generated response as a string, or None if an error occurs
@@ -190,6 +211,8 @@ def chat_completion(messages: List[Dict[str, str]]) -> Optional[str]:
         # Calculate message tokens to determine appropriate max_tokens
         message_tokens = num_tokens_from_messages(messages, "gpt-4")
         max_completion_tokens = max(100, 8192 - message_tokens - 100)  # Leave 100 tokens buffer
+        if max_tokens:
+            max_completion_tokens = min(max_completion_tokens, max_tokens)
         
         completion = client.chat.completions.create(
             model="gpt-4",
@@ -286,6 +309,38 @@ def test_vision_model_access():
         logger.error(f'[test_vision_model_access] Error listing models: {str(e)}')
         return False
 
+def prepare_image(image_content: bytes) -> Tuple[bytes, str]:
+    """
+    Downscale and re-encode an image before it is base64 encoded for the vision API. Images whose longer
+    side is over IMAGE_MAX_SIDE are resized and re-encoded as JPEG, which keeps phone photos and screenshots
+    to a few hundred KB instead of several MB of base64 in the request. Small images and images that cannot
+    be decoded are returned unchanged.
+
+    params:
+    - image_content (bytes): The raw binary data of the image
+
+    returns:
+    Returns a tuple of (image bytes, MIME type of those bytes)
+    """
+    mime_type = sniff_content_type(image_content[:16])
+    if not mime_type.startswith('image/'):
+        mime_type = 'image/jpeg'
+    try:
+        with Image.open(BytesIO(image_content)) as image:
+            if max(image.size) <= IMAGE_MAX_SIDE:
+                return image_content, mime_type
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = BytesIO()
+            image.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        logger.info(f'[prepare_image] Resized image from {len(image_content)} to {output.tell()} bytes')
+        return output.getvalue(), 'image/jpeg'
+    except Exception as e:
+        logger.warning(f'[prepare_image] Could not resize image, sending it as is: {str(e)}')
+        return image_content, mime_type
+
+
 def process_image(image_content: bytes, prompt: str = "Analyze this image and provide insights:") -> str:
     """
     Process an image using GPT-4 Vision. This function handles the complete image analysis workflow using OpenAI's GPT-4 Vision API. It validates image size limits, converts the image to base64 format for API transmission, and creates the appropriate message structure for vision analysis. The function uses the gpt-4.1 model for enhanced visual understanding and provides comprehensive logging throughout the process. It returns detailed analysis and insights about the image content, enabling the bot to understand and describe visual information.
@@ -300,16 +355,15 @@ def process_image(image_content: bytes, prompt: str = "Analyze this image and pr
     try:
         logger.info(f'[process_image] Starting image processing with prompt: {prompt}')
         logger.info(f'[process_image] Image content size: {len(image_content)} bytes')
-        logger.info(f'[process_image] First few bytes of image: {image_content[:100]}') 
         #check image size 
         if len(image_content) > 20 * 1024 * 1024:
             logger.error(f'[process_image] Image too large: {len(image_content)} bytes')
             return "Sorry, the image is too large. Maximum size is 20MB."
         
-        #convert image to base64
+        #downscale, then convert image to base64
+        image_content, mime_type = prepare_image(image_content)
         image_base64 = base64.b64encode(image_content).decode('utf-8')
-        logger.info(f'[process_image] Successfully encoded image to base64')
-        logger.info(f'[process_image] First 100 chars of base64: {image_base64[:100]}') 
+        logger.info(f'[process_image] Successfully encoded {mime_type} image to base64: {len(image_base64)} chars')
         
         #create messages array with image
         messages = [
@@ -320,14 +374,13 @@ def process_image(image_content: bytes, prompt: str = "Analyze this image and pr
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
+                            "url": f"data:{mime_type};base64,{image_base64}"
                         }
                     }
                 ]
             }
         ]
         logger.info(f'[process_image] Created messages array with image')
-        logger.info(f'[process_image] Message structure: {json.dumps(messages, indent=2)}')  # Log full message structure
 
         #get completion from OpenAI
         logger.info(f'[process_image] Attempting to call OpenAI API with model: gpt-4.1')
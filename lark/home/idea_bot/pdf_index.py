@@ -0,0 +1,240 @@
+import math
+import multiprocessing
+import re
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from util import redis_util
+from util.log_util import logger
+
+PDF_CACHE_TTL = 3600  # same lifetime as file_context
+PARALLEL_MIN_PAGES = 8  # smaller documents are extracted in the calling thread
+PAGES_PER_TASK = 16
+MAX_WORKERS = 4
+BM25_K1 = 1.5
+BM25_B = 0.75
+RETRIEVE_TOP_K = 4
+RETRIEVE_MAX_CHARS = 6000  # roughly 1.5k tokens of page text in the system message
+TEXT_PREVIEW_CHARS = 1000  # document text kept in file_context, the pages stay in the page store
+
+PT_TERM = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]')
+STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'with', 'by', 'at', 'from', 'as', 'is', 'are',
+    'was', 'were', 'be', 'been', 'it', 'its', 'this', 'that', 'these', 'those', 'what', 'which', 'who', 'how',
+    'when', 'where', 'why', 'do', 'does', 'did', 'can', 'could', 'me', 'my', 'i', 'you', 'your', 'we', 'our',
+    'about', 'tell', 'show', 'give', 'please', 'file', 'document', 'pdf', 'page', 'pages',
+}
+
+_pool = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        #spawn fresh workers: forking this process copies locks held by the scheduler, persister and redis pool threads
+        _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _open_reader(source: Union[str, bytes]):
+    from io import BytesIO
+    from PyPDF2 import PdfReader
+    return PdfReader(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+
+
+def _extract_page_range(source: Union[str, bytes], start: int, end: int) -> List[Tuple[int, str]]:
+    """Worker: extract pages [start, end) from the document, runs in a pool process"""
+    reader = _open_reader(source)
+    return [(i, reader.pages[i].extract_text() or '') for i in range(start, end)]
+
+
+def iter_pages(source: Union[str, bytes]) -> Iterator[Tuple[int, str]]:
+    """
+    Extract the text of every PDF page, yielding (page index, text) as soon as each page range is done.
+    Large documents are split into page ranges extracted in a process pool, so parsing neither blocks
+    on the GIL nor holds the whole document text in one growing string; pages may arrive out of order.
+
+    params:
+    - source (Union[str, bytes]): A file path or the raw PDF bytes
+
+    returns:
+    Yields (page index, page text) tuples
+    """
+    page_count = len(_open_reader(source).pages)
+    if page_count < PARALLEL_MIN_PAGES:
+        yield from _extract_page_range(source, 0, page_count)
+        return
+    pool = _get_pool()
+    #in-memory documents are pickled to every task, so send them to each worker only once
+    pages_per_task = PAGES_PER_TASK if isinstance(source, str) else math.ceil(page_count / MAX_WORKERS)
+    futures = [pool.submit(_extract_page_range, source, start, min(start + pages_per_task, page_count))
+               for start in range(0, page_count, pages_per_task)]
+    for future in as_completed(futures):
+        yield from future.result()
+
+
+def extract_pages(source: Union[str, bytes]) -> List[str]:
+    """
+    Extract the text of every PDF page in page order.
+
+    params:
+    - source (Union[str, bytes]): A file path or the raw PDF bytes
+
+    returns:
+    Returns a list of page texts, index i holding page i+1
+    """
+    pages = {}
+    for index, text in iter_pages(source):
+        pages[index] = text
+    return [pages[i] for i in range(len(pages))]
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords, each CJK character counts as one token"""
+    return [term for term in PT_TERM.findall(text.lower()) if term not in STOPWORDS]
+
+
+def build_index(pages: List[str]) -> Dict:
+    """
+    Build a BM25 index over pages.
+
+    params:
+    - pages (List[str]): The page texts
+
+    returns:
+    Returns a JSON-serializable index with page lengths and term postings ([page, term frequency] pairs)
+    """
+    postings, lengths = {}, []
+    for page_no, text in enumerate(pages):
+        terms = tokenize(text)
+        lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            postings.setdefault(term, []).append([page_no, tf])
+    return {
+        'n': len(pages),
+        'avgdl': (sum(lengths) / len(lengths)) if lengths else 0,
+        'lengths': lengths,
+        'postings': postings,
+    }
+
+
+def search(index: Dict, query: str, top_k: int = RETRIEVE_TOP_K) -> List[Tuple[int, float]]:
+    """
+    Rank pages against a query with BM25.
+
+    params:
+    - index (Dict): The index returned by build_index
+    - query (str): The user's question
+    - top_k (int, optional): Maximum number of pages to return
+
+    returns:
+    Returns (page index, score) tuples with a positive score, best first
+    """
+    n, avgdl, lengths, postings = index.get('n', 0), index.get('avgdl', 0) or 1, index.get('lengths', []), index.get('postings', {})
+    scores = {}
+    for term in set(tokenize(query)):
+        plist = postings.get(term)
+        if not plist:
+            continue
+        idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+        for page_no, tf in plist:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[page_no] / avgdl)
+            scores[page_no] = scores.get(page_no, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return ranked[:top_k]
+
+
+def _pages_key(file_hash: str) -> str:
+    return f'pdf_pages:{file_hash}'
+
+
+def _index_key(file_hash: str) -> str:
+    return f'pdf_index:{file_hash}'
+
+
+def store_pages(file_hash: str, pages: List[str]) -> bool:
+    """
+    Store pages in the page-indexed store (a Redis hash keyed by page number) and their BM25 index.
+
+    params:
+    - file_hash (str): The content hash of the uploaded file
+    - pages (List[str]): The page texts
+
+    returns:
+    Returns True if stored successfully
+    """
+    try:
+        if not pages:
+            return False
+        redis_util.hset_many(_pages_key(file_hash), {str(i): text for i, text in enumerate(pages)})
+        redis_util.expire(_pages_key(file_hash), PDF_CACHE_TTL)
+        redis_util.setex(_index_key(file_hash), PDF_CACHE_TTL, build_index(pages))
+        logger.info(f'[pdf_index] Stored {len(pages)} pages and index for {file_hash}')
+        return True
+    except Exception as e:
+        logger.error(f'[pdf_index] Error storing pages for {file_hash}: {str(e)}')
+        logger.error(f'[pdf_index] Traceback: {traceback.format_exc()}')
+        return False
+
+
+def load_pages(file_hash: Optional[str]) -> List[str]:
+    """
+    Read all pages of a document back from the page store, for whole-document analysis.
+
+    params:
+    - file_hash (str): The content hash of the uploaded file
+
+    returns:
+    Returns the page texts in page order, empty if the pages are not stored (or expired)
+    """
+    if not file_hash:
+        return []
+    stored = redis_util.hgetall(_pages_key(file_hash))
+    return [str(stored[str(i)]) for i in range(len(stored)) if str(i) in stored]
+
+
+def preview(pages: List[str], max_chars: int = TEXT_PREVIEW_CHARS) -> str:
+    """The first max_chars characters of the document, without joining all pages"""
+    parts, size = [], 0
+    for text in pages:
+        if size >= max_chars:
+            break
+        parts.append(text[:max_chars - size])
+        size += len(parts[-1]) + 2
+    return '\n\n'.join(parts)[:max_chars]
+
+
+def retrieve(file_hash: Optional[str], query: str, top_k: int = RETRIEVE_TOP_K,
+             max_chars: int = RETRIEVE_MAX_CHARS) -> List[Dict]:
+    """
+    Retrieve the pages most relevant to a question. Only the matching pages are read back from the
+    page store, and they are cut to a total character budget so they fit in a system message.
+
+    params:
+    - file_hash (str): The content hash of the uploaded file
+    - query (str): The user's question
+    - top_k (int, optional): Maximum number of pages
+    - max_chars (int, optional): Maximum total characters of page text
+
+    returns:
+    Returns a list of {'page': page number (1-based), 'score': float, 'text': str}, best first; empty if nothing matches
+    """
+    if not file_hash:
+        return []
+    index = redis_util.get(_index_key(file_hash))
+    if not isinstance(index, dict):
+        return []
+    ranked = search(index, query, top_k)
+    if not ranked:
+        return []
+    texts = redis_util.hmget(_pages_key(file_hash), [str(page_no) for page_no, _ in ranked])
+    results, budget = [], max_chars
+    for (page_no, score), text in zip(ranked, texts):
+        if not text or budget <= 0:
+            continue
+        text = text[:budget]
+        budget -= len(text)
+        results.append({'page': page_no + 1, 'score': round(score, 3), 'text': text})
+    return results
@@ -1,4 +1,5 @@
 from home.idea_bot.version import get_version_info, get_capabilities, CAPABILITIES
+from home.idea_bot.file_profile import format_profile
 import json
 import logging
 
@@ -68,13 +69,34 @@ def get_intelligent_data_sample(data, max_rows=50):
     
     return sampled_data
 
-def get_system_message(file_context=None, language_preference=None):
+PROFILE_SAMPLE_ROWS = 10  # raw rows still shown next to a dataset profile
+
+
+def _format_rows(data, columns):
+    """Format data rows as numbered 'col: value' lines"""
+    data_summary = ''
+    for i, row in enumerate(data):
+        if isinstance(row, dict):
+            row_parts = []
+            for col in columns:
+                value = row.get(col, '')
+                row_parts.append(f"{col}: {value}")
+            data_summary += f"{i+1}: {' | '.join(row_parts)}\n"
+        else:
+            data_summary += f"{i+1}: {row}\n"
+    return data_summary
+
+def get_system_message(file_context=None, language_preference=None, profile=None, relevant_pages=None):
     """
     Get the system message with optional file context and language preference.
+    When a precomputed dataset profile is available it is embedded instead of the raw data sample,
+    and for documents the pages retrieved for the question replace the truncated beginning of the text.
     
     params:
     - file_context (dict, optional): Context information about uploaded files
     - language_preference (str, optional): User's preferred language ("chinese" or "english")
+    - profile (dict, optional): Precomputed profile of the uploaded file (see file_profile.build_profile)
+    - relevant_pages (list, optional): Pages retrieved for the question (see pdf_index.retrieve)
     
     returns:
     Returns a dictionary with role "system" and formatted content for OpenAI API
@@ -126,6 +148,19 @@ def get_system_message(file_context=None, language_preference=None):
                 data = processed_data.get('data', [])
                 logger.info(f'[get_system_message] Tabular data: {rows} rows, {len(columns)} columns, {len(data)} data entries')
                 
+                if profile and profile.get('type') == 'tabular':
+                    #the profile already covers every row, only a few raw rows are needed for shape
+                    data_to_include = data[:PROFILE_SAMPLE_ROWS]
+                    base_message += f"""
+
+File: {file_name} ({file_type})
+{format_profile(profile)}
+
+Sample rows:
+{_format_rows(data_to_include, columns)}"""
+                    logger.info(f'[get_system_message] Embedded dataset profile with {len(data_to_include)} sample rows, total length: {len(base_message)} characters')
+                    return {"role": "system", "content": base_message}
+
                 # Create a data summary with actual data for analysis
                 data_summary = f"""
 
@@ -178,7 +213,17 @@ Data:
                 
                 base_message += f"""
 
-File: {file_name} ({file_type})
+File: {file_name} ({file_type})"""
+                if profile and profile.get('type') == 'text':
+                    base_message += f"""
+{format_profile(profile)}"""
+                if relevant_pages:
+                    pages_text = '\n\n'.join(f"[Page {page['page']}]\n{page['text']}" for page in relevant_pages)
+                    base_message += f"""
+Relevant pages:
+{pages_text}"""
+                else:
+                    base_message += f"""
 Content: {text_content}"""
             
             else:
@@ -190,13 +235,15 @@ Data available for analysis"""
 
     return {"role": "system", "content": base_message}
 
-def get_analysis_system_message(file_context, language_preference=None):
+def get_analysis_system_message(file_context, language_preference=None, profile=None):
     """
     Get system message specifically for large dataset analysis.
+    When a precomputed dataset profile is available it replaces the full row dump.
     
     params:
     - file_context (dict): Complete file context with full dataset information
     - language_preference (str, optional): User's preferred language ("chinese" or "english")
+    - profile (dict, optional): Precomputed profile of the uploaded file (see file_profile.build_profile)
     
     returns:
     Returns a dictionary with role "system" and analysis-focused content for OpenAI API
@@ -236,6 +283,18 @@ def get_analysis_system_message(file_context, language_preference=None):
                 columns = processed_data.get('columns', [])
                 data = processed_data.get('data', [])
                 
+                if profile and profile.get('type') == 'tabular':
+                    #statistics come from the profile, rows are sampled to keep the prompt small
+                    data_to_include = get_intelligent_data_sample(data)
+                    base_message += f"""
+
+File: {file_name} ({file_type})
+{format_profile(profile)}
+
+Sample rows ({len(data_to_include)} of {rows}):
+{_format_rows(data_to_include, columns)}"""
+                    return {"role": "system", "content": base_message}
+                
                 # Include data for analysis
                 data_summary = f"""
 
@@ -263,12 +322,15 @@ Data:
 
     return {"role": "system", "content": base_message}
 
-def get_file_processing_response(file_type, file_name, result, language_preference=None):
-    """Get response for file processing results with language support"""
+def get_file_processing_response(file_type, file_name, result, language_preference=None, profile=None):
+    """Get response for file processing results with language support, including the dataset profile when ready"""
     if language_preference == "chinese":
-        return f"我已经分析了您的文件：{file_name}，可以回答任何相关问题。"
+        response = f"我已经分析了您的文件：{file_name}，可以回答任何相关问题。"
     else:
-        return f"I have analyzed your file: {file_name} and am ready to answer any questions regarding it."
+        response = f"I have analyzed your file: {file_name} and am ready to answer any questions regarding it."
+    if profile:
+        response += f"\n\n{format_profile(profile, max_columns=15)}"
+    return response
 
 def get_error_response(error_msg, include_version=True):
     """Get standardized error response"""
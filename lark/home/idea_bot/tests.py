@@ -0,0 +1,229 @@
+from unittest import mock
+
+import pandas as pd
+from django.test import SimpleTestCase
+
+from home.idea_bot import broker, chunk_analyzer, file_client, file_profile, pdf_index
+from home.idea_bot.enum import FileType
+
+
+class FileProfileTest(SimpleTestCase):
+
+    def test_profile_dataframe(self):
+        df = pd.DataFrame({
+            'qty': [1, 2, 3, None],
+            'color': ['red', 'blue', 'red', None],
+            'day': pd.to_datetime(['2026-01-01', '2026-01-03', None, '2026-01-02']),
+        })
+        profile = file_profile.profile_dataframe(df)
+        self.assertEqual((profile['rows'], profile['column_count']), (4, 3))
+        qty, color, day = profile['columns']
+        self.assertEqual((qty['nulls'], qty['unique'], qty['min'], qty['max'], qty['mean'], qty['sum']), (1, 3, 1.0, 3.0, 2.0, 6.0))
+        self.assertEqual(sum(qty['histogram']['counts']), 3)
+        self.assertEqual(color['top_values'], [['red', 2], ['blue', 1]])
+        self.assertEqual((day['min'][:10], day['max'][:10]), ('2026-01-01', '2026-01-03'))
+        self.assertEqual(len(profile['sample_rows']), 4)
+        self.assertIsNone(profile['sample_rows'][3]['color'])
+
+    def test_build_profile_text_from_pages(self):
+        #documents keep only a preview in data, the profile is built from all pages
+        profile = file_profile.build_profile({'type': 'text', 'data': 'preview', 'pages': ['one two', 'three\nfour']})
+        self.assertEqual((profile['words'], profile['lines'], profile['chars']), (4, 3, len('one two\n\nthree\nfour')))
+        self.assertIsNone(file_profile.build_profile({'type': 'image'}))
+
+    def test_submit_profile_reuses_cached(self):
+        cached = {'type': 'text', 'words': 1}
+        with mock.patch.object(file_profile.redis_util, 'get', return_value=cached), \
+                mock.patch.object(file_profile._executor, 'submit') as submit:
+            self.assertEqual(file_profile.submit_profile('h1', {'type': 'text', 'data': 'x'}), cached)
+        submit.assert_not_called()
+
+    def test_submit_profile_builds_and_stores(self):
+        with mock.patch.object(file_profile.redis_util, 'get', return_value=None), \
+                mock.patch.object(file_profile.redis_util, 'setex') as setex:
+            profile = file_profile.submit_profile('h2', {'type': 'tabular', 'columns': ['a'], 'data': [{'a': 1}, {'a': 3}]})
+        self.assertEqual(profile['rows'], 2)
+        setex.assert_called_once_with('file_profile:h2', file_profile.PROFILE_TTL, profile)
+
+    def test_format_profile(self):
+        profile = file_profile.profile_dataframe(pd.DataFrame({'qty': [1, 2], 'color': ['red', 'red']}))
+        text = file_profile.format_profile(profile, max_columns=1)
+        self.assertIn('Dataset profile: 2 rows, 2 columns', text)
+        self.assertIn('qty (int64)', text)
+        self.assertIn('- ... 1 more columns', text)
+
+
+class ChunkAnalyzerTest(SimpleTestCase):
+
+    def tokens(self, text):
+        return len(chunk_analyzer.encoding.encode(text))
+
+    def test_pack_respects_budget_and_order(self):
+        units = ['row {} with some words\n'.format(i) for i in range(200)]
+        budget = self.tokens(''.join(units[:10]))
+        chunks = chunk_analyzer._pack(units, 'Columns: a\n', budget + self.tokens('Columns: a\n'))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(c[len('Columns: a\n'):] for c in chunks), ''.join(units))
+        for chunk in chunks:
+            self.assertTrue(chunk.startswith('Columns: a\n'))
+            self.assertLessEqual(self.tokens(chunk), budget + self.tokens('Columns: a\n'))
+
+    def test_split_rows_keeps_row_numbers(self):
+        data = [{'a': i, 'b': 'x' * 20} for i in range(100)]
+        chunks = chunk_analyzer.split_rows(['a', 'b'], data, token_budget=200)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(c.startswith('Columns: a, b\n') for c in chunks))
+        self.assertIn('100: a: 99 | b: ', chunks[-1])
+
+    def test_split_text_cuts_long_paragraphs(self):
+        chunks = chunk_analyzer.split_text('word ' * 2000 + '\n\nshort', token_budget=300)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(self.tokens(c) <= 300 + 2 for c in chunks))
+        self.assertIn('short', chunks[-1])
+
+    def test_needs_chunking_uses_document_length(self):
+        text = {'processed_data': {'type': 'text', 'data': 'preview', 'chars': chunk_analyzer.TEXT_INLINE_CHARS + 1}}
+        self.assertTrue(chunk_analyzer.needs_chunking(text))
+        self.assertFalse(chunk_analyzer.needs_chunking({'processed_data': {'type': 'text', 'data': 'short'}}))
+        self.assertTrue(chunk_analyzer.needs_chunking({'processed_data': {'type': 'tabular', 'rows': 51}}))
+
+    def test_split_file_context_reads_stored_pages(self):
+        context = {'file_hash': 'h', 'processed_data': {'type': 'text', 'data': 'preview', 'page_count': 2}}
+        with mock.patch.object(chunk_analyzer.pdf_index, 'load_pages', return_value=['page one', 'page two']) as load:
+            chunks = chunk_analyzer.split_file_context(context)
+        load.assert_called_once_with('h')
+        self.assertEqual(chunks, ['page one\n\npage two\n\n'])
+
+    def test_chunk_key_includes_language(self):
+        self.assertNotEqual(chunk_analyzer._chunk_key('f', 'q', 'chinese', 0), chunk_analyzer._chunk_key('f', 'q', 'english', 0))
+        self.assertEqual(chunk_analyzer._chunk_key('f', 'q', None, 'reduce'), 'chunk_answer:f:q:auto:reduce')
+
+    def test_reduce_findings_fits_in_one_prompt(self):
+        with mock.patch.object(chunk_analyzer, '_reduce_group') as reduce_group:
+            findings = chunk_analyzer.reduce_findings(['a', None, 'b'], 'q', 'f.csv', None)
+        reduce_group.assert_not_called()
+        self.assertEqual(findings, '[Part 1/3]\na\n\n[Part 3/3]\nb')
+
+    def test_reduce_findings_merges_groups(self):
+        partials = ['finding {} '.format(i) * 40 for i in range(12)]
+        budget = self.tokens('[Part 1/12]\n{}\n\n'.format(partials[0])) * 3
+        with mock.patch.object(chunk_analyzer, '_reduce_group', return_value='merged') as reduce_group:
+            findings = chunk_analyzer.reduce_findings(partials, 'q', 'f.csv', None, token_budget=budget)
+        groups = reduce_group.call_count
+        self.assertGreater(groups, 1)
+        self.assertEqual(findings, '\n\n'.join('[Group {}/{}]\nmerged'.format(i + 1, groups) for i in range(groups)))
+
+    def test_reduce_findings_stops_after_max_levels(self):
+        partials = ['finding {} '.format(i) * 40 for i in range(12)]
+        budget = self.tokens('[Part 1/12]\n{}\n\n'.format(partials[0])) * 3
+        #merging never shrinks the findings, the first group is used after the last level
+        with mock.patch.object(chunk_analyzer, '_reduce_group', side_effect=lambda group, *args: group) as reduce_group:
+            findings = chunk_analyzer.reduce_findings(partials, 'q', 'f.csv', None, token_budget=budget)
+        self.assertGreaterEqual(reduce_group.call_count, chunk_analyzer.MAX_REDUCE_LEVELS)
+        self.assertTrue(findings.startswith('[Group 1/'))
+
+
+class PdfIndexTest(SimpleTestCase):
+
+    pages = [
+        'Revenue grew in the third quarter. Revenue by region is listed below.',
+        'The appendix lists office locations.',
+        '收入 增长',
+    ]
+
+    def test_tokenize_drops_stopwords_and_splits_cjk(self):
+        self.assertEqual(pdf_index.tokenize('What is the Revenue in Q3?'), ['revenue', 'q3'])
+        self.assertEqual(pdf_index.tokenize('收入增长'), ['收', '入', '增', '长'])
+
+    def test_search_ranks_matching_pages(self):
+        index = pdf_index.build_index(self.pages)
+        self.assertEqual((index['n'], index['lengths'][1]), (3, 4))
+        ranked = pdf_index.search(index, 'how did revenue grow by region')
+        self.assertEqual([page for page, _ in ranked], [0])
+        self.assertEqual([page for page, _ in pdf_index.search(index, '收入')], [2])
+        self.assertEqual(pdf_index.search(index, 'the document'), [])
+
+    def test_retrieve_reads_only_ranked_pages_within_budget(self):
+        index = pdf_index.build_index(self.pages)
+        with mock.patch.object(pdf_index.redis_util, 'get', return_value=index), \
+                mock.patch.object(pdf_index.redis_util, 'hmget', return_value=[self.pages[0]]) as hmget:
+            results = pdf_index.retrieve('h', 'revenue', max_chars=10)
+        hmget.assert_called_once_with('pdf_pages:h', ['0'])
+        self.assertEqual(results, [{'page': 1, 'score': results[0]['score'], 'text': self.pages[0][:10]}])
+        with mock.patch.object(pdf_index.redis_util, 'get', return_value=None):
+            self.assertEqual(pdf_index.retrieve('h', 'revenue'), [])
+
+    def test_load_pages_in_page_order(self):
+        with mock.patch.object(pdf_index.redis_util, 'hgetall', return_value={'1': 'two', '0': 'one'}):
+            self.assertEqual(pdf_index.load_pages('h'), ['one', 'two'])
+        self.assertEqual(pdf_index.load_pages(None), [])
+
+    def test_preview_stops_at_max_chars(self):
+        self.assertEqual(pdf_index.preview(['abcdef', 'ghij'], max_chars=9), 'abcdef\n\ng')
+        self.assertEqual(pdf_index.preview(['ab', 'cd']), 'ab\n\ncd')
+
+
+class ProcessFileContentTest(SimpleTestCase):
+
+    def test_small_uploads_parse_from_memory(self):
+        with mock.patch.object(broker.openai_client, 'process_file', return_value={'type': 'text'}) as process_file:
+            broker.process_file_content(b'%PDF-small', FileType.PDF, 'a.pdf')
+        self.assertEqual(process_file.call_args[0], (b'%PDF-small', 'pdf'))
+
+    def test_large_uploads_spill_to_disk(self):
+        data = b'x' * (broker.INMEMORY_FILE_MAX_BYTES + 1)
+        self.assertLess(len(data), broker.file_client.MAX_DOWNLOAD_BYTES)
+        seen = {}
+
+        def process_file(source, file_type):
+            with open(source, 'rb') as f:
+                seen['size'] = len(f.read())
+            return {'type': 'tabular'}
+
+        with mock.patch.object(broker.openai_client, 'process_file', side_effect=process_file):
+            self.assertEqual(broker.process_file_content(data, FileType.EXCEL, 'big.xlsx'), {'type': 'tabular'})
+        self.assertEqual(seen['size'], len(data))
+
+
+class FakeResponse:
+
+    def __init__(self, chunks, content_length=None):
+        self.chunks = chunks
+        self.headers = {'Content-Length': str(content_length)} if content_length else {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FileClientTest(SimpleTestCase):
+
+    def test_sniff_content_type(self):
+        self.assertEqual(file_client.sniff_content_type(b'%PDF-1.7'), 'application/pdf')
+        self.assertEqual(file_client.sniff_content_type(b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'image/webp')
+        self.assertEqual(file_client.sniff_content_type(b'  [1, 2]'), 'application/json')
+        self.assertEqual(file_client.sniff_content_type('名称,数量\n'.encode('utf-8')), 'text/plain')
+        self.assertEqual(file_client.sniff_content_type(b'\xff\xfe\x00bad'), 'application/octet-stream')
+
+    def test_read_content_joins_chunks(self):
+        response = FakeResponse([b'%PDF-1.7 ', b'', b'rest'])
+        self.assertEqual(file_client.read_content(response, 'pdf'), b'%PDF-1.7 rest')
+        self.assertTrue(response.closed)
+
+    def test_read_content_size_cap(self):
+        response = FakeResponse([b'abc'], content_length=100)
+        self.assertIsNone(file_client.read_content(response, max_bytes=10))
+        self.assertTrue(response.closed)
+        self.assertIsNone(file_client.read_content(FakeResponse([b'abcdef', b'ghijkl']), max_bytes=10))
+
+    def test_read_content_rejects_unexpected_kind(self):
+        self.assertIsNone(file_client.read_content(FakeResponse([b'%PDF-1.7']), 'image'))
+        self.assertEqual(file_client.read_content(FakeResponse([b'%PDF-1.7']), 'unknown'), b'%PDF-1.7')
+
+    def test_read_content_accepts_csv_starting_with_bracket(self):
+        data = b'[id],name\n1,a\n'
+        self.assertEqual(file_client.read_content(FakeResponse([data]), 'csv'), data)
+        self.assertEqual(broker.EXPECTED_CONTENT_KINDS[FileType.CSV], 'csv')
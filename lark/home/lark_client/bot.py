@@ -1,16 +1,20 @@
+import asyncio
 import json
 import traceback
 
+import httpx
 import requests
 
 from home.config import constant
 from home.lark_client import meta
+from util import loop_local
 from util.lark_util import Lark
 from util.log_util import logger
 
 
 RECEIVE_ID_TYPE_CHAT = 'chat_id'
 RECEIVE_ID_TYPE_USER = 'user_id'
+ASYNC_HTTP_TIMEOUT = 10
 
 
 def send_msg(receive_id_type, receive_id, msg_type, content, retry_max=2, headers=None):
@@ -36,6 +40,33 @@ def send_msg(receive_id_type, receive_id, msg_type, content, retry_max=2, header
     return None
 
 
+def _get_async_http() -> httpx.AsyncClient:
+    # one connection pool per event loop
+    return loop_local.get('lark:http', lambda: httpx.AsyncClient(timeout=ASYNC_HTTP_TIMEOUT))
+
+
+async def send_msg_async(receive_id_type, receive_id, msg_type, content, retry_max=2, headers=None):
+    if not headers:
+        headers = await asyncio.to_thread(meta.get_headers)
+    if headers is None:
+        return None
+    url = 'https://your-feishu-instance.com'
+    params = {'receive_id_type': receive_id_type}
+    data = {'receive_id': receive_id, 'content': json.dumps(content), 'msg_type': msg_type}
+    retry = 0
+    while retry < retry_max:
+        retry += 1
+        try:
+            resp = await _get_async_http().post(url, content=json.dumps(data), params=params, headers=headers)
+            if resp.is_success:
+                return resp.json()
+            logger.error('[send] error: {}, retry: {}'.format(resp.text, retry))
+        except:
+            logger.error('[lark send msg exception]: {}'.format(traceback.format_exc()))
+            await asyncio.to_thread(Lark(constant.LARK_CHAT_ID_P0).send_rich_text, 'lark send msg exception', traceback.format_exc())
+    return None
+
+
 def send_txt(receive_id_type, receive_id, text, headers=None):
     content = {'text': text}
     send_msg(receive_id_type, receive_id, 'text', content, headers=headers)
@@ -1,7 +1,7 @@
-from home.lark_client.bot import send_msg
+from home.lark_client.bot import send_msg, send_msg_async
 
 
-def reply_text(chat_id, user_id, text, title=None, headers=None):
+def _build_reply(chat_id, user_id, text, title=None):
     receive_id_type = ''
     receive_id = ''
     if chat_id:
@@ -25,6 +25,14 @@ def reply_text(chat_id, user_id, text, title=None, headers=None):
                         ]
                     ]
                 }}
+    return receive_id_type, receive_id, content_type, content
+
 
+def reply_text(chat_id, user_id, text, title=None, headers=None):
+    receive_id_type, receive_id, content_type, content = _build_reply(chat_id, user_id, text, title)
     return send_msg(receive_id_type, receive_id, content_type, content, headers=headers)
 
+
+async def reply_text_async(chat_id, user_id, text, title=None, headers=None):
+    receive_id_type, receive_id, content_type, content = _build_reply(chat_id, user_id, text, title)
+    return await send_msg_async(receive_id_type, receive_id, content_type, content, headers=headers)
@@ -46,7 +46,7 @@ class ChatMsg(models.Model):
         db_table = 'chat_msg'
         indexes = [
             models.Index(fields=['user_id'], name='idx_user_id'),
-            models.Index(fields=['chat_id'], name='idx_chat_id'),
+            models.Index(fields=['chat_id', 'deleted', 'id'], name='idx_chat_deleted_id'),
             models.Index(fields=['msg_parent_id'], name='idx_msg_parent_id'),
             models.Index(fields=['msg_root_id'], name='idx_msg_root_id'),
             models.Index(fields=['created_at'], name='idx_created_at')
@@ -210,6 +210,18 @@ class ObserverArchive(models.Model):
         unique_together = (('archive_type', 'archive_name', 'record_count'),)
 
 
+class ObserverArchiveReview(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    digest = models.CharField(max_length=64)
+    seq = models.IntegerField()
+    data = models.JSONField(blank=True, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'observer_archive_review'
+        unique_together = (('digest', 'seq'),)
+
+
 class LarkPoll(models.Model):
     id = models.BigAutoField(primary_key=True)
     poll_type = models.CharField(max_length=32)
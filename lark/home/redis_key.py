@@ -7,3 +7,14 @@ def lock_chatgpt_review_run(user_id):
 def lock_chatgpt_review_merge(user_id):
     return 'lock:chatgpt:review:merge:{}'.format(user_id)
 
+
+def gpt_embedding(model, text_hash):
+    return 'gpt:embedding:{}:{}'.format(model, text_hash)
+
+
+def gpt_token_counts(reviews_digest):
+    return 'gpt:tokens:reviews:{}'.format(reviews_digest)
+
+
+def gpt_review_check(point_hash):
+    return 'gpt:review:check:{}'.format(point_hash)
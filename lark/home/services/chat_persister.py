@@ -0,0 +1,159 @@
+import atexit
+import threading
+import time
+import traceback
+from collections import deque
+from typing import List, Optional
+
+from django.db import close_old_connections
+
+from home.models import ChatMsg
+from util.log_util import logger
+
+FLUSH_BATCH_SIZE = 100  # flush as soon as this many messages are buffered
+FLUSH_INTERVAL = 1.0  # seconds a message may wait in the buffer
+MAX_PENDING = 10000  # oldest messages are dropped beyond this while the database is down
+RETRY_BACKOFF_MAX = 30.0
+
+
+class ChatMsgPersister:
+    """
+    Write-behind persister for ChatMsg rows. Request threads only append to an in-memory buffer;
+    a background thread writes the buffer with one bulk_create when FLUSH_BATCH_SIZE messages are
+    waiting or FLUSH_INTERVAL seconds have passed. Inserts ignore conflicts on the unique msg_id,
+    so a retried batch or a redelivered message is written once. Whatever is buffered is drained
+    when the process exits.
+
+    Contract: a queued message has no id until it is flushed, and readers that must see it before
+    then ask pending() / is_pending(). A hard crash (SIGKILL, OOM) skips the exit drain and loses
+    what is buffered, normally at most FLUSH_INTERVAL seconds of messages, more while the database
+    is down; writes that must not be lost use save(msg, sync=True).
+    """
+
+    def __init__(self, batch_size: int = FLUSH_BATCH_SIZE, interval: float = FLUSH_INTERVAL,
+                 max_pending: int = MAX_PENDING):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._buffer = deque()
+        self._inflight = []  # batch being written, still visible to pending()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self._backoff = 0.0
+
+    def save(self, msg: ChatMsg):
+        """Queue a message for insert, returns immediately"""
+        with self._cond:
+            if self._stopped:
+                # shutting down, write through
+                try:
+                    self._write([msg])
+                except Exception:
+                    logger.error('[chat persister] write msg {} error: {}'.format(msg.msg_id, traceback.format_exc()))
+                return
+            self._buffer.append(msg)
+            if len(self._buffer) > self.max_pending:
+                dropped = self._buffer.popleft()
+                logger.error('[chat persister] buffer full, drop msg {}'.format(dropped.msg_id))
+            if len(self._buffer) >= self.batch_size and not self._backoff:
+                self._cond.notify()
+            self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='chat_persister', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # while the database is failing, wait out the backoff even with a full buffer
+                if self._backoff or len(self._buffer) < self.batch_size:
+                    self._cond.wait(timeout=self._backoff or self.interval)
+                if self._stopped:
+                    return
+            self.flush()
+
+    def _take(self) -> List[ChatMsg]:
+        with self._cond:
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            self._inflight = batch
+            return batch
+
+    def pending(self, chat_id: Optional[str] = None) -> List[ChatMsg]:
+        """Messages saved but not written yet, oldest first, optionally only those of one chat"""
+        with self._cond:
+            msgs = self._inflight + list(self._buffer)
+        if chat_id is not None:
+            msgs = [m for m in msgs if m.chat_id == chat_id]
+        return msgs
+
+    def is_pending(self, msg_id: str) -> bool:
+        return any(m.msg_id == msg_id for m in self.pending())
+
+    def _write(self, batch: List[ChatMsg]):
+        close_old_connections()
+        ChatMsg.objects.bulk_create(batch, batch_size=self.batch_size, ignore_conflicts=True)
+
+    def flush(self) -> int:
+        """Write everything buffered now, returns the number of messages written"""
+        written = 0
+        with self._flush_lock:
+            while batch := self._take():
+                try:
+                    self._write(batch)
+                    with self._cond:
+                        self._inflight = []
+                    written += len(batch)
+                    self._backoff = 0.0
+                except Exception:
+                    logger.error('[chat persister] write {} msgs error: {}'.format(len(batch), traceback.format_exc()))
+                    # put the batch back in order and retry later
+                    with self._cond:
+                        self._buffer.extendleft(reversed(batch))
+                        self._inflight = []
+                    self._backoff = min(RETRY_BACKOFF_MAX, max(1.0, self._backoff * 2))
+                    break
+        return written
+
+    def shutdown(self, timeout: float = 10.0):
+        """Stop the background thread and drain the buffer, retrying until timeout"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        deadline = time.monotonic() + timeout
+        while self._buffer and time.monotonic() < deadline:
+            if not self.flush():
+                time.sleep(0.5)
+        if self._buffer:
+            logger.error('[chat persister] exit with {} unsaved msgs: {}'.format(
+                len(self._buffer), [m.msg_id for m in self._buffer]))
+
+
+persister = ChatMsgPersister()
+atexit.register(persister.shutdown)
+
+
+def save(msg: ChatMsg, sync: bool = False) -> ChatMsg:
+    """
+    Queue a message for the background insert, it gets its id when flushed (see ChatMsgPersister).
+    With sync the row is inserted before returning and comes back with its id; a duplicate msg_id
+    then raises instead of being ignored.
+    """
+    if sync:
+        msg.save()
+    else:
+        persister.save(msg)
+    return msg
+
+
+def pending(chat_id: Optional[str] = None) -> List[ChatMsg]:
+    return persister.pending(chat_id)
+
+
+def is_pending(msg_id: str) -> bool:
+    return persister.is_pending(msg_id)
@@ -0,0 +1,138 @@
+import calendar
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from home.models import ChatContext
+from lark.settings import CHAT_CONTEXT_PARTITIONED
+from util.log_util import logger
+
+DB_ALIAS = 'chat_history'
+REAP_BATCH_SIZE = 1000  # rows per DELETE, keeps each transaction and its locks short
+REAP_MAX_BATCHES = 200  # per run, the rest is left for the next run
+REAP_PAUSE = 0.05  # seconds between batches, lets replication and other writers keep up
+PARTITION_DAYS_AHEAD = 7  # daily partitions created ahead of time
+PARTITION_GRACE_DAYS = 1  # partitions are dropped this long after their last expiry
+LOOKUP_SAMPLES = 1024
+#expiry of contexts without ttl in the partitioned layout, which has no NULL expires_at
+NO_EXPIRY = datetime(2038, 1, 19, 3, 14, 7, tzinfo=dt_timezone.utc)
+
+_lookups = deque(maxlen=LOOKUP_SAMPLES)
+_lookups_lock = threading.Lock()
+stats = {'runs': 0, 'reaped': 0, 'partitions_dropped': 0, 'last_run_at': None, 'last_reaped': 0, 'last_seconds': 0.0}
+
+
+def record_lookup(elapsed_ms: float):
+    """Record the latency of a ChatContext lookup (ChatHistoryService.get_context)"""
+    with _lookups_lock:
+        _lookups.append(elapsed_ms)
+
+
+def lookup_stats() -> dict:
+    with _lookups_lock:
+        samples = sorted(_lookups)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'p50': round(samples[len(samples) // 2], 2),
+        'p99': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2),
+        'max': round(samples[-1], 2),
+    }
+
+
+def reap_expired(batch_size: int = REAP_BATCH_SIZE, max_batches: int = REAP_MAX_BATCHES) -> int:
+    """
+    Delete expired contexts in bounded batches, oldest first. Each batch selects ids on the expires_at
+    index and deletes them by primary key, so no statement scans or locks more than batch_size rows.
+    Contexts without expires_at never expire and are kept.
+    """
+    now = timezone.now()
+    total = 0
+    for _ in range(max_batches):
+        ids = list(ChatContext.objects.filter(expires_at__lte=now).order_by('expires_at')
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        total += ChatContext.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            break
+        time.sleep(REAP_PAUSE)
+    return total
+
+
+def _partition_bounds(cursor) -> dict:
+    cursor.execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'chat_context' AND PARTITION_NAME IS NOT NULL")
+    return {name: desc for name, desc in cursor.fetchall()}
+
+
+def rotate_partitions() -> int:
+    """
+    For the daily-partitioned layout (home/db/20261019-chat_context_partition.sql): split the catch-all
+    partition to keep PARTITION_DAYS_AHEAD future days, and drop whole days whose contexts have all expired.
+    Dropping a partition is a metadata operation, much cheaper than deleting its rows.
+    Returns the number of partitions dropped.
+    """
+    dropped = 0
+    with connections[DB_ALIAS].cursor() as cursor:
+        bounds = _partition_bounds(cursor)
+        if not bounds:
+            logger.warning('[context reaper] chat_context is not partitioned, skip rotation')
+            return 0
+        today = datetime.utcnow().date()
+        highest = max((int(desc) for desc in bounds.values() if desc.isdigit()), default=0)
+        # 1. add missing future days, p{yyyymmdd} holds contexts expiring before the end of that (utc) day
+        if 'pmax' not in bounds:
+            # new days are split from pmax, without it contexts past the last day cannot be inserted
+            logger.error('[context reaper] chat_context has no pmax partition, skip adding days: {}'.format(sorted(bounds)))
+        for i in range(PARTITION_DAYS_AHEAD + 1 if 'pmax' in bounds else 0):
+            day = today + timedelta(days=i)
+            name = 'p{}'.format(day.strftime('%Y%m%d'))
+            upper = calendar.timegm(day.timetuple()) + 86400
+            if name in bounds or upper <= highest:
+                continue
+            cursor.execute("ALTER TABLE chat_context REORGANIZE PARTITION pmax INTO "
+                           "(PARTITION {} VALUES LESS THAN ({}), PARTITION pmax VALUES LESS THAN MAXVALUE)".format(name, upper))
+            highest = upper
+            logger.info('[context reaper] add partition {}'.format(name))
+        # 2. drop expired days
+        cutoff = calendar.timegm(today.timetuple()) - PARTITION_GRACE_DAYS * 86400
+        expired = sorted(name for name, desc in bounds.items() if desc.isdigit() and int(desc) <= cutoff)
+        if len(expired) == len(bounds):
+            # a table keeps at least one partition
+            expired = expired[:-1]
+        if expired:
+            cursor.execute("ALTER TABLE chat_context DROP PARTITION {}".format(', '.join(expired)))
+            dropped = len(expired)
+            logger.info('[context reaper] drop partitions {}'.format(expired))
+    return dropped
+
+
+def run():
+    """Scheduler entry: reap expired contexts (and rotate partitions if enabled), then log metrics"""
+    start = time.monotonic()
+    reaped, dropped = 0, 0
+    try:
+        close_old_connections()
+        if CHAT_CONTEXT_PARTITIONED:
+            dropped = rotate_partitions()
+        # rows of the current days are still reaped row by row in both layouts
+        reaped = reap_expired()
+    except Exception:
+        logger.error('[context reaper] exception: {}'.format(traceback.format_exc()))
+    finally:
+        close_old_connections()
+    elapsed = time.monotonic() - start
+    stats['runs'] += 1
+    stats['reaped'] += reaped
+    stats['partitions_dropped'] += dropped
+    stats.update(last_run_at=timezone.now().isoformat(), last_reaped=reaped, last_seconds=round(elapsed, 3))
+    logger.info('[context reaper] reaped {} rows, dropped {} partitions in {:.2f}s, total {}, lookup latency {}'.format(
+        reaped, dropped, elapsed, stats['reaped'], lookup_stats()))
+    return reaped
@@ -1,6 +1,15 @@
+import asyncio
+import calendar
 import json
+from datetime import datetime
+from unittest import mock
+
 import requests
-from home import meta
+from django.test import SimpleTestCase
+
+from home import meta, views_async
+from home.models import ChatMsg
+from home.services import chat_history, chat_persister, context_reaper
 
 
 def get_users():
@@ -64,3 +73,217 @@ def approval_approve(approval_code, instance_code, user_id, task_id):
     resp = requests.post(url, headers=headers, data=json.dumps(data))
     print(resp.text)
 
+
+def chat_msg(msg_id, chat_id='c1'):
+    return ChatMsg(msg_id=msg_id, chat_id=chat_id)
+
+
+class ChatPersisterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.persister = chat_persister.ChatMsgPersister(batch_size=2)
+        self.written = []
+        patchers = [mock.patch.object(self.persister, '_ensure_thread'),
+                    mock.patch.object(self.persister, '_write', side_effect=lambda batch: self.written.append(batch))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_flush_writes_in_batches(self):
+        for i in range(5):
+            self.persister.save(chat_msg(str(i)))
+        self.assertEqual(self.persister.flush(), 5)
+        self.assertEqual([[m.msg_id for m in batch] for batch in self.written], [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(self.persister.pending(), [])
+
+    def test_failed_batch_is_retried_in_order_with_backoff(self):
+        for i in range(3):
+            self.persister.save(chat_msg(str(i)))
+        self.persister._write.side_effect = OSError('database down')
+        self.assertEqual(self.persister.flush(), 0)
+        self.assertEqual(self.persister._backoff, 1.0)
+        self.persister.flush()
+        self.assertEqual(self.persister._backoff, 2.0)
+        self.assertEqual([m.msg_id for m in self.persister.pending()], ['0', '1', '2'])
+        self.persister._write.side_effect = lambda batch: self.written.append(batch)
+        self.assertEqual(self.persister.flush(), 3)
+        self.assertEqual(self.persister._backoff, 0.0)
+
+    def test_pending_includes_batch_being_written(self):
+        self.persister.save(chat_msg('a'))
+        self.persister.save(chat_msg('b', chat_id='c2'))
+        seen = []
+        self.persister._write.side_effect = lambda batch: seen.append(
+            ([m.msg_id for m in self.persister.pending('c1')], self.persister.is_pending('b')))
+        self.persister.flush()
+        self.assertEqual(seen, [(['a'], True)])
+        self.assertFalse(self.persister.is_pending('a'))
+
+    def test_buffer_drops_oldest_when_full(self):
+        self.persister.max_pending = 2
+        for i in range(3):
+            self.persister.save(chat_msg(str(i)))
+        self.assertEqual([m.msg_id for m in self.persister.pending()], ['1', '2'])
+
+    def test_shutdown_drains_buffer_then_writes_through(self):
+        for i in range(3):
+            self.persister.save(chat_msg(str(i)))
+        self.persister.shutdown(timeout=1)
+        self.assertEqual(sum(len(batch) for batch in self.written), 3)
+        self.persister.save(chat_msg('late'))
+        self.assertEqual(self.written[-1][0].msg_id, 'late')
+        self.assertEqual(self.persister.pending(), [])
+
+    def test_shutdown_retries_until_timeout(self):
+        self.persister.save(chat_msg('a'))
+        self.persister._write.side_effect = [OSError('database down'), None]
+        with mock.patch.object(chat_persister.time, 'sleep') as sleep:
+            self.persister.shutdown(timeout=5)
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual(self.persister.pending(), [])
+
+    def test_sync_save_inserts_now(self):
+        msg = mock.MagicMock()
+        with mock.patch.object(chat_persister, 'persister') as persister:
+            self.assertIs(chat_persister.save(msg, sync=True), msg)
+        msg.save.assert_called_once_with()
+        persister.save.assert_not_called()
+
+
+class ChatHistoryTest(SimpleTestCase):
+
+    def test_history_includes_unwritten_messages(self):
+        rows = [chat_msg('2'), chat_msg('1')]
+        with mock.patch.object(chat_history.ChatMsg, 'objects') as objects, \
+                mock.patch.object(chat_history.chat_persister, 'pending', return_value=[chat_msg('2'), chat_msg('3')]):
+            objects.filter.return_value.order_by.return_value.__getitem__.return_value = rows
+            history = chat_history.ChatHistoryService.get_chat_history('c1', limit=3)
+        self.assertEqual([m.msg_id for m in history], ['3', '2', '1'])
+
+    def test_history_page_cursor(self):
+        rows = [{'id': i} for i in (9, 8, 7)]
+        with mock.patch.object(chat_history.ChatMsg, 'objects') as objects:
+            query = objects.filter.return_value
+            query.filter.return_value.order_by.return_value.values.return_value.__getitem__.return_value = rows
+            page, cursor = chat_history.ChatHistoryService.get_chat_history_page('c1', before_id=10, limit=2, fields=('msg_id',))
+            query.filter.assert_called_once_with(id__lt=10)
+            query.filter.return_value.order_by.return_value.values.assert_called_once_with('id', 'msg_id')
+            query.filter.return_value.order_by.return_value.values.return_value.__getitem__.assert_called_once_with(slice(None, 3))
+        self.assertEqual((page, cursor), (rows[:2], 8))
+
+    def test_history_page_last_page_and_limit_clamp(self):
+        with mock.patch.object(chat_history.ChatMsg, 'objects') as objects:
+            values = objects.filter.return_value.order_by.return_value.values.return_value
+            values.__getitem__.return_value = [{'id': 5}]
+            self.assertEqual(chat_history.ChatHistoryService.get_chat_history_page('c1', limit=5), ([{'id': 5}], None))
+            values.__getitem__.return_value = [{'id': 5}, {'id': 4}]
+            self.assertEqual(chat_history.ChatHistoryService.get_chat_history_page('c1', limit=0), ([{'id': 5}], 5))
+            values.__getitem__.assert_called_with(slice(None, 2))
+
+
+def epoch(day):
+    return str(calendar.timegm(datetime.strptime(day, '%Y-%m-%d').timetuple()))
+
+
+class ContextReaperTest(SimpleTestCase):
+
+    def rotate(self, today, partitions):
+        with mock.patch.object(context_reaper, 'connections') as connections, \
+                mock.patch.object(context_reaper, 'datetime', wraps=datetime) as dt:
+            dt.utcnow.return_value = datetime.strptime(today, '%Y-%m-%d')
+            cursor = connections.__getitem__.return_value.cursor.return_value.__enter__.return_value
+            cursor.fetchall.return_value = partitions
+            dropped = context_reaper.rotate_partitions()
+        return dropped, [c[0][0] for c in cursor.execute.call_args_list[1:]]
+
+    def test_rotate_adds_days_ahead_after_deploy(self):
+        dropped, statements = self.rotate('2026-10-19', [('p0', epoch('2026-10-20')), ('pmax', 'MAXVALUE')])
+        self.assertEqual(dropped, 0)
+        self.assertEqual(len(statements), context_reaper.PARTITION_DAYS_AHEAD)
+        self.assertIn('PARTITION p20261020 VALUES LESS THAN ({})'.format(epoch('2026-10-21')), statements[0])
+        self.assertTrue(all('REORGANIZE PARTITION pmax' in statement for statement in statements))
+
+    def test_rotate_drops_expired_days(self):
+        partitions = [('p0', epoch('2026-10-20')), ('p20261020', epoch('2026-10-21')), ('p20261021', epoch('2026-10-22')),
+                      ('pmax', 'MAXVALUE')]
+        dropped, statements = self.rotate('2026-10-22', partitions)
+        self.assertEqual(dropped, 2)
+        self.assertEqual(statements[-1], 'ALTER TABLE chat_context DROP PARTITION p0, p20261020')
+
+    def test_rotate_without_pmax_only_drops(self):
+        partitions = [('p0', epoch('2026-10-20')), ('p20261026', epoch('2026-10-27'))]
+        dropped, statements = self.rotate('2026-10-25', partitions)
+        self.assertEqual((dropped, statements), (1, ['ALTER TABLE chat_context DROP PARTITION p0']))
+        # the last partition is kept even when it has expired
+        dropped, statements = self.rotate('2026-11-01', partitions)
+        self.assertEqual((dropped, statements), (1, ['ALTER TABLE chat_context DROP PARTITION p0']))
+
+    def test_rotate_skips_unpartitioned_table(self):
+        self.assertEqual(self.rotate('2026-10-19', []), (0, []))
+
+    def test_reap_expired_in_batches(self):
+        with mock.patch.object(context_reaper.ChatContext, 'objects') as objects, \
+                mock.patch.object(context_reaper.time, 'sleep') as sleep:
+            objects.filter.return_value.order_by.return_value.values_list.return_value.__getitem__.side_effect = [[1, 2], [3]]
+            objects.filter.return_value.delete.side_effect = [(2, {}), (1, {})]
+            self.assertEqual(context_reaper.reap_expired(batch_size=2), 3)
+        objects.filter.assert_any_call(id__in=[1, 2])
+        objects.filter.assert_any_call(id__in=[3])
+        sleep.assert_called_once_with(context_reaper.REAP_PAUSE)
+
+    def test_reap_expired_stops_after_max_batches(self):
+        with mock.patch.object(context_reaper.ChatContext, 'objects') as objects, \
+                mock.patch.object(context_reaper.time, 'sleep'):
+            objects.filter.return_value.order_by.return_value.values_list.return_value.__getitem__.return_value = [1, 2]
+            objects.filter.return_value.delete.return_value = (2, {})
+            self.assertEqual(context_reaper.reap_expired(batch_size=2, max_batches=3), 6)
+
+
+
+class FakeASGIRequest:
+
+    def __init__(self, data):
+        self.body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+
+
+class ViewsAsyncTest(SimpleTestCase):
+    private_msg = {'type': 'event_callback', 'event': {'type': 'message', 'chat_type': 'private', 'text_without_at_bot': 'hi'}}
+
+    def setUp(self):
+        patchers = [mock.patch.object(views_async, 'ASGIRequest', FakeASGIRequest),
+                    mock.patch.object(views_async, 'JsonResponse', side_effect=lambda data: data),
+                    mock.patch.object(views_async, 'sync_to_async', side_effect=lambda func: mock.AsyncMock(side_effect=func)),
+                    mock.patch.object(views_async.views, 'event', return_value='sync view'),
+                    mock.patch.object(views_async.broker_async, 'ask', new=mock.AsyncMock())]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, request):
+        async def run():
+            resp = await views_async.event(request)
+            # 等待后台任务结束
+            await asyncio.gather(*views_async._tasks)
+            return resp
+        return asyncio.run(run())
+
+    def test_private_message_answered_on_loop(self):
+        self.assertEqual(self.call(FakeASGIRequest(self.private_msg)), {})
+        views_async.broker_async.ask.assert_awaited_once_with(self.private_msg)
+        views_async.views.event.assert_not_called()
+
+    def test_other_events_go_to_sync_view(self):
+        group_msg = {'type': 'event_callback', 'event': {'type': 'message', 'chat_type': 'group', 'text_without_at_bot': 'hi'}}
+        for data in (group_msg, {'type': 'url_verification', 'challenge': 'x'}):
+            self.assertEqual(self.call(FakeASGIRequest(data)), 'sync view')
+        views_async.broker_async.ask.assert_not_awaited()
+
+    def test_not_served_by_asgi_falls_back_to_sync_view(self):
+        request = mock.MagicMock(body=json.dumps(self.private_msg).encode('utf-8'))
+        self.assertEqual(self.call(request), 'sync view')
+        views_async.views.event.assert_called_once_with(request)
+        views_async.broker_async.ask.assert_not_awaited()
+
+    def test_invalid_body(self):
+        self.assertEqual(self.call(FakeASGIRequest(b'not json')), {})
+        views_async.views.event.assert_not_called()
@@ -1,12 +1,13 @@
 from django.urls import path
 
-from . import views, views_bu, cron, views_api, views_idea
+from . import views, views_bu, cron, views_api, views_idea, views_async
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('page', views.index, name='index'),
     path('health/', views.health, name='health'),
     path('event', views.event, name='event'),
+    path('event/async', views_async.event, name='event-async'),
     path('approval/cs/submit', views_bu.cs_submit_approval, name='cs_submit_approval'),
     path('page/approval', views.approval_page, name='approval'),
     path('ajax-check-approval', views.ajax_check_approval, name='check-approval'),
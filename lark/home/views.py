@@ -25,7 +25,7 @@ from django.conf import settings
 from home import approval, bu_cs, meta, message, task, router
 from home.config import constant
 from home.enums import ApprovalStatus
-from home.gpt import broker, dev_mode, review, dto
+from home.gpt import broker, dev_mode, review, dto, review_store
 from home.models import LarkApprovalInstance, AigcPrompt, IdeaMaterial, LarkUserWorkbench, LarkPoll
 from home.tool import poll
 from lark.settings import IS_PROD, BASE_DIR
@@ -338,7 +338,7 @@ def page_chatgpt_review(request):
     auto_merge, temperature, words_batch = review.DEFAULT_AUTO_MERGE, review.DEFAULT_TEMPERATURE, review.DEFAULT_WORDS_BATCH
     record = LarkUserWorkbench.objects.filter(lark_user_id=login_id, work_symbol=dto.WORK_SYMBOL).first()
     if record and record.detail:
-        reviews_count = len(record.detail.get(dto.JSON_KEY_EXCEL_DATA, []))
+        reviews_count = review_store.get_excel_count(record.detail)
         file_name = record.detail.get(dto.JSON_KEY_EXCEL_NAME, file_name)
         excel_columns = record.detail.get(dto.JSON_KEY_EXCEL_COLUMNS, excel_columns)
         review_format = record.detail.get(dto.JSON_KEY_REVIEW_FORMAT, review_format)
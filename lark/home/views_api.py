@@ -1,5 +1,6 @@
 import json
 import os
+import tempfile
 import threading
 import traceback
 
@@ -14,7 +15,7 @@ from home.gpt.cache import get_chatgpt4_users
 from home.gpt.review import RequestRunReview, RequestMergeReview
 from home.gpt.review_reader.enums import ExtractType
 from home.models import AigcPrompt
-from lark.settings import BASE_DIR, IS_PROD
+from lark.settings import IS_PROD
 from util import redis_util, http_util
 from util.lark_util import Lark
 from util.log_util import logger
@@ -122,9 +123,11 @@ def tool_speech2text_receive(request):
     resp = {'code': 0, 'msg': '', 'data': {}}
     file_raw = request.FILES['fileToUpload']
     file_name = str(file_raw)
-    local_file = str(BASE_DIR) + '/home/gpt/data/{}'.format(file_name)
-    with open(local_file, 'wb') as f:
-        f.write(file_raw.read())
+    # 上传文件名可能重复, 写入唯一的临时文件, 保留扩展名
+    fd, local_file = tempfile.mkstemp(prefix='speech_', suffix=os.path.splitext(file_name)[1])
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in file_raw.chunks():
+            f.write(chunk)
     ok, text = speech_client.to_text(file_path=local_file)
     if not ok:
         resp['code'] = -1
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import traceback
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse
+
+from home import views
+from home.config import constant
+from home.gpt import broker_async
+from util.lark_util import Lark
+from util.log_util import logger
+
+# 后台任务的引用, 避免任务执行中被回收
+_tasks = set()
+
+
+async def _ask(data):
+    try:
+        await broker_async.ask(data)
+    except:
+        await asyncio.to_thread(Lark(constant.LARK_CHAT_ID_P0).send_rich_text, 'chat exception', traceback.format_exc())
+
+
+async def event(request):
+    """
+    Lark event callback served by the ASGI entry (lark/asgi.py): private chat messages are answered
+    on the event loop (gpt.broker_async), every other event goes to views.event in a thread
+    """
+    if not isinstance(request, ASGIRequest):
+        # WSGI runs the view on a loop that closes with the response, a background task would be lost
+        logger.warning('[lark event async] not served by ASGI, handled by the sync view')
+        return await sync_to_async(views.event)(request)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({})
+    event_info = data.get('event') or {}
+    if data.get('type') == 'event_callback' and event_info.get('type') == 'message' \
+            and event_info.get('chat_type') == 'private' and event_info.get('text_without_at_bot'):
+        logger.info('[lark event async] %s' % data)
+        task = asyncio.create_task(_ask(data))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        return JsonResponse({})
+    return await sync_to_async(views.event)(request)
+
+
+# django 4.0的csrf_exempt不支持协程视图, 直接标记
+event.csrf_exempt = True
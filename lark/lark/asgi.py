@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+
+The asyncio chat path (event/async, home/views_async.py) needs this entry, e.g.
+``uvicorn lark.asgi:application``: replies run as tasks on the worker loop after the
+callback has returned, which a WSGI worker would not keep alive.
 """
 
 import os
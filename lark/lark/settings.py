@@ -47,6 +47,12 @@ if not IS_PROD:
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', '')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 5))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+# value codec of util.redis_util: 'orjson' (tagged, compressed when large), 'msgpack', or 'json' for untagged legacy values
+REDIS_VALUE_CODEC = os.getenv('REDIS_VALUE_CODEC', 'orjson')
 
 # Crawler Configuration
 # Lark API credentials for spreadsheet operations
@@ -56,11 +62,20 @@ LARK_APP_SECRET = os.getenv('LARK_APP_SECRET')
 
 # OpenAI API key for infringement analysis
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# shared OpenAI clients of util.openai_util, one connection pool per api key / base url
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 50))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 120))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5))
+# on-disk cache of deterministic chat completions (home/gpt/response_cache), 0 disables it
+GPT_RESPONSE_CACHE_PATH = os.getenv('GPT_RESPONSE_CACHE_PATH', str(BASE_DIR / 'home/gpt/data/response_cache.sqlite3'))
+GPT_RESPONSE_CACHE_MAX_MB = int(os.getenv('GPT_RESPONSE_CACHE_MAX_MB', 512))
 
 # Crawler-specific settings
 HALARA_SHEET_STRATEGY = os.getenv('HALARA_SHEET_STRATEGY', 'new_sheet')
 HALARA_TARGET_SHEET = os.getenv('HALARA_TARGET_SHEET', 'Halara_Analysis')
 PRESERVE_CRAWLER_JSON = os.getenv('PRESERVE_CRAWLER_JSON', 'false').lower() == 'true'
+# chat_context uses the daily-partitioned layout of home/db/20261019-chat_context_partition.sql
+CHAT_CONTEXT_PARTITIONED = os.getenv('CHAT_CONTEXT_PARTITIONED', 'false').lower() == 'true'
 
 # Database Configuration
 # Each database has its own configuration section for clarity
@@ -0,0 +1,88 @@
+import hashlib
+import math
+import threading
+import time
+from typing import Optional
+
+from util import redis_util
+from util.log_util import logger
+
+BLOOM_CAPACITY = 100000  # ids per generation
+BLOOM_ERROR_RATE = 1e-6  # a false positive drops a new event, keep it negligible
+
+
+class TimeWindowBloom:
+    """
+    In-process bloom filter over a sliding time window, made of two generations: ids are added to the
+    current one, looked up in both, and every `window` seconds the older generation is dropped.
+    An id is remembered for at least `window` and at most 2 * `window` seconds.
+    """
+
+    def __init__(self, window: float, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        self.window = window
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self._lock = threading.Lock()
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray((self.bits + 7) // 8)
+        self._rotated_at = time.monotonic()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._rotated_at >= self.window:
+            # after two windows without rotation both generations are stale
+            self._previous = self._current if now - self._rotated_at < 2 * self.window else bytearray(len(self._current))
+            self._current = bytearray(len(self._current))
+            self._rotated_at = now
+
+    def add(self, item: str):
+        positions = self._positions(item)
+        with self._lock:
+            self._rotate()
+            for p in positions:
+                self._current[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item: str) -> bool:
+        positions = self._positions(item)
+        with self._lock:
+            self._rotate()
+            return all(self._current[p >> 3] & (1 << (p & 7)) for p in positions) or \
+                all(self._previous[p >> 3] & (1 << (p & 7)) for p in positions)
+
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+def _get_filter(namespace: str, ttl: int) -> TimeWindowBloom:
+    with _filters_lock:
+        bloom = _filters.get(namespace)
+        if bloom is None:
+            bloom = _filters[namespace] = TimeWindowBloom(window=ttl)
+        return bloom
+
+
+def first_seen(namespace: str, item_id: str, ttl: int = 3600) -> Optional[bool]:
+    """
+    Check-and-mark an id (event id, message id) as processed.
+    Ids already seen by this process within the window are answered from the local bloom filter without
+    a round trip; otherwise one atomic SET NX EX in Redis decides across processes.
+
+    returns: True the first time an id is seen, False for a duplicate,
+    None if Redis is unavailable and the caller should fall back to its own check
+    """
+    bloom = _get_filter(namespace, ttl)
+    if item_id in bloom:
+        return False
+    try:
+        new = redis_util.set_nx('{}:{}'.format(namespace, item_id), ex=ttl)
+    except Exception as e:
+        logger.error('[dedup] {} {} check error: {}'.format(namespace, item_id, e))
+        return None
+    bloom.add(item_id)
+    return new
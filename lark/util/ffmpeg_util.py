@@ -1,4 +1,7 @@
 import os
+import re
+import shutil
+import subprocess
 import traceback
 
 from home.config import constant
@@ -11,6 +14,83 @@ if IS_PROD:
     os.environ['IMAGEIO_FFMPEG_EXE'] = sys_util.get_ffmpeg_exec_file()
     from moviepy.editor import VideoFileClip
 
+FFMPEG_TIMEOUT = 1800  # seconds, enough to decode a few hours of media
+pt_duration = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+pt_silence_start = re.compile(r'silence_start: (-?\d+(?:\.\d+)?)')
+pt_silence_end = re.compile(r'silence_end: (\d+(?:\.\d+)?)')
+
+
+def get_ffmpeg():
+    """The bundled ffmpeg binary when present, otherwise the one on PATH"""
+    exec_file = sys_util.get_ffmpeg_exec_file()
+    if exec_file and os.path.isfile(exec_file):
+        return exec_file
+    return shutil.which('ffmpeg')
+
+
+def _run(args, timeout=FFMPEG_TIMEOUT, check=True):
+    """
+    Run ffmpeg with `args`, returns (ok, stderr); ffmpeg reports progress and filter output on stderr.
+    A non zero exit is logged as an error only when `check` is set
+    """
+    ffmpeg = get_ffmpeg()
+    if not ffmpeg:
+        logger.error('[ffmpeg] executable not found')
+        return False, ''
+    try:
+        proc = subprocess.run([ffmpeg, '-hide_banner', '-nostdin'] + args, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error('[ffmpeg] timeout after {}s: {}'.format(timeout, args))
+        return False, ''
+    stderr = proc.stderr.decode('utf-8', errors='replace')
+    if proc.returncode != 0:
+        if not check:
+            return False, stderr
+        logger.error('[ffmpeg] exit {}: {}, {}'.format(proc.returncode, args, stderr[-1000:]))
+        return False, stderr
+    return True, stderr
+
+
+def extract_audio(src_file, output_file, sample_rate=16000, bitrate='48k'):
+    """
+    Decode the audio track of any audio/video file once into a mono mp3, small enough that
+    an hour of speech is about 20MB and every later cut can copy the stream without re-encoding
+    """
+    logger.info('[ffmpeg extract audio] {} -> {}'.format(src_file, output_file))
+    ok, _ = _run(['-y', '-i', src_file, '-vn', '-ac', '1', '-ar', str(sample_rate), '-c:a', 'libmp3lame',
+                  '-b:a', bitrate, output_file])
+    return ok
+
+
+def probe_duration(file):
+    """Duration in seconds from the input header, None when unknown"""
+    _, stderr = _run(['-i', file], timeout=60, check=False)  # exits non zero as no output is given
+    if mt := pt_duration.search(stderr):
+        return int(mt.group(1)) * 3600 + int(mt.group(2)) * 60 + float(mt.group(3))
+    return None
+
+
+def detect_silences(file, noise_db=-35, min_silence=0.5):
+    """[(start, end), ...] of the stretches quieter than noise_db for at least min_silence seconds"""
+    ok, stderr = _run(['-i', file, '-af', 'silencedetect=noise={}dB:d={}'.format(noise_db, min_silence), '-f', 'null', '-'])
+    if not ok:
+        return []
+    silences, start = [], None
+    for line in stderr.splitlines():
+        if mt := pt_silence_start.search(line):
+            start = max(0.0, float(mt.group(1)))
+        elif (mt := pt_silence_end.search(line)) and start is not None:
+            silences.append((start, float(mt.group(1))))
+            start = None
+    return silences
+
+
+def cut(src_file, output_file, start, duration):
+    """Copy `duration` seconds from `start` into output_file without re-encoding"""
+    ok, _ = _run(['-y', '-ss', '{:.3f}'.format(start), '-t', '{:.3f}'.format(duration), '-i', src_file,
+                  '-c', 'copy', output_file], timeout=300)
+    return ok
+
 
 def convert_video_to_audio_moviepy(video_file, output_file):
     """Converts video to audio using MoviePy library
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from util import redis_util
+from util.log_util import logger
+
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TTL = 60  # upper bound on staleness if an invalidation message is lost
+INVALIDATE_CHANNEL = redis_util.key_prefix + 'local_cache:invalidate'
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with a per-entry TTL"""
+
+    def __init__(self, maxsize: int = LOCAL_CACHE_SIZE, ttl: float = LOCAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, value: Any, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_cache = LRUCache()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _listen():
+    """Drop keys invalidated by any process, reconnecting (and clearing everything, as messages may be lost) on errors"""
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_util.r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            _cache.clear()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message and message.get('type') == 'message':
+                    _cache.delete(*json.loads(message['data']))
+        except Exception as e:
+            logger.warning('[local cache] invalidation listener error, reconnect: {}'.format(e))
+            _cache.clear()
+            time.sleep(1)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = threading.Thread(target=_listen, name='local_cache_invalidate', daemon=True)
+                _listener.start()
+
+
+def get(key: str) -> Any:
+    """Get a locally cached value, MISSING if absent or expired"""
+    _ensure_listener()
+    return _cache.get(key)
+
+
+def put(key: str, value: Any, ttl: float = None):
+    _ensure_listener()
+    _cache.put(key, value, ttl)
+
+
+def get_or_load(key: str, loader: Callable[[], Any], ttl: float = None) -> Any:
+    """
+    Two-tier read: return the in-process value, or call loader (which reads Redis / MySQL) and keep its result
+    locally for ttl seconds. None results are cached too, so a missing setting does not cost a round trip per message.
+    """
+    value = get(key)
+    if value is MISSING:
+        value = loader()
+        _cache.put(key, value, ttl)
+    return value
+
+
+def invalidate(*keys: str, batch: redis_util.Batch = None):
+    """
+    Drop keys from this process and tell every other process to drop them too. Call it after the value is changed
+    in Redis; with batch the publish is queued on that pipeline instead of sent on its own.
+    """
+    _cache.delete(*keys)
+    message = json.dumps(keys)
+    if batch is not None:
+        batch.publish(INVALIDATE_CHANNEL, message)
+        return
+    try:
+        redis_util.r.publish(INVALIDATE_CHANNEL, message)
+    except Exception as e:
+        logger.error('[local cache] publish invalidation of {} error: {}'.format(keys, e))
+
+
+def stats() -> dict:
+    return {'size': len(_cache._data), 'hits': _cache.hits, 'misses': _cache.misses}
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Callable
+
+from util.log_util import logger
+
+# event loop -> {name: resource}; loops are weak keys and closed loops are dropped on the next lookup,
+# as their resources (pools, clients) hold references back to the loop and would otherwise keep it alive
+_resources = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get(name: str, factory: Callable[[], Any]) -> Any:
+    """
+    Resource `name` (e.g. a connection pool) of the running event loop, created with factory() on first use.
+    Asyncio connections belong to the loop they were opened on, so every loop gets its own instance.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        closed = [each for each in _resources.keys() if each.is_closed()]
+        for each in closed:
+            del _resources[each]
+        if closed:
+            logger.info('[loop local] drop resources of {} closed loops'.format(len(closed)))
+        per_loop = _resources.setdefault(loop, {})
+        if name not in per_loop:
+            per_loop[name] = factory()
+        return per_loop[name]
@@ -0,0 +1,109 @@
+import hashlib
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from home.config import constant
+from lark.settings import OPENAI_MAX_CONNECTIONS, OPENAI_TIMEOUT, OPENAI_CONNECT_TIMEOUT
+from util import dedup, loop_local
+from util.lark_util import Lark
+from util.log_util import logger
+
+KEEPALIVE_EXPIRY = 60  # seconds an idle connection is kept for reuse
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+RETRY_AFTER_MAX = 60.0  # longer server hints are capped, the caller may give up instead
+RETRYABLE_STATUS = (408, 409, 429)
+ALERT_WINDOW = 600  # the same kind of error is alerted once per window across processes
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _limits():
+    return httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def _timeout():
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def get_client(api_key: str, base_url: Optional[str] = None) -> OpenAI:
+    """
+    Process-wide OpenAI client per api key and base url. Clients are thread safe and keep their
+    httpx connection pool, so repeated calls reuse open TLS connections instead of handshaking again.
+    Retries are left to the caller (see retry_delay), the client itself does not retry.
+    """
+    key = (api_key, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = openai.DefaultHttpxClient(limits=_limits(), timeout=_timeout())
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+            _clients[key] = client
+            logger.info('[openai] create client, base url: {}, max connections: {}'.format(
+                base_url or 'default', OPENAI_MAX_CONNECTIONS))
+        return client
+
+
+def get_async_client(api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    """AsyncOpenAI client per api key and base url for the running event loop, same pool settings as get_client"""
+    def create():
+        http_client = openai.DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout())
+        logger.info('[openai] create async client, base url: {}'.format(base_url or 'default'))
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+    return loop_local.get('openai:{}:{}'.format(hashlib.md5(api_key.encode('utf-8')).hexdigest(), base_url), create)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if value := headers.get('retry-after-ms'):
+            return float(value) / 1000
+        if value := headers.get('retry-after'):
+            try:
+                return float(value)
+            except ValueError:
+                return parsedate_to_datetime(value).timestamp() - time.time()
+    except Exception:
+        return None
+    return None
+
+
+def retry_delay(attempt: int, error: Optional[Exception] = None) -> float:
+    """
+    Seconds to wait before retry `attempt` (from 1): the server's Retry-After when given,
+    otherwise exponential backoff with full jitter
+    """
+    if error is not None:
+        hint = _retry_after(error)
+        if hint is not None and hint >= 0:
+            return min(hint, RETRY_AFTER_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def alert(title: str, error: Exception, detail: str = ''):
+    """Send an error to the P0 chat, once per kind of error (type, status, title) within ALERT_WINDOW"""
+    signature = '{}:{}:{}'.format(title, type(error).__name__, getattr(error, 'status_code', ''))
+    digest = hashlib.md5(signature.encode('utf-8')).hexdigest()
+    if dedup.first_seen('openai:alert', digest, ttl=ALERT_WINDOW) is False:
+        return
+    Lark(constant.LARK_CHAT_ID_P0).send_rich_text(title, '{}\n\n{}'.format(signature, detail or error))
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from util.log_util import logger
+
+
+class RateLimiter:
+    """
+    Thread-safe sliding-window limiter for requests and tokens per minute.
+    acquire() blocks the calling thread until the request fits in the window, so a pool of
+    worker threads sharing one limiter never exceeds the model's RPM/TPM quota.
+    """
+
+    def __init__(self, rpm: int, tpm: Optional[int] = None, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls = deque()  # (timestamp, tokens)
+        self._tokens = 0
+
+    def _purge(self, now: float):
+        while self._calls and now - self._calls[0][0] >= self.window:
+            _, tokens = self._calls.popleft()
+            self._tokens -= tokens
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until one request of `tokens` tokens is allowed, returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge(now)
+                fits_rpm = len(self._calls) < self.rpm
+                # a single request larger than the whole budget is let through on an empty window
+                fits_tpm = self.tpm is None or not self._calls or self._tokens + tokens <= self.tpm
+                if fits_rpm and fits_tpm:
+                    self._calls.append((now, tokens))
+                    self._tokens += tokens
+                    return waited
+                sleep_for = max(0.01, self.window - (now - self._calls[0][0]))
+            time.sleep(sleep_for)
+            waited += sleep_for
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, rpm: int, tpm: Optional[int] = None) -> RateLimiter:
+    """Get the process-wide limiter registered under `name` (e.g. a model name), creating it on first use"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            logger.info('[rate limit] create limiter {}: rpm={}, tpm={}'.format(name, rpm, tpm))
+            limiter = RateLimiter(rpm, tpm)
+            _limiters[name] = limiter
+        return limiter
@@ -0,0 +1,145 @@
+"""
+Value codec for redis_util.
+
+Encoded values start with one tag byte: the high nibble is the serialization format and the
+low nibble the compression. Tags are in 0x80-0x9f, which can start neither a JSON document nor
+a UTF-8 string, so values written before the codec existed (plain JSON, or raw strings from
+set_) are still read back by falling through to json / plain text. Only untagged values that
+start like a JSON object, array or string are parsed; anything else (raw "123", "true", "0.7")
+is returned as the string it was written as.
+"""
+import json
+import zlib
+from typing import Any, Callable, Dict, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+FORMAT_JSON = 0x80
+FORMAT_MSGPACK = 0x90
+
+COMPRESS_NONE = 0x0
+COMPRESS_ZLIB = 0x1
+COMPRESS_ZSTD = 0x2
+COMPRESS_LZ4 = 0x3
+
+COMPRESS_MIN_BYTES = 1024  # smaller values are not worth the compression header and cpu
+
+# format tag -> (dumps, loads), both on bytes
+_formats: Dict[int, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {}
+# compression tag -> (compress, decompress)
+_compressions: Dict[int, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {}
+
+
+def register_format(tag: int, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+    assert tag & 0xf0 == tag and 0x80 <= tag <= 0x90, 'format tag should be 0x80 or 0x90'
+    _formats[tag] = (dumps, loads)
+
+
+def register_compression(tag: int, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]):
+    assert 0 < tag <= 0xf, 'compression tag should be 0x1-0xf'
+    _compressions[tag] = (compress, decompress)
+
+
+def _json_dumps(value: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass  # e.g. int keys or ints over 64 bit, which json handles
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+register_format(FORMAT_JSON, _json_dumps, _json_loads)
+if msgpack is not None:
+    register_format(FORMAT_MSGPACK, lambda v: msgpack.packb(v, use_bin_type=True), lambda d: msgpack.unpackb(d, raw=False))
+
+register_compression(COMPRESS_ZLIB, lambda d: zlib.compress(d, 1), zlib.decompress)
+if zstandard is not None:
+    # compressor objects are not thread safe, so each call gets its own
+    register_compression(COMPRESS_ZSTD,
+                         lambda d: zstandard.ZstdCompressor(level=3).compress(d),
+                         lambda d: zstandard.ZstdDecompressor().decompress(d))
+if lz4_frame is not None:
+    register_compression(COMPRESS_LZ4, lz4_frame.compress, lz4_frame.decompress)
+
+
+def _default_compression() -> int:
+    for tag in (COMPRESS_ZSTD, COMPRESS_LZ4, COMPRESS_ZLIB):
+        if tag in _compressions:
+            return tag
+    return COMPRESS_NONE
+
+
+def get_codec(name: str) -> Tuple[int, int]:
+    """
+    Resolve a codec name from settings to (format tag, compression tag).
+    'json' means legacy untagged JSON, e.g. while processes without the codec still read the same keys;
+    numbers and booleans are then read back as strings, see decode.
+    """
+    if name == 'json':
+        return 0, COMPRESS_NONE
+    if name == 'msgpack' and FORMAT_MSGPACK in _formats:
+        return FORMAT_MSGPACK, _default_compression()
+    return FORMAT_JSON, _default_compression()
+
+
+def encode(value: Any, fmt: int = FORMAT_JSON, compression: int = COMPRESS_NONE,
+           min_compress_bytes: int = COMPRESS_MIN_BYTES) -> bytes:
+    """Serialize a value into tagged bytes, compressing it when it is large enough"""
+    if not fmt:
+        return json.dumps(value).encode('utf-8')
+    data = _formats[fmt][0](value)
+    if compression and len(data) >= min_compress_bytes:
+        compressed = _compressions[compression][0](data)
+        if len(compressed) < len(data):
+            return bytes((fmt | compression,)) + compressed
+    return bytes((fmt,)) + data
+
+
+_JSON_STARTS = ('{', '[', '"')
+
+
+def decode(data) -> Any:
+    """
+    Deserialize tagged bytes. Untagged values that start like a JSON object, array or string are read
+    as JSON, anything else is returned as the plain string so raw scalars keep their type.
+    """
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data and 0x80 <= data[0] <= 0x9f:
+        fmt, compression = data[0] & 0xf0, data[0] & 0x0f
+        body = data[1:]
+        if compression:
+            body = _compressions[compression][1](body)
+        return _formats[fmt][1](body)
+    text = data.decode('utf-8')
+    if not text.lstrip().startswith(_JSON_STARTS):
+        return text
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
@@ -1,40 +1,145 @@
 import redis
+import redis.asyncio as redis_asyncio
 import json
+import threading
+import time as time_
 import traceback
-from lark.settings import REDIS_HOST
+from collections import deque
+from lark.settings import REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, REDIS_VALUE_CODEC, REDIS_MAX_CONNECTIONS, \
+    REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_HEALTH_CHECK_INTERVAL
 from typing import Any, Optional
+from util import loop_local, redis_codec
+from util.log_util import logger
+
+SLOW_COMMAND_MS = 100  # commands slower than this are logged
+LATENCY_SAMPLES = 1024  # latest samples kept per command for percentiles
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+def _record_latency(command: str, elapsed_ms: float):
+    with _latencies_lock:
+        samples = _latencies.get(command)
+        if samples is None:
+            samples = _latencies[command] = deque(maxlen=LATENCY_SAMPLES)
+        samples.append(elapsed_ms)
+    if elapsed_ms > SLOW_COMMAND_MS:
+        logger.warning('[redis] slow command {}: {:.1f}ms'.format(command, elapsed_ms))
+
+
+def latency_stats() -> dict:
+    """Per command count, p50, p99 and max latency in ms over the latest samples"""
+    with _latencies_lock:
+        snapshot = {command: sorted(samples) for command, samples in _latencies.items()}
+    stats = {}
+    for command, samples in snapshot.items():
+        if not samples:
+            continue
+        stats[command] = {
+            'count': len(samples),
+            'p50': round(samples[len(samples) // 2], 2),
+            'p99': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2),
+            'max': round(samples[-1], 2),
+        }
+    return stats
+
+
+def log_latency_stats():
+    """Log the latency percentiles of every command, run periodically by the scheduler"""
+    for command, stat in sorted(latency_stats().items()):
+        logger.info('[redis] latency {}: count={count}, p50={p50}ms, p99={p99}ms, max={max}ms'.format(command, **stat))
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client that records the latency of every command"""
+
+    def execute_command(self, *args, **options):
+        start = time_.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            _record_latency(str(args[0]).upper(), (time_.perf_counter() - start) * 1000)
+
+
+class LazyClient:
+    """Create the pool and client on first use, so importing redis_util never opens a connection"""
+
+    def __init__(self, decode_responses: bool):
+        self._decode_responses = decode_responses
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get(self) -> InstrumentedRedis:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    #blocking pool: when all connections are busy wait for one instead of failing
+                    pool = redis.BlockingConnectionPool(
+                        host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD or None,
+                        max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_SOCKET_TIMEOUT,
+                        socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                        socket_keepalive=True, retry_on_timeout=True,
+                        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                        decode_responses=self._decode_responses)
+                    self._client = InstrumentedRedis(connection_pool=pool)
+                    logger.info('[redis] create pool {}:{}, max_connections={}, decode_responses={}'.format(
+                        REDIS_HOST, REDIS_PORT, REDIS_MAX_CONNECTIONS, self._decode_responses))
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+r = LazyClient(decode_responses=True)
+#values written by set/setex are binary (see redis_codec), read them without decoding responses
+rb = LazyClient(decode_responses=False)
+key_prefix = 'lark:'
 
 
-r = redis.Redis(host=REDIS_HOST, port=6379, decode_responses=True)
-key_prefix = 'lark:'
+def _create_async_client():
+    pool = redis_asyncio.BlockingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD or None,
+        max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True, retry_on_timeout=True,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL, decode_responses=True)
+    logger.info('[redis] create async pool {}:{}, max_connections={}'.format(REDIS_HOST, REDIS_PORT, REDIS_MAX_CONNECTIONS))
+    return redis_asyncio.Redis(connection_pool=pool)
+
+
+def async_client():
+    """
+    redis.asyncio client (decoded responses) for the event loop of the caller, e.g. the ASGI worker loop.
+    Connections of an asyncio pool belong to one loop, so each loop gets its own pool (see loop_local).
+    """
+    return loop_local.get('redis', _create_async_client)
+
+
+value_format, value_compression = redis_codec.get_codec(REDIS_VALUE_CODEC)
+
+
+def encode(value: Any) -> bytes:
+    return redis_codec.encode(value, value_format, value_compression)
 
 
 def set_(key, val, ex):
-    if type(val) == dict:
-        val = json.dumps(val)
-    r.set(key_prefix+key, val, ex=ex)
+    #written with the codec so get returns the value with its type, e.g. a float temperature
+    rb.set(key_prefix+key, encode(val), ex=ex)
 
 
 def get(key: str) -> Optional[Any]:
-    """Get value from Redis and deserialize from JSON if needed"""
+    """Get value from Redis and deserialize it, raw strings written before the codec are returned as is"""
     try:
-        value = r.get(key_prefix+key)
-        if value is None:
-            return None
-        return json.loads(value)
+        return redis_codec.decode(rb.get(key_prefix+key))
     except Exception as e:
-        print(f"Error getting key {key} from Redis: {e}")
+        logger.error(f"[redis] Error getting key {key} from Redis: {e}")
         return None
 
 
 def set_nx(key, ex=60):
-    if r.setnx(key_prefix+key, 1):
-        r.expire(key_prefix+key, ex)
-        return True
-    elif r.ttl(key_prefix+key) == -1:
-        r.expire(key_prefix + key, ex)
-
-    return False
+    #one atomic SET NX EX, the key can never be left without a ttl
+    return bool(r.set(key_prefix+key, 1, nx=True, ex=ex))
 
 
 def del_(key):
@@ -90,22 +195,20 @@ def expire(key, expire_seconds):
 
 
 def set(key: str, value: Any, ex: Optional[int] = None) -> bool:
-    """Set value in Redis with JSON serialization"""
+    """Set value in Redis, serialized with the configured codec"""
     try:
-        json_value = json.dumps(value)
-        return r.set(key_prefix+key, json_value, ex=ex)
+        return rb.set(key_prefix+key, encode(value), ex=ex)
     except Exception as e:
-        print(f"Error setting key {key} in Redis: {e}")
+        logger.error(f"[redis] Error setting key {key} in Redis: {e}")
         return False
 
 
 def setex(key: str, time: int, value: Any) -> bool:
-    """Set value in Redis with expiration time and JSON serialization"""
+    """Set value in Redis with expiration time, serialized with the configured codec"""
     try:
-        json_value = json.dumps(value)
-        return r.setex(key_prefix+key, time, json_value)
+        return rb.setex(key_prefix+key, time, encode(value))
     except Exception as e:
-        print(f"Error setting key {key} in Redis with expiration: {e}")
+        logger.error(f"[redis] Error setting key {key} in Redis with expiration: {e}")
         return False
 
 
@@ -119,7 +222,7 @@ def hget(key: str, field: str) -> Optional[Any]:
             return None
         return json.loads(value)
     except Exception as e:
-        print(f"Error getting hash field {field} from key {key} in Redis: {e}")
+        logger.error(f"[redis] Error getting hash field {field} from key {key} in Redis: {e}")
         return None
 
 
@@ -132,10 +235,33 @@ def hset(key: str, field: str, value: Any) -> bool:
         # We want to return True if the operation succeeded
         return result >= 0  # Any non-negative result means success
     except Exception as e:
-        print(f"Error setting hash field {field} in key {key} in Redis: {e}")
+        logger.error(f"[redis] Error setting hash field {field} in key {key} in Redis: {e}")
         return False
 
 
+def hset_many(key: str, mapping: dict) -> bool:
+    """Set several fields of a Redis hash in one command with JSON serialization"""
+    try:
+        if not mapping:
+            return True
+        r.hset(key_prefix+key, mapping={field: json.dumps(value) for field, value in mapping.items()})
+        return True
+    except Exception as e:
+        logger.error(f"[redis] Error setting hash fields in key {key} in Redis: {e}")
+        return False
+
+
+def hmget(key: str, fields: list) -> list:
+    """Get several fields of a Redis hash in one command, missing fields are None"""
+    try:
+        if not fields:
+            return []
+        return [json.loads(value) if value is not None else None for value in r.hmget(key_prefix+key, fields)]
+    except Exception as e:
+        logger.error(f"[redis] Error getting hash fields from key {key} in Redis: {e}")
+        return [None] * len(fields)
+
+
 def hgetall(key: str) -> dict:
     """Get all fields and values from Redis hash"""
     try:
@@ -148,7 +274,7 @@ def hgetall(key: str) -> dict:
                 result[field] = value  # Keep as string if not JSON
         return result
     except Exception as e:
-        print(f"Error getting all hash fields from key {key} in Redis: {e}")
+        logger.error(f"[redis] Error getting all hash fields from key {key} in Redis: {e}")
         return {}
 
 
@@ -157,7 +283,7 @@ def hdel(key: str, *fields: str) -> int:
     try:
         return r.hdel(key_prefix+key, *fields)
     except Exception as e:
-        print(f"Error deleting hash fields from key {key} in Redis: {e}")
+        logger.error(f"[redis] Error deleting hash fields from key {key} in Redis: {e}")
         return 0
 
 
@@ -166,7 +292,7 @@ def hexists(key: str, field: str) -> bool:
     try:
         return r.hexists(key_prefix+key, field)
     except Exception as e:
-        print(f"Error checking hash field existence for key {key} in Redis: {e}")
+        logger.error(f"[redis] Error checking hash field existence for key {key} in Redis: {e}")
         return False
 
 
@@ -175,7 +301,7 @@ def ttl(key: str) -> int:
     try:
         return r.ttl(key_prefix+key)
     except Exception as e:
-        print(f"Error getting TTL for key {key} in Redis: {e}")
+        logger.error(f"[redis] Error getting TTL for key {key} in Redis: {e}")
         return -1
 
 
@@ -184,5 +310,175 @@ def delete(key: str) -> int:
     try:
         return r.delete(key_prefix+key)
     except Exception as e:
-        print(f"Error deleting key {key} from Redis: {e}")
+        logger.error(f"[redis] Error deleting key {key} from Redis: {e}")
+        return 0
+
+
+#for batched operations, several commands in one round trip
+
+def _loads(value) -> Optional[Any]:
+    """Decode a hash field value (plain JSON)"""
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except Exception:
+        return None
+
+
+def _decode(value) -> Optional[Any]:
+    """Decode a string value written with the codec"""
+    try:
+        return redis_codec.decode(value)
+    except Exception as e:
+        logger.error(f"[redis] Error decoding value from Redis: {e}")
+        return None
+
+
+def _decode_list(values) -> Optional[list]:
+    """List entries are plain strings pushed by rpush, not written with the codec"""
+    if values is None:
+        return None
+    return [value.decode('utf-8') if isinstance(value, bytes) else value for value in values]
+
+
+class Batch:
+    """
+    Queue commands on a pipeline and send them to Redis in one round trip.
+    Keys are prefixed and values JSON encoded the same way as the module functions,
+    execute() returns one result per queued command, with get/hget results decoded.
+    The pipeline runs on the binary client, as string values are written with the codec.
+    With transaction=True the commands run atomically in a MULTI/EXEC block.
+    """
+
+    def __init__(self, transaction: bool = False):
+        self._pipe = rb.pipeline(transaction=transaction)
+        self._decode = []
+
+    def __len__(self):
+        return len(self._decode)
+
+    def _queue(self, decode=None):
+        self._decode.append(decode)
+        return self
+
+    def get(self, key: str):
+        self._pipe.get(key_prefix+key)
+        return self._queue(decode=_decode)
+
+    def set(self, key: str, value: Any, ex: Optional[int] = None):
+        self._pipe.set(key_prefix+key, encode(value), ex=ex)
+        return self._queue()
+
+    def setex(self, key: str, time: int, value: Any):
+        self._pipe.setex(key_prefix+key, time, encode(value))
+        return self._queue()
+
+    def delete(self, *keys: str):
+        self._pipe.delete(*[key_prefix+key for key in keys])
+        return self._queue()
+
+    def expire(self, key: str, expire_seconds: int):
+        self._pipe.expire(key_prefix+key, expire_seconds)
+        return self._queue()
+
+    def incrby(self, key: str, amount: int):
+        self._pipe.incrby(key_prefix+key, amount)
+        return self._queue()
+
+    def rpush(self, key: str, *values: str):
+        self._pipe.rpush(key_prefix+key, *values)
+        return self._queue()
+
+    def lpush(self, key: str, *values: str):
+        self._pipe.lpush(key_prefix+key, *values)
+        return self._queue()
+
+    def ltrim(self, key: str, start: int, end: int):
+        self._pipe.ltrim(key_prefix+key, start, end)
+        return self._queue()
+
+    def lrange(self, key: str, start: int, end: int):
+        self._pipe.lrange(key_prefix+key, start, end)
+        return self._queue(decode=_decode_list)
+
+    def hget(self, key: str, field: str):
+        self._pipe.hget(key_prefix+key, field)
+        return self._queue(decode=_loads)
+
+    def hset(self, key: str, field: str, value: Any):
+        self._pipe.hset(key_prefix+key, field, json.dumps(value))
+        return self._queue()
+
+    def hdel(self, key: str, *fields: str):
+        self._pipe.hdel(key_prefix+key, *fields)
+        return self._queue()
+
+    def publish(self, channel: str, message: str):
+        self._pipe.publish(channel, message)
+        return self._queue()
+
+    def execute(self) -> list:
+        """Send the queued commands, failed commands give None instead of failing the whole batch"""
+        if not self._decode:
+            return []
+        decoders = self._decode
+        start = time_.perf_counter()
+        try:
+            results = self._pipe.execute(raise_on_error=False)
+            _record_latency('PIPELINE', (time_.perf_counter() - start) * 1000)
+        except Exception as e:
+            logger.error(f"[redis] Error executing batch of {len(decoders)} commands in Redis: {e}")
+            return [None] * len(decoders)
+        finally:
+            #the batch can be reused, also after a failed round trip
+            self._pipe.reset()
+            self._decode = []
+        out = []
+        for value, decode in zip(results, decoders):
+            if isinstance(value, Exception):
+                logger.error(f"[redis] Error in batched Redis command: {value}")
+                value = None
+            out.append(decode(value) if decode else value)
+        return out
+
+
+def batch(transaction: bool = False) -> Batch:
+    return Batch(transaction)
+
+
+def mget(keys: list) -> list:
+    """Get several keys in one command, deserialized from JSON, missing keys are None"""
+    try:
+        if not keys:
+            return []
+        return [_decode(value) for value in rb.mget([key_prefix+key for key in keys])]
+    except Exception as e:
+        logger.error(f"[redis] Error getting keys {keys} from Redis: {e}")
+        return [None] * len(keys)
+
+
+def set_many(mapping: dict, ex: Optional[int] = None) -> bool:
+    """Set several keys in one round trip with JSON serialization"""
+    if not mapping:
+        return True
+    b = batch()
+    for key, value in mapping.items():
+        b.set(key, value, ex=ex)
+    return all(b.execute())
+
+
+def setex_many(mapping: dict, time: int) -> bool:
+    """Set several keys with the same expiration time in one round trip with JSON serialization"""
+    return set_many(mapping, ex=time)
+
+
+def delete_many(keys: list) -> int:
+    """Delete several keys in one command"""
+    try:
+        if not keys:
+            return 0
+        return r.delete(*[key_prefix+key for key in keys])
+    except Exception as e:
+        logger.error(f"[redis] Error deleting keys {keys} from Redis: {e}")
         return 0
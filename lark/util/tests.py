@@ -0,0 +1,289 @@
+from unittest import mock
+
+import httpx
+import openai
+from django.test import SimpleTestCase
+
+from util import dedup, local_cache, openai_util, redis_codec, redis_util, token_count
+
+
+class ClientTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(redis_util._latencies, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lazy_client_creates_pool_once_on_first_use(self):
+        client = redis_util.LazyClient(decode_responses=True)
+        with mock.patch.object(redis_util.redis, 'BlockingConnectionPool') as pool, \
+                mock.patch.object(redis_util, 'InstrumentedRedis') as instrumented:
+            pool.assert_not_called()
+            client.get('a')
+            client.get('b')
+        pool.assert_called_once()
+        self.assertTrue(pool.call_args.kwargs['decode_responses'])
+        self.assertEqual(instrumented.return_value.get.call_count, 2)
+
+    def test_latency_stats(self):
+        for ms in range(1, 101):
+            redis_util._record_latency('GET', ms)
+        self.assertEqual(redis_util.latency_stats(), {'GET': {'count': 100, 'p50': 51, 'p99': 100, 'max': 100}})
+
+    def test_latency_samples_are_bounded(self):
+        for ms in range(redis_util.LATENCY_SAMPLES + 10):
+            redis_util._record_latency('SET', 1)
+        self.assertEqual(redis_util.latency_stats()['SET']['count'], redis_util.LATENCY_SAMPLES)
+
+
+class BatchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.pipe = mock.MagicMock()
+        patcher = mock.patch.object(redis_util, 'rb', mock.MagicMock(**{'pipeline.return_value': self.pipe}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_execute_decodes_per_command(self):
+        self.pipe.execute.return_value = [redis_util.encode({'a': 1}), b'{"b": 2}', [b'x', 'y'], True]
+        b = redis_util.batch().get('k').hget('h', 'f').lrange('l', 0, -1).set('s', [1], ex=60)
+        self.assertEqual(len(b), 4)
+        self.assertEqual(b.execute(), [{'a': 1}, {'b': 2}, ['x', 'y'], True])
+        self.pipe.get.assert_called_once_with('lark:k')
+        self.pipe.hget.assert_called_once_with('lark:h', 'f')
+        self.pipe.set.assert_called_once_with('lark:s', redis_util.encode([1]), ex=60)
+        self.pipe.execute.assert_called_once_with(raise_on_error=False)
+        self.pipe.reset.assert_called_once_with()
+        self.assertEqual(len(b), 0)
+
+    def test_failed_command_gives_none(self):
+        self.pipe.execute.return_value = [Exception('WRONGTYPE'), 1]
+        self.assertEqual(redis_util.batch().get('k').incrby('n', 1).execute(), [None, 1])
+
+    def test_failed_pipeline_gives_none_for_every_command(self):
+        self.pipe.execute.side_effect = ConnectionError('down')
+        self.assertEqual(redis_util.batch().get('a').delete('b', 'c').execute(), [None, None])
+        self.pipe.delete.assert_called_once_with('lark:b', 'lark:c')
+        self.pipe.reset.assert_called_once_with()
+
+    def test_failed_pipeline_clears_queued_commands(self):
+        b = redis_util.batch().get('a')
+        self.pipe.execute.side_effect = ConnectionError('down')
+        b.execute()
+        self.assertEqual(len(b), 0)
+        self.pipe.execute.side_effect = None
+        self.pipe.execute.return_value = [1]
+        self.assertEqual(b.incrby('n', 1).execute(), [1])
+
+    def test_empty_batch_sends_nothing(self):
+        self.assertEqual(redis_util.batch().execute(), [])
+        self.pipe.execute.assert_not_called()
+
+    def test_set_many(self):
+        self.pipe.execute.return_value = [True, True]
+        self.assertTrue(redis_util.set_many({'a': 1, 'b': 2}, ex=10))
+        self.assertEqual(self.pipe.set.call_count, 2)
+        self.assertTrue(redis_util.set_many({}))
+
+
+class RedisCodecTest(SimpleTestCase):
+    value = {'id': 1, 'text': '评论' * 1000, 'tags': ['a', 'b'], 'score': 0.5}
+
+    def test_round_trip(self):
+        for fmt in (0, redis_codec.FORMAT_JSON):
+            self.assertEqual(redis_codec.decode(redis_codec.encode(self.value, fmt)), self.value)
+
+    def test_round_trip_compressed(self):
+        data = redis_codec.encode(self.value, redis_codec.FORMAT_JSON, redis_codec.COMPRESS_ZLIB)
+        self.assertEqual(data[0], redis_codec.FORMAT_JSON | redis_codec.COMPRESS_ZLIB)
+        self.assertEqual(redis_codec.decode(data), self.value)
+
+    def test_small_value_not_compressed(self):
+        data = redis_codec.encode({'id': 1}, redis_codec.FORMAT_JSON, redis_codec.COMPRESS_ZLIB)
+        self.assertEqual(data[0], redis_codec.FORMAT_JSON)
+        self.assertEqual(redis_codec.decode(data), {'id': 1})
+
+    def test_round_trip_codecs(self):
+        for name in ('json', 'orjson', 'msgpack'):
+            fmt, compression = redis_codec.get_codec(name)
+            self.assertEqual(redis_codec.decode(redis_codec.encode(self.value, fmt, compression)), self.value)
+
+    def test_round_trip_scalars(self):
+        for value in (123, 0.7, True, '123', 'true'):
+            self.assertEqual(redis_codec.decode(redis_codec.encode(value, redis_codec.FORMAT_JSON)), value)
+
+    def test_decode_legacy(self):
+        self.assertIsNone(redis_codec.decode(None))
+        self.assertEqual(redis_codec.decode(b'{"a": [1, 2]}'), {'a': [1, 2]})
+        self.assertEqual(redis_codec.decode('"text"'), 'text')
+        self.assertEqual(redis_codec.decode(b'plain token'), 'plain token')
+        self.assertEqual(redis_codec.decode('中文'.encode('utf-8')), '中文')
+        self.assertEqual(redis_codec.decode(b'[not json'), '[not json')
+
+    def test_decode_legacy_raw_scalars_stay_strings(self):
+        # raw values written by set_ before the codec
+        for raw in ('123', 'true', '0.7', 'null'):
+            self.assertEqual(redis_codec.decode(raw.encode('utf-8')), raw)
+
+    def test_set_writes_with_codec(self):
+        with mock.patch.object(redis_util, 'rb') as rb:
+            redis_util.set_('temp', 0.7, 60)
+            rb.set.assert_called_once_with('lark:temp', redis_util.encode(0.7), ex=60)
+            rb.get.return_value = rb.set.call_args[0][1]
+            self.assertEqual(redis_util.get('temp'), 0.7)
+
+
+class LocalCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch.object(local_cache.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_expire_after_ttl(self):
+        cache = local_cache.LRUCache(ttl=10)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl=30)
+        self.now += 11
+        self.assertIs(cache.get('a'), local_cache.MISSING)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual((cache.hits, cache.misses, len(cache._data)), (1, 1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = local_cache.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIs(cache.get('b'), local_cache.MISSING)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_get_or_load_caches_none(self):
+        loader = mock.MagicMock(return_value=None)
+        with mock.patch.object(local_cache, '_cache', local_cache.LRUCache()), \
+                mock.patch.object(local_cache, '_ensure_listener'):
+            self.assertIsNone(local_cache.get_or_load('k', loader))
+            self.assertIsNone(local_cache.get_or_load('k', loader))
+        loader.assert_called_once_with()
+
+    def test_invalidate_drops_locally_and_publishes(self):
+        cache = local_cache.LRUCache()
+        cache.put('a', 1)
+        with mock.patch.object(local_cache, '_cache', cache), \
+                mock.patch.object(local_cache.redis_util, 'r') as r:
+            local_cache.invalidate('a', 'b')
+            r.publish.assert_called_once_with(local_cache.INVALIDATE_CHANNEL, '["a", "b"]')
+            batch = mock.MagicMock()
+            local_cache.invalidate('c', batch=batch)
+            batch.publish.assert_called_once_with(local_cache.INVALIDATE_CHANNEL, '["c"]')
+            self.assertEqual(r.publish.call_count, 1)
+        self.assertIs(cache.get('a'), local_cache.MISSING)
+
+
+class DedupTest(SimpleTestCase):
+
+    def test_first_seen_then_duplicate_from_bloom(self):
+        with mock.patch.object(dedup.redis_util, 'set_nx', return_value=True) as set_nx:
+            self.assertIs(dedup.first_seen('test:dedup:local', 'ev-1'), True)
+            self.assertIs(dedup.first_seen('test:dedup:local', 'ev-1'), False)
+            self.assertEqual(set_nx.call_count, 1)
+
+    def test_duplicate_seen_by_another_process(self):
+        with mock.patch.object(dedup.redis_util, 'set_nx', return_value=False):
+            self.assertIs(dedup.first_seen('test:dedup:remote', 'ev-1'), False)
+
+    def test_redis_unavailable(self):
+        with mock.patch.object(dedup.redis_util, 'set_nx', side_effect=ConnectionError('down')):
+            self.assertIsNone(dedup.first_seen('test:dedup:down', 'ev-1'))
+        # ids that were not written to Redis do not enter the local filter
+        with mock.patch.object(dedup.redis_util, 'set_nx', return_value=True):
+            self.assertIs(dedup.first_seen('test:dedup:down', 'ev-1'), True)
+
+    def test_bloom_forgets_after_two_windows(self):
+        now = [0.0]
+        with mock.patch.object(dedup.time, 'monotonic', side_effect=lambda: now[0]):
+            bloom = dedup.TimeWindowBloom(window=10, capacity=1000)
+            bloom.add('ev-1')
+            now[0] = 15
+            self.assertIn('ev-1', bloom)
+            now[0] = 26
+            self.assertNotIn('ev-1', bloom)
+
+
+class TokenCountTest(SimpleTestCase):
+
+    def setUp(self):
+        self.encoding = mock.MagicMock()
+        self.encoding.name = 'test'
+        self.encoding.encode_batch.side_effect = lambda texts, num_threads: [t.split() for t in texts]
+        patcher = mock.patch.object(token_count, '_cache', local_cache.LRUCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_process_cache(self):
+        self.assertEqual(token_count.count_many(self.encoding, ['a b', 'c']), [2, 1])
+        self.assertEqual(token_count.count_many(self.encoding, ['c', 'a b', 'd e f']), [1, 2, 3])
+        self.assertEqual([c[0][0] for c in self.encoding.encode_batch.call_args_list], [['a b', 'c'], ['d e f']])
+
+    def test_cache_is_per_encoding(self):
+        token_count.count(self.encoding, 'a b')
+        self.encoding.name = 'other'
+        token_count.count(self.encoding, 'a b')
+        self.assertEqual(self.encoding.encode_batch.call_count, 2)
+
+    def test_store_layer(self):
+        digest = token_count._digest('a b')
+        with mock.patch.object(token_count.redis_util, 'hmget', return_value=[7, None]) as hmget, \
+                mock.patch.object(token_count.redis_util, 'hset_many') as hset_many, \
+                mock.patch.object(token_count.redis_util, 'expire') as expire:
+            self.assertEqual(token_count.count_many(self.encoding, ['a b', 'c d'], store_key='archive'), [7, 2])
+        hmget.assert_called_once_with('archive:test', [digest, token_count._digest('c d')])
+        hset_many.assert_called_once_with('archive:test', {token_count._digest('c d'): 2})
+        expire.assert_called_once_with('archive:test', token_count.STORE_TTL)
+        # counts read from the store are kept in process too
+        self.assertEqual(token_count.count(self.encoding, 'a b'), 7)
+        self.assertEqual(self.encoding.encode_batch.call_count, 1)
+
+
+def status_error(status, headers=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return openai.APIStatusError('error {}'.format(status), response=response, body=None)
+
+
+class OpenAIRetryTest(SimpleTestCase):
+
+    def test_is_retryable(self):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        self.assertTrue(openai_util.is_retryable(openai.APIConnectionError(request=request)))
+        self.assertTrue(openai_util.is_retryable(openai.APITimeoutError(request=request)))
+        for status in (408, 409, 429, 500, 503):
+            self.assertTrue(openai_util.is_retryable(status_error(status)), status)
+        for status in (400, 401, 404):
+            self.assertFalse(openai_util.is_retryable(status_error(status)), status)
+        self.assertFalse(openai_util.is_retryable(ValueError('bad input')))
+
+    def test_retry_delay_uses_server_hint(self):
+        self.assertEqual(openai_util.retry_delay(1, status_error(429, {'retry-after-ms': '1500'})), 1.5)
+        self.assertEqual(openai_util.retry_delay(1, status_error(429, {'retry-after': '7'})), 7.0)
+        self.assertEqual(openai_util.retry_delay(1, status_error(429, {'retry-after': '3600'})), openai_util.RETRY_AFTER_MAX)
+
+    def test_retry_delay_http_date(self):
+        with mock.patch.object(openai_util.time, 'time', return_value=1760000000.0):
+            error = status_error(503, {'retry-after': 'Thu, 09 Oct 2025 08:53:40 GMT'})
+            self.assertAlmostEqual(openai_util.retry_delay(1, error), 20.0)
+
+    def test_retry_delay_backoff_with_jitter(self):
+        with mock.patch.object(openai_util.random, 'uniform', side_effect=lambda low, high: high) as uniform:
+            self.assertEqual(openai_util.retry_delay(1), openai_util.BACKOFF_BASE)
+            self.assertEqual(openai_util.retry_delay(3, status_error(500)), openai_util.BACKOFF_BASE * 4)
+            self.assertEqual(openai_util.retry_delay(10), openai_util.BACKOFF_MAX)
+        self.assertTrue(all(c[0][0] == 0 for c in uniform.call_args_list))
+
+    def test_alert_once_per_kind(self):
+        with mock.patch.object(openai_util.dedup, 'first_seen', side_effect=[True, False]), \
+                mock.patch.object(openai_util, 'Lark') as lark:
+            openai_util.alert('chat failed', status_error(500))
+            openai_util.alert('chat failed', status_error(500))
+        lark.return_value.send_rich_text.assert_called_once()
@@ -0,0 +1,63 @@
+import hashlib
+from typing import List, Optional
+
+from util import redis_util
+from util.local_cache import LRUCache, MISSING
+from util.log_util import logger
+
+TOKEN_CACHE_SIZE = 200000
+TOKEN_CACHE_TTL = 24 * 3600  # counts never change, the ttl only lets idle entries go
+STORE_TTL = 30 * 86400
+ENCODE_THREADS = 8
+
+_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def count_many(encoding, texts: List[str], store_key: Optional[str] = None) -> List[int]:
+    """
+    Token counts of texts under a tiktoken encoding, cached by content hash and encoding name.
+    Counts are looked up in process first, then in the Redis hash `store_key` (e.g. one per review
+    archive, so a later run over the same archive skips tokenization), and the rest are encoded
+    together with encode_batch on threads.
+    """
+    digests = [_digest(text) for text in texts]
+    counts, missing = [None] * len(texts), []
+    for i, digest in enumerate(digests):
+        value = _cache.get('{}:{}'.format(encoding.name, digest))
+        if value is MISSING:
+            missing.append(i)
+        else:
+            counts[i] = value
+    if not missing:
+        return counts
+
+    key = '{}:{}'.format(store_key, encoding.name) if store_key else None
+    if key:
+        stored = redis_util.hmget(key, [digests[i] for i in missing])
+        for i, value in zip(missing, stored):
+            if value is not None:
+                counts[i] = value
+                _cache.put('{}:{}'.format(encoding.name, digests[i]), value)
+        missing = [i for i in missing if counts[i] is None]
+    if not missing:
+        return counts
+
+    encoded = encoding.encode_batch([texts[i] for i in missing], num_threads=ENCODE_THREADS)
+    fresh = {}
+    for i, tokens in zip(missing, encoded):
+        counts[i] = len(tokens)
+        fresh[digests[i]] = counts[i]
+        _cache.put('{}:{}'.format(encoding.name, digests[i]), counts[i])
+    if key:
+        redis_util.hset_many(key, fresh)
+        redis_util.expire(key, STORE_TTL)
+        logger.info('[token count] {} encoded {} of {} texts, encoding: {}'.format(store_key, len(missing), len(texts), encoding.name))
+    return counts
+
+
+def count(encoding, text: str) -> int:
+    return count_many(encoding, [text])[0]